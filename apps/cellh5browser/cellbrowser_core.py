@@ -349,10 +349,13 @@ class EventObjectItemMixin(object):
     def item_features(self):
         children = self.children()
         if children is not None:
-            return numpy.concatenate([c.features for c in children], axis=0)
+            # read all child rows at once, h5py needs increasing indices
+            idx, inverse = numpy.unique([c.idx for c in children], return_inverse=True)
+            features = children[0]._get_additional_object_data(children[0].name, 'feature')[idx.tolist(), :]
+            return features[inverse]
         else:
             return None
-            
+
     @property
     def item_labels(self):
         children = self.children()
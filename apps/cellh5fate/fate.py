@@ -132,12 +132,11 @@ class CellFateAnalysis(object):
                 continue
             #preds = cellh5pos.get_class_prediction()
             self.tracks[(w, p)] = {}
-            event_ids = cellh5pos.get_events()
+            catalog = cellh5.CH5EventCatalog.build([(self.mcellh5, w, str(int(p)))], onset_frame=onset_frame)
+            catalog = catalog.select(onset_window=(None, events_before_frame - 1), branch=0)
             
-            event_ids = [e for e in event_ids if cellh5pos.get_time_idx(e[onset_frame]) < events_before_frame]
-            
-            self.tracks[(w, p)]['ids'] = event_ids
-            self.tracks[(w, p)]['labels'] = [cellh5pos.get_class_label(e) for e in event_ids]
+            self.tracks[(w, p)]['ids'] = catalog.tracks()
+            self.tracks[(w, p)]['labels'] = catalog.split(catalog.get_class_labels())
             
             print "Read events from ch5:", w, p, "with", list(self.mcellh5.get_treatment_of_pos(w, p))
            
@@ -180,14 +179,14 @@ class CellFateAnalysis(object):
             print w,
             cell5pos = self.mcellh5.get_position(w, p)
             
+            event_ids = self.tracks[(w,p)]['ids']
             class_labels_list = []
             id_list = []
-            for k, e_idx in enumerate(self.tracks[(w,p)]['ids']):   
-                start_idx = e_idx[-1]
-                track = list(e_idx) + cell5pos.track_first(start_idx)
-                class_labels = cell5pos.get_class_label(track)
-                class_labels_list.append(class_labels)
-                id_list.append(track)
+            if len(event_ids) > 0:
+                next_ids, offsets = cell5pos.track_first_many([e_idx[-1] for e_idx in event_ids])
+                id_list = [list(e_idx) + list(next_ids[offsets[k]:offsets[k+1]]) for k, e_idx in enumerate(event_ids)]
+                class_labels = cell5pos.get_class_label(numpy.concatenate(id_list))
+                class_labels_list = numpy.split(class_labels, numpy.cumsum(map(len, id_list))[:-1])
 
             self.tracks[(w,p)][out_name] = class_labels_list
             self.tracks[(w,p)]['track_ids'] = id_list
@@ -230,15 +229,8 @@ class CellFateAnalysis(object):
             print w, 
             cell5pos = self.mcellh5.get_position(w, p)
             
-            hmm_labels_list = []
-            for k, t in enumerate(self.tracks[(w,p)][class_selector]):   
-                class_labels = t
-                if not isinstance(t, (list,)):
-                    class_labels = list(t)
-                    class_labels = numpy.array(map(int, t))
-                
-                hmm_class_labels = self.hmm.predict(numpy.array(class_labels-1)) + 1
-                hmm_labels_list.append(hmm_class_labels)
+            class_labels_list = [numpy.array(map(int, t)) - 1 for t in self.tracks[(w,p)][class_selector]]
+            hmm_labels_list = [l + 1 for l in self.hmm_decoder.predict_tracks(class_labels_list)]
 
                 
             #self.tracks[(w,p)]['class_labels'] = class_labels_list
@@ -339,8 +331,7 @@ class CellFateAnalysis(object):
             ax = pylab.gca()
             
             
-            feature_table = self.mcellh5.get_position(w,str(p)).get_object_features(region_name)
-            feature_idx = self.mcellh5.get_object_feature_idx_by_name(region_name, feature_name)
+            cellh5pos = self.mcellh5.get_position(w,str(p))
 
             id_selector = 'ids'
             fate_ = 'short'
@@ -355,7 +346,7 @@ class CellFateAnalysis(object):
                             (('mito_apo',), 'r', 'Mitosis - death in mitosis')]
             
             for fate_names, fate_color, fate_label in fate_classes:
-                feature_values = []
+                fate_tracks = []
                 for fate_name in fate_names:
                     for track_1, track_2, track_ids in self.tracks[(w,p)][fate_name]:
                         track_str = "".join(map(lambda x: "%02d" % x, track_2))
@@ -367,15 +358,12 @@ class CellFateAnalysis(object):
                             print track_str
                             print ""
                             continue
-                        values = numpy.array([feature_table[t, feature_idx] for t in track_ids[:end]])
-                        values -= feature_min
-                        values /= numpy.mean(values[(self.onset_frame-1):(self.onset_frame+2)])
-                        feature_values.append(values)
-                y = []
-                yerr = []
-                for tmp in izip_longest(*feature_values):
-                    y.append(numpy.array([t for t in tmp if t is not None]).mean())
-                    yerr.append(numpy.array([t for t in tmp if t is not None]).std())
+                        fate_tracks.append(track_ids[:end])
+                values, _ = cellh5pos.get_track_features(fate_tracks, feature_name, region_name)
+                values = values[:, :, 0] - feature_min
+                values /= numpy.nanmean(values[:, (self.onset_frame-1):(self.onset_frame+2)], axis=1)[:, None]
+                y = numpy.nanmean(values, axis=0)
+                yerr = numpy.nanstd(values, axis=0)
                     
                 xa = numpy.arange(-self.onset_frame, len(y)-self.onset_frame, 1) * self.time_lapse
                 
@@ -384,7 +372,7 @@ class CellFateAnalysis(object):
                 if with_fate:
                     step = 4
                     fate_ = 'long'
-                pylab.errorbar(xa[::step], y[::step], yerr=yerr[::step], fmt='o-', color=fate_color, markeredgecolor=fate_color, label=fate_label+" (%d)"%len(feature_values))
+                pylab.errorbar(xa[::step], y[::step], yerr=yerr[::step], fmt='o-', color=fate_color, markeredgecolor=fate_color, label=fate_label+" (%d)"%len(fate_tracks))
   
 
             handles, labels = ax.get_legend_handles_labels()
@@ -431,14 +419,14 @@ class CellFateAnalysis(object):
             
             
             
-            feature_table = self.mcellh5.get_position(w,str(p)).get_object_features(region_name)
-            feature_idx = self.mcellh5.get_object_feature_idx_by_name(region_name, feature_name)
+            cellh5pos = self.mcellh5.get_position(w,str(p))
 
             id_selector = 'ids'
             if with_fate:
                 id_selector = 'track_ids'
             
-            all_feature_values = [feature_table[t, feature_idx] for t in self.tracks[(w,p)][id_selector]]
+            values, offsets = cellh5pos.get_track_features(self.tracks[(w,p)][id_selector], feature_name, region_name, ragged=True)
+            all_feature_values = numpy.split(values[:, 0], offsets[1:-1])
                 
             feature_min = SECURIN_BACKGROUND
                 
@@ -532,8 +520,7 @@ class CellFateAnalysis(object):
             ax = pylab.gca()
             
             
-            feature_table = self.mcellh5.get_position(w,str(p)).get_object_features(region_name)
-            feature_idx = self.mcellh5.get_object_feature_idx_by_name(region_name, feature_name)
+            cellh5pos = self.mcellh5.get_position(w,str(p))
 
             id_selector = 'track_ids'
             fate_ = 'short'
@@ -541,7 +528,8 @@ class CellFateAnalysis(object):
                 id_selector = 'track_ids'
                 fate_ = 'long'
             
-            all_feature_values = [feature_table[t, feature_idx] for t in self.tracks[(w,p)][id_selector]]
+            values, offsets = cellh5pos.get_track_features(self.tracks[(w,p)][id_selector], feature_name, region_name, ragged=True)
+            all_feature_values = numpy.split(values[:, 0], offsets[1:-1])
                 
             feature_min = SECURIN_BACKGROUND #numpy.min(map(numpy.min, all_feature_values))
                 
@@ -591,6 +579,7 @@ class CellFateAnalysis(object):
         est.constrain(constraints)
         self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
         self.hmm._set_emissionprob(est.emis) 
+        self.hmm_decoder = cellh5.HMMViterbiDecoder(est.startprob, transmat, est.emis)
              
     def plot_tracks(self, track_selection, cmaps, names, title='plot_tracks'):
         n = len(track_selection)
@@ -1120,6 +1109,7 @@ class CellFateAnalysisMultiHMM(CellFateAnalysis):
         est.constrain(constraints)
         self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
         self.hmm._set_emissionprob(est.emis) 
+        self.hmm_decoder = cellh5.HMMViterbiDecoder(est.startprob, transmat, est.emis)
         
     def mitotic_entries_within(self, frame_idx, apo_class_label = 5):
         
@@ -1372,6 +1362,7 @@ class CellFateMitoticTiming(CellFateAnalysis):
         est.constrain(constraints)
         self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
         self.hmm._set_emissionprob(est.emis) 
+        self.hmm_decoder = cellh5.HMMViterbiDecoder(est.startprob, transmat, est.emis)
         
     def setup_hmm_2408(self, k_classes, constraint_xml):
         constraints = HMMConstraint(constraint_xml)
@@ -1391,6 +1382,7 @@ class CellFateMitoticTiming(CellFateAnalysis):
         est.constrain(constraints)
         self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
         self.hmm._set_emissionprob(est.emis)
+        self.hmm_decoder = cellh5.HMMViterbiDecoder(est.startprob, transmat, est.emis)
         
     def setup_hmm(self, k_classes, constraint_xml):
         constraints = HMMConstraint(constraint_xml)
@@ -1408,6 +1400,7 @@ class CellFateMitoticTiming(CellFateAnalysis):
         est.constrain(constraints)
         self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
         self.hmm._set_emissionprob(est.emis)
+        self.hmm_decoder = cellh5.HMMViterbiDecoder(est.startprob, transmat, est.emis)
     
     
     def plot_mitotic_timing(self):
@@ -21,16 +21,21 @@ import base64
 import warnings
 import unittest
 import datetime
+import time
 
 import functools
+import itertools
 import collections
+import hashlib
+import threading
+import weakref
 
 from itertools import chain
 from collections import OrderedDict
 from contextlib import contextmanager
 
 from matplotlib.colors import hex2color
-from hmm_wrapper import HMMConstraint, HMMAgnosticEstimator, normalize, hmm
+from hmm_wrapper import HMMConstraint, HMMAgnosticEstimator, HMMViterbiDecoder, normalize, hmm
 from functools import reduce
 
 
@@ -96,108 +101,317 @@ def pandas_ms_apply(df, func, n_cores=10):
     else:
         return res
 
-def repack_cellh5(cellh5_folder, output_file=None, check_reg=r'^[A-Z]\d{2}_\d{2}', new_plate_name=None):
-    """Copies a cellh5 folder well-based into one single postition file"""
-    if output_file is None:
-        output_file = '%s/_all_positions_with_data.ch5' % cellh5_folder
+def _pool_map(func, jobs, n_workers=None):
+    """Results of func (living at the module level) for all picklable jobs,
+       computed in a process pool of n_workers (None for one per CPU) and
+       returned in the order of jobs"""
+    from multiprocessing import Pool
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    pool = Pool(processes=max(1, min(n_workers, len(jobs))))
+    try:
+        return list(pool.imap(func, jobs))
+    finally:
+        pool.terminate()
+
+REPACK_SIZE_ATTR = 'repack_nbytes'
+REPACK_CHECKSUM_ATTR = 'repack_checksum'
+# datasets are copied in slabs of about this size
+REPACK_SLAB_BYTES = 64 * 1024 * 1024
+
+def _repack_unit_size(fhs, unit):
+    nbytes = [0]
+    def _add_(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            nbytes[0] += obj.size * obj.dtype.itemsize
+    for src_file, src_path, _ in unit:
+        obj = fhs[src_file][src_path]
+        if isinstance(obj, h5py.Dataset):
+            _add_(src_path, obj)
+        else:
+            obj.visititems(_add_)
+    return nbytes[0]
+
+def _repack_checksum(data, checksum=0):
+    if data.dtype.kind == 'O':
+        for item in data.ravel():
+            checksum = zlib.crc32(item if isinstance(item, bytes) else str(item).encode(), checksum)
+        return checksum
+    return zlib.crc32(numpy.ascontiguousarray(data).tobytes(), checksum)
+
+def _repack_copy_dataset(src, dst=None, checksum=0):
+    """Checksum of src, read in slabs of about REPACK_SLAB_BYTES along the
+       first axis (aligned to its chunks), each slab is also written to dst if
+       given. Same result as _repack_checksum on the whole dataset."""
+    if src.ndim == 0 or src.size == 0:
+        data = src[()]
+        if dst is not None and src.size > 0:
+            dst[()] = data
+        return _repack_checksum(numpy.asarray(data), checksum)
+
+    row_bytes = max(1, src.size // src.shape[0] * src.dtype.itemsize)
+    step = max(1, REPACK_SLAB_BYTES // row_bytes)
+    if src.chunks is not None:
+        step = max(1, step // src.chunks[0]) * src.chunks[0]
+    for a in range(0, src.shape[0], step):
+        data = src[a:a + step]
+        if dst is not None:
+            dst[a:a + step] = data
+        checksum = _repack_checksum(data, checksum)
+    return checksum
+
+def _repack_read_unit(args):
+    """Worker of repack_positions: size, checksum and layout of all groups and
+       datasets of a unit, the data itself is copied by the writer. Returns None
+       for the layout if the unit is already present in the output with the same
+       size (and checksum if verify is set)."""
+    unit, done_size, done_checksum, verify = args
+    fhs = {}
+    try:
+        for src_file, _, _ in unit:
+            if src_file not in fhs:
+                fhs[src_file] = h5py.File(src_file, 'r')
+
+        nbytes = _repack_unit_size(fhs, unit)
+        if done_size is not None and done_size == nbytes and not verify:
+            return unit, nbytes, done_checksum, None
+
+        groups = []
+        datasets = []
+        for src_file, src_path, dst_path in unit:
+            def _read_(name, obj, src_file=src_file, src_path=src_path, dst_path=dst_path):
+                path = dst_path if name is None else "%s/%s" % (dst_path, name)
+                source = src_path if name is None else "%s/%s" % (src_path, name)
+                attrs = dict(obj.attrs.items())
+                if isinstance(obj, h5py.Dataset):
+                    layout = dict(dtype=obj.dtype, shape=obj.shape, maxshape=obj.maxshape, chunks=obj.chunks,
+                                  compression=obj.compression, compression_opts=obj.compression_opts,
+                                  shuffle=obj.shuffle)
+                    datasets.append((path, (src_file, source), attrs, layout))
+                else:
+                    groups.append((path, attrs))
+            obj = fhs[src_file][src_path]
+            _read_(None, obj)
+            if isinstance(obj, h5py.Group):
+                obj.visititems(_read_)
+
+        if done_size is not None and done_size == nbytes:
+            checksum = 0
+            for _, (src_file, source), _, _ in datasets:
+                checksum = _repack_copy_dataset(fhs[src_file][source], checksum=checksum)
+            if done_checksum == checksum:
+                return unit, nbytes, checksum, None
+        return unit, nbytes, None, (groups, datasets)
+    finally:
+        for fh in fhs.values():
+            fh.close()
 
+def _repack_write_unit(f, unit, nbytes, checksum, payload, chunks=None, compression=None, compression_opts=None):
+    groups, datasets = payload
+    for _, _, dst_path in unit:
+        if dst_path in f:
+            del f[dst_path]
+
+    for path, attrs in groups:
+        grp = f.require_group(path)
+        for k, v in attrs.items():
+            grp.attrs[k] = v
+
+    fhs = {}
+    try:
+        checksum = 0
+        for path, (src_file, source), attrs, layout in datasets:
+            shape = layout['shape']
+            kwargs = dict(dtype=layout['dtype'])
+            if len(shape) > 0 and numpy.prod(shape) > 0:
+                dset_chunks = layout['chunks']
+                if chunks is True:
+                    dset_chunks = True
+                elif callable(chunks):
+                    dset_chunks = chunks(path, shape)
+                dset_compression = layout['compression'] if compression is None else (compression or None)
+                dset_compression_opts = layout['compression_opts'] if compression is None else compression_opts
+                if dset_compression is not None and dset_chunks is None:
+                    dset_chunks = True
+                if dset_chunks is not None:
+                    kwargs.update(chunks=dset_chunks, maxshape=layout['maxshape'], shuffle=layout['shuffle'],
+                                  compression=dset_compression, compression_opts=dset_compression_opts)
+            elif layout['chunks'] is not None:
+                kwargs.update(chunks=layout['chunks'], maxshape=layout['maxshape'])
+            dset = f.create_dataset(path, shape=shape, **kwargs)
+            if src_file not in fhs:
+                fhs[src_file] = h5py.File(src_file, 'r')
+            checksum = _repack_copy_dataset(fhs[src_file][source], dset, checksum)
+            for k, v in attrs.items():
+                dset.attrs[k] = v
+    finally:
+        for fh in fhs.values():
+            fh.close()
+
+    # book keeping for resuming, written after the data
+    grp = f[unit[0][2]]
+    grp.attrs[REPACK_SIZE_ATTR] = nbytes
+    grp.attrs[REPACK_CHECKSUM_ATTR] = checksum
+    f.flush()
+
+def _repack_log_progress(done, total, stats):
+    MODULE_LOGGER.info("Repack %d/%d positions (%d skipped), %5.1f MB at %5.1f MB/s" %
+                       (done, total, stats['skipped'], stats['bytes'] / 1e6, stats['mb_per_sec']))
+
+def repack_positions(units, output_file, definitions=(), n_workers=None, chunks=None, compression=None,
+                     compression_opts=None, verify=False, progress=_repack_log_progress, mode='a'):
+    """Copy position groups of (several) cellh5 files into one output file.
+
+       Source positions are scanned (size, layout and, for resuming, checksum)
+       in a process pool and copied by a single writer (the calling process)
+       in slabs of about REPACK_SLAB_BYTES. Positions already present in the
+       output with matching size (and checksum if verify is set) are skipped,
+       such that an interrupted repack can be resumed.
+
+       units: list of units, each a list of (source_file, source_path, dest_path),
+              the first dest_path of a unit is its position group
+       definitions: list of (source_file, source_path, dest_path) copied once
+                    if dest_path is not yet present
+       n_workers: number of reading processes, 0 reads in the calling process
+       chunks: None to keep the source chunking, True for automatic chunking or a
+               function (dest_path, shape) -> chunk shape
+       compression, compression_opts: None to keep the source compression, False
+               to write uncompressed, otherwise passed to h5py
+       progress: function (done, total, stats) called after each unit
+
+       returns dict with throughput statistics
+    """
+    from multiprocessing import Pool
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    stats = dict(positions=len(units), written=0, skipped=0, bytes=0, seconds=0.0, mb_per_sec=0.0)
+    start = datetime.datetime.now()
+
+    f = h5py.File(output_file, mode)
+    pool = None
+    try:
+        for src_file, src_path, dst_path in definitions:
+            if dst_path not in f:
+                with h5py.File(src_file, 'r') as fh:
+                    f.copy(fh[src_path], dst_path)
+
+        def _task_(unit):
+            dst = unit[0][2]
+            if dst in f and REPACK_SIZE_ATTR in f[dst].attrs:
+                done_size = int(f[dst].attrs[REPACK_SIZE_ATTR])
+                done_checksum = int(f[dst].attrs[REPACK_CHECKSUM_ATTR])
+            else:
+                done_size = done_checksum = None
+            return unit, done_size, done_checksum, verify
+
+        if n_workers > 0:
+            pool = Pool(processes=n_workers)
+            pending = collections.deque()
+            def _results_():
+                # keep at most 2 units per worker in flight to bound memory
+                for unit in units:
+                    pending.append(pool.apply_async(_repack_read_unit, (_task_(unit),)))
+                    if len(pending) >= 2 * n_workers:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            results = _results_()
+        else:
+            results = (_repack_read_unit(_task_(unit)) for unit in units)
+
+        for done, (unit, nbytes, checksum, payload) in enumerate(results):
+            if payload is None:
+                stats['skipped'] += 1
+            else:
+                _repack_write_unit(f, unit, nbytes, checksum, payload, chunks=chunks,
+                                   compression=compression, compression_opts=compression_opts)
+                stats['written'] += 1
+                stats['bytes'] += nbytes
+
+            stats['seconds'] = (datetime.datetime.now() - start).total_seconds()
+            stats['mb_per_sec'] = stats['bytes'] / 1e6 / max(stats['seconds'], 1e-9)
+            if progress is not None:
+                progress(done + 1, len(units), stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        f.close()
+
+    return stats
+
+def _find_cellh5_files(cellh5_folder, check_reg):
     import glob, re
+    flist = sorted(glob.glob('%s/*.ch5' % cellh5_folder))
+    if check_reg is None:
+        return flist
+    reg = re.compile(check_reg)
+    return [fname for fname in flist if reg.search(os.path.split(fname)[1]) is not None]
+
+def _get_plate_and_position(hf_file):
     PLATE_PREFIX = '/sample/0/plate/'
     WELL_PREFIX = PLATE_PREFIX + '%s/experiment/'
     POSITION_PREFIX = WELL_PREFIX + '%s/position/'
+    plate = list(hf_file[PLATE_PREFIX].keys())[0]
+    well = list(hf_file[WELL_PREFIX % plate].keys())[0]
+    position = list(hf_file[POSITION_PREFIX % (plate, well)].keys())[0]
+    return plate, well, position
 
-    def get_plate_and_postion(hf_file):
-        plate = list(hf_file[PLATE_PREFIX].keys())[0]
-        well = list(hf_file[WELL_PREFIX % plate].keys())[0]
-        position = list(hf_file[POSITION_PREFIX % (plate, well)].keys())[0]
-        return plate, well, position
+def repack_cellh5(cellh5_folder, output_file=None, check_reg=r'^[A-Z]\d{2}_\d{2}', new_plate_name=None,
+                  n_workers=None, resume=True, **kwargs):
+    """Copies a cellh5 folder well-based into one single postition file
 
-    flist = sorted(glob.glob('%s/*.ch5' % cellh5_folder))
+       see repack_positions for the parallel and resume options
+    """
+    if output_file is None:
+        output_file = '%s/_all_positions_with_data.ch5' % cellh5_folder
 
-    f = h5py.File(output_file, 'w')
+    flist = _find_cellh5_files(cellh5_folder, check_reg)
 
-    if check_reg is not None:
-        reg = re.compile(check_reg)
-    else:
-        reg = None
-    cnt = 0
+    units = []
     for fname in flist:
-        if reg is None or reg.search(os.path.split(fname)[1]) is not None:
-            #print cnt, fname
-            if cnt == 0:
-                # write definition
-                fh = h5py.File(fname, 'r')
-                f.copy(fh['/definition'], 'definition')
-                fh.close()
-            # copy suff
-            try:
-                fh = h5py.File(fname, 'r')
-            except IOError as e:
-                print(fname)
-                raise
-            fplate, fwell, fpos = get_plate_and_postion(fh)
+        with h5py.File(fname, 'r') as fh:
+            fplate, fwell, fpos = _get_plate_and_position(fh)
 
+        if new_plate_name is not None:
+            fplate_out = new_plate_name
+        else:
+            fplate_out = fplate
+        units.append([(fname, CH5PositionCoordinate(fplate, fwell, fpos).get_path(),
+                             CH5PositionCoordinate(fplate_out, fwell, fpos).get_path())])
 
-            if new_plate_name is not None:
-                fplate_out = new_plate_name
-            else:
-                fplate_out = fplate
-            print(" copying", fplate_out, (POSITION_PREFIX + '%s') % (fplate, fwell, fpos))
-            f.copy(fh[(POSITION_PREFIX + '%s') % (fplate, fwell, fpos)], (POSITION_PREFIX + '%s') % (fplate_out, fwell, fpos))
-            fh.close()
-            cnt += 1
-    f.close()
+    definitions = [(flist[0], '/definition', 'definition')] if len(flist) > 0 else []
+    return repack_positions(units, output_file, definitions=definitions, n_workers=n_workers,
+                            mode='a' if resume else 'w', **kwargs)
 
-def repack_cellh5_and_combine(cellh5_folder, cellh5_folder_2, rel_path_src, rel_path_dest):
+def repack_cellh5_and_combine(cellh5_folder, cellh5_folder_2, rel_path_src, rel_path_dest,
+                              n_workers=None, resume=True, **kwargs):
     """Copies a cellh5 folder wellbased into one single postition file
        and copies stuff from another cellh5 into that one (usefull if the same exp
        ran twice)
     """
-    import glob, re
-    PLATE_PREFIX = '/sample/0/plate/'
-    WELL_PREFIX = PLATE_PREFIX + '%s/experiment/'
-    POSITION_PREFIX = WELL_PREFIX + '%s/position/'
-
-    def get_plate_and_postion(hf_file):
-        plate = list(hf_file[PLATE_PREFIX].keys())[0]
-        well = list(hf_file[WELL_PREFIX % plate].keys())[0]
-        position = list(hf_file[POSITION_PREFIX % (plate, well)].keys())[0]
-        return plate, well, position
-
-    flist = sorted(glob.glob('%s/*.ch5' % cellh5_folder))
-
-    f = h5py.File('%s/_all_positions_with_data_combined.ch5' % cellh5_folder, 'w')
+    flist = _find_cellh5_files(cellh5_folder, r'^[A-Z]\d{2}_\d{2}')
 
-    reg = re.compile('^[A-Z]\d{2}_\d{2}')
-    cnt = 0
+    units = []
     for fname in flist:
-        if reg.search(os.path.split(fname)[1]) is not None:
-            print(cnt, fname)
-            if cnt == 0:
-                # write definition
-                fh = h5py.File(fname, 'r')
-                fh_2 = h5py.File(os.path.join(cellh5_folder_2, os.path.split(fname)[1]), 'r')
-                f.copy(fh['/definition'], 'definition')
-                for rps, rpd in zip(rel_path_src, rel_path_dest):
-                    f.copy(fh_2['/definition/%s' % rps], 'definition/%s' % rpd)
-
-                fh.close()
-                fh_2.close()
-            # copy suff
-            fh = h5py.File(fname, 'r')
-            fh_2 = h5py.File(os.path.join(cellh5_folder_2, os.path.split(fname)[1]), 'r')
-            fplate, fwell, fpos = get_plate_and_postion(fh)
-            # print (POSITION_PREFIX + '%s') % (fplate, fwell, fpos)
-            pos_path_in_ch5 = (POSITION_PREFIX + '%s') % (fplate, fwell, fpos)
-            f.copy(fh[pos_path_in_ch5], pos_path_in_ch5)
-            for rps, rpd in zip(rel_path_src, rel_path_dest):
-                f.copy(fh_2[pos_path_in_ch5 + ("/%s" % rps)], pos_path_in_ch5 + ("/%s" % rpd))
-
-            fh.close()
-            fh_2.close()
-            cnt += 1
-
-    f.close()
+        fname_2 = os.path.join(cellh5_folder_2, os.path.split(fname)[1])
+        with h5py.File(fname, 'r') as fh:
+            pos_path_in_ch5 = CH5PositionCoordinate(*_get_plate_and_position(fh)).get_path()
+        unit = [(fname, pos_path_in_ch5, pos_path_in_ch5)]
+        for rps, rpd in zip(rel_path_src, rel_path_dest):
+            unit.append((fname_2, pos_path_in_ch5 + ("/%s" % rps), pos_path_in_ch5 + ("/%s" % rpd)))
+        units.append(unit)
+
+    definitions = []
+    if len(flist) > 0:
+        definitions.append((flist[0], '/definition', 'definition'))
+        fname_2 = os.path.join(cellh5_folder_2, os.path.split(flist[0])[1])
+        for rps, rpd in zip(rel_path_src, rel_path_dest):
+            definitions.append((fname_2, '/definition/%s' % rps, 'definition/%s' % rpd))
+
+    return repack_positions(units, '%s/_all_positions_with_data_combined.ch5' % cellh5_folder,
+                            definitions=definitions, n_workers=n_workers, mode='a' if resume else 'w', **kwargs)
 
 def hex2rgb(color, mpl=False):
     """Return the rgb color as python int in the range 0-255."""
@@ -221,16 +435,101 @@ def to_index_array(value):
     else:
         return numpy.array([value])
 
+def ragged_arange(starts, lengths):
+    """Concatenation of numpy.arange(s, s + l) for all s, l in zip(starts, lengths)"""
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    return numpy.arange(lengths.sum()) + numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+
+def pad_tracks(values, offsets, align=None, window=None, fill=numpy.nan):
+    """Padded (n_tracks, length, ...) array of the ragged array values, offsets.
+
+       align: index of the onset object in each track (scalar or per track);
+              tracks are shifted such that all onsets fall into the same column
+       window: (before, after) number of frames kept before and after the onset,
+               defaults to the longest extents of all tracks
+
+       Returns the padded array and the column of the onset (0 without align)
+    """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    lengths = numpy.diff(offsets)
+    n_tracks = len(lengths)
+    if align is None:
+        align = numpy.zeros(n_tracks, dtype=numpy.int64)
+    else:
+        align = numpy.broadcast_to(numpy.asarray(align, dtype=numpy.int64), (n_tracks,))
+    if window is None:
+        before = int(align.max()) if n_tracks > 0 else 0
+        after = int((lengths - align).max()) - 1 if n_tracks > 0 else -1
+    else:
+        before, after = window
+
+    track = numpy.repeat(numpy.arange(n_tracks), lengths)
+    column = ragged_arange(numpy.zeros(n_tracks), lengths) + numpy.repeat(before - align, lengths)
+    keep = (column >= 0) & (column <= before + after)
+
+    values = numpy.asarray(values)
+    result = numpy.empty((n_tracks, max(before + after + 1, 0)) + values.shape[1:],
+                         dtype=numpy.result_type(values.dtype, numpy.min_scalar_type(fill)))
+    result.fill(fill)
+    result[track[keep], column[keep]] = values[keep]
+    return result, before
+
+READ_MAX_GAP = 128
+
+def read_coalesced(dset, index, fields=(), max_gap=None):
+    """Read the rows given by an arbitrary index array (unsorted, with
+       duplicates or negative values) from a HDF5 dataset.
+
+       The unique indices are grouped into runs, where consecutive indices
+       less than max_gap rows apart are merged, and each run is read with a
+       single contiguous slab read. The rows are returned in the order of
+       index with shape index.shape + dset.shape[1:].
+
+       fields: field name or tuple of field names to read from compound datasets
+       max_gap: gap merging threshold in rows, defaults to READ_MAX_GAP
+    """
+    if max_gap is None:
+        max_gap = READ_MAX_GAP
+    if isinstance(fields, str):
+        fields = (fields,)
+    fields = tuple(fields)
+
+    index = numpy.asarray(index)
+    flat = index.ravel().astype(numpy.int64)
+    n_rows = dset.shape[0]
+    flat = numpy.where(flat < 0, flat + n_rows, flat)
+    if len(flat) > 0 and (flat.min() < 0 or flat.max() >= n_rows):
+        raise IndexError("Index out of range for dataset '%s' with %d rows" % (dset.name, n_rows))
+
+    uindex, inverse = numpy.unique(flat, return_inverse=True)
+    if len(uindex) == 0:
+        data = dset[(slice(0, 0),) + fields]
+        return data.reshape(index.shape + data.shape[1:])
+
+    breaks = numpy.nonzero(numpy.diff(uindex) > max_gap + 1)[0] + 1
+    parts = []
+    for run in numpy.split(uindex, breaks):
+        start, stop = run[0], run[-1] + 1
+        slab = dset[(slice(start, stop),) + fields]
+        if stop - start == len(run):
+            parts.append(slab)
+        else:
+            parts.append(slab[run - start])
+    data = parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+    return data[inverse.ravel()].reshape(index.shape + data.shape[1:])
+
 @contextmanager
-def ch5open(filename, mode='r', cached=True):
+def ch5open(filename, mode='r', cached=True, swmr=False):
     """Open a cellh5 file using the with statement. The file handle is closed
-    automatically.
+    automatically. swmr=True opens a file still being written in streaming
+    mode for reading (see CH5Position.refresh).
 
     >>>with ch5open('datafile.ch5', 'r', cached=False) as ch5:
     >>>   ch5.get_position("0", "0038")
     """
 
-    ch5 = CH5File(filename, mode, cached)
+    ch5 = CH5File(filename, mode, cached, swmr=swmr)
     yield ch5
     ch5.close()
 
@@ -240,6 +539,8 @@ class CH5Const(object):
     # defaults for unpredicted objects, -1 one might be not a
     UNPREDICTED_LABEL = -99
     UNPREDICTED_PROB = numpy.nan
+    UNPREDICTED_NAME = 'unpredicted'
+    UNPREDICTED_COLOR = '#FFFFFF'
 
     REGION = 'region'
     RELATION = 'relation'
@@ -262,6 +563,11 @@ class CH5Const(object):
     RAW_IMAGE = "channel"
     LABEL_IMAGE = "region"
 
+    # publication log of positions written in streaming (SWMR) mode, one row
+    # (time_idx, row counts of the logged tables) per completed frame
+    PUBLISHED = "published"
+    STREAM_CLOSED = -1
+
     NOT_DEFINED = 'none'
 
 
@@ -292,36 +598,726 @@ class CH5GroupCoordinate(object):
         self.plate = plate
         self.sample = sample
 
+class CH5Cache(object):
+    """Least recently used cache with a byte budget, shared by all cached
+       positions and files (see memoize).
+
+       Entries are keyed by owner, method and arguments. Numpy arrays, lists
+       and tuples given as arguments are hashed by content. Hits, misses and
+       evictions are counted per method.
+    """
+    DEFAULT_MAX_BYTES = 1 << 30
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._owner_keys = collections.defaultdict(set)
+        self._stats = collections.defaultdict(lambda: dict(hits=0, misses=0, evictions=0, uncacheable=0))
+        self._lock = threading.RLock()
+        self._owner_ids = itertools.count()
+
+    @staticmethod
+    def make_key(value):
+        """Hashable representation of an argument, raises TypeError if none exists"""
+        if isinstance(value, numpy.ndarray):
+            data = numpy.ascontiguousarray(value)
+            if data.dtype.hasobject:
+                return ('ndarray', data.dtype.str, data.shape, CH5Cache.make_key(data.tolist()))
+            return ('ndarray', data.dtype.str, data.shape, hashlib.sha1(data.view(numpy.uint8)).hexdigest())
+        elif isinstance(value, (list, tuple)):
+            return (type(value).__name__,) + tuple(CH5Cache.make_key(v) for v in value)
+        elif isinstance(value, dict):
+            return ('dict',) + tuple(sorted((k, CH5Cache.make_key(v)) for k, v in value.items()))
+        hash(value)
+        return value
+
+    @staticmethod
+    def sizeof(value):
+        """Approximate memory consumption of a cached value in bytes"""
+        if isinstance(value, numpy.ndarray):
+            if value.dtype.hasobject:
+                return value.nbytes + sum(CH5Cache.sizeof(v) for v in value.flat)
+            return value.nbytes
+        elif isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(CH5Cache.sizeof(v) for v in value)
+        elif isinstance(value, dict):
+            return sys.getsizeof(value) + sum(CH5Cache.sizeof(v) for v in value.values())
+        elif hasattr(value, 'nbytes'):
+            return sys.getsizeof(value) + int(value.nbytes)
+        return sys.getsizeof(value)
+
+    def owner_id(self, owner):
+        try:
+            return owner.__dict__['_cache_owner_id']
+        except KeyError:
+            owner_id = next(self._owner_ids)
+            owner.__dict__['_cache_owner_id'] = owner_id
+            # drop all entries once the owner is garbage collected
+            weakref.finalize(owner, self._invalidate_owner_id, owner_id)
+            return owner_id
+
+    def get(self, owner, method, args, kwargs, func):
+        """Return the cached result of func(owner, *args, **kwargs) or compute it"""
+        try:
+            key = (self.owner_id(owner), method,
+                   self.make_key(args), self.make_key(dict(kwargs)))
+        except TypeError:
+            with self._lock:
+                self._stats[method]['uncacheable'] += 1
+            return func(owner, *args, **kwargs)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._stats[method]['hits'] += 1
+                return self._entries[key][0]
+            self._stats[method]['misses'] += 1
+
+        res = func(owner, *args, **kwargs)
+        self.put(key, res)
+        return res
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes)
+            self._owner_keys[key[0]].add(key)
+            self.nbytes += nbytes
+            self._shrink(self.max_bytes)
+
+    def _remove(self, key):
+        _, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        keys = self._owner_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._owner_keys[key[0]]
+
+    def _shrink(self, max_bytes):
+        while self.nbytes > max_bytes and len(self._entries) > 0:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self._stats[key[1]]['evictions'] += 1
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink(max_bytes)
+
+    @staticmethod
+    def _matches(key, method):
+        return method is None or key[1] == method or key[1].endswith('.' + method)
+
+    def _invalidate_owner_id(self, owner_id, method=None):
+        with self._lock:
+            for key in list(self._owner_keys.get(owner_id, ())):
+                if self._matches(key, method):
+                    self._remove(key)
+
+    def invalidate(self, owner=None, method=None):
+        """Drop cached entries of an owner (all owners if None), optionally
+           only the ones of a method given by its name, e.g. 'get_events'"""
+        with self._lock:
+            if owner is not None:
+                if '_cache_owner_id' in owner.__dict__:
+                    self._invalidate_owner_id(owner.__dict__['_cache_owner_id'], method)
+                return
+            for key in list(self._entries.keys()):
+                if self._matches(key, method):
+                    self._remove(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def reset_statistics(self):
+        with self._lock:
+            self._stats.clear()
+
+    def statistics(self):
+        """Hit/miss/eviction counts and current memory usage per method"""
+        with self._lock:
+            stats = pandas.DataFrame.from_dict(dict(self._stats), orient='index',
+                                               columns=['hits', 'misses', 'evictions', 'uncacheable'])
+            stats['entries'] = 0
+            stats['nbytes'] = 0
+            for (_, method, _, _), (_, nbytes) in self._entries.items():
+                stats.loc[method, 'entries'] += 1
+                stats.loc[method, 'nbytes'] += nbytes
+        return stats.fillna(0)
+
+CH5_CACHE = CH5Cache()
+
 class memoize(object):
-    """Cache the return value of a method
-       make sure the arguments are hashable
+    """Cache the return value of a method in the global CH5_CACHE.
+       Arguments need to be hashable, numpy arrays, lists or tuples.
     """
     def __init__(self, func):
         self.func = func
-        self.cache = {}
+        self.name = func.__qualname__
+        functools.update_wrapper(self, func)
 
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self.func
         return functools.partial(self, obj)
 
-    def __call__(self, *args, **kw):
-        key = (self.func, args, frozenset(list(kw.items())))
+    def __call__(self, obj, *args, **kw):
+        return CH5_CACHE.get(obj, self.name, args, kw, self.func)
 
-        obj = args[0]
-        if not hasattr(obj, "_cache"):
-            obj._cache = dict()
+class CH5Table(object):
+    """Lazy view on a (compound) table of a position, e.g. object/<name>,
+       object/tracking, object/event, feature/<name>/center or bounding_box.
 
-        try:
-            res = obj._cache[key]
-        except KeyError:
-            res = self.func(*args, **kw)
-            obj._cache[key] = res
-        except TypeError:
-            # if key is not hashable (e.g ndarrays)
-            res = self.func(*args, **kw)
+       Nothing is read on construction. Field names, slices, index arrays and
+       boolean masks are translated into HDF5 reads of only the requested
+       fields and rows:
 
-        return res
+       >>>table = pos.get_table('object/primary__primary')
+       >>>table['time_idx']                  # one column
+       >>>table[10:20]                       # rows 10 to 19, all fields
+       >>>table[mask, 'time_idx']            # column restricted to a boolean mask
+       >>>table[['time_idx', 'obj_label_id']][index]
+    """
+    def __init__(self, dset, fields=()):
+        self.dset = dset
+        self.fields = tuple(fields)
+
+    def __len__(self):
+        return self.dset.shape[0]
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+    @property
+    def dtype(self):
+        if len(self.fields) == 0:
+            return self.dset.dtype
+        return numpy.dtype([(f, self.dset.dtype.fields[f][0]) for f in self.fields])
+
+    @property
+    def names(self):
+        if len(self.fields) == 0:
+            return self.dset.dtype.names
+        return self.fields
+
+    def select(self, *fields):
+        """Return a view restricted to the given fields"""
+        return CH5Table(self.dset, fields)
+
+    def read(self):
+        return self._read(slice(None), self.fields)
+
+    def __getitem__(self, key):
+        fields = self.fields
+        if isinstance(key, str):
+            return self._read(slice(None), (key,))
+        if isinstance(key, list) and len(key) > 0 and all(isinstance(k, str) for k in key):
+            return self.select(*key)
+        if isinstance(key, tuple):
+            names = tuple(k for k in key if isinstance(k, str))
+            rows = [k for k in key if not isinstance(k, str)]
+            if len(names) > 0:
+                fields = names
+            if len(rows) > 1:
+                raise IndexError("CH5Table supports indexing of the first dimension only")
+            # also accepts the result of numpy.nonzero/where
+            key = rows[0] if len(rows) == 1 else slice(None)
+        return self._read(key, fields)
+
+    def _read(self, rows, fields):
+        if isinstance(self.dset, numpy.ndarray):
+            # rows already in memory, e.g. published rows of a streamed position
+            if len(fields) == 0:
+                return self.dset[rows]
+            return self.dset[fields[0] if len(fields) == 1 else list(fields)][rows]
+        if isinstance(rows, slice):
+            return self.dset[(rows,) + fields]
+        if numpy.isscalar(rows) and not isinstance(rows, (bool, numpy.bool_)):
+            return self.dset[(int(rows),) + fields]
+        rows = numpy.asarray(rows)
+        if rows.dtype == bool:
+            if rows.shape != (len(self),):
+                raise IndexError("Boolean mask of shape %r does not match table of length %d" % (rows.shape, len(self)))
+            rows = numpy.nonzero(rows)[0]
+        return read_coalesced(self.dset, rows, fields)
+
+class CH5FrameIndex(object):
+    """Objects of a position grouped by time frame (CSR layout). The objects
+       of frame t are order[offsets[t]:offsets[t + 1]], in ascending object
+       index, so frame lookups and per-frame counts are slices."""
+    def __init__(self, order, offsets):
+        self.order = numpy.asarray(order, dtype=numpy.int64)
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+
+    @classmethod
+    def from_time_idx(cls, time_idx):
+        time_idx = numpy.asarray(time_idx, dtype=numpy.int64)
+        if len(time_idx) == 0:
+            return cls(numpy.zeros((0,), dtype=numpy.int64), numpy.zeros((1,), dtype=numpy.int64))
+        if time_idx.min() < 0:
+            raise ValueError('Error: cellh5 - negative time index in object table')
+        offsets = numpy.r_[0, numpy.cumsum(numpy.bincount(time_idx))]
+        if numpy.all(time_idx[1:] >= time_idx[:-1]):
+            order = numpy.arange(len(time_idx))
+        else:
+            order = numpy.argsort(time_idx, kind='mergesort')
+        return cls(order, offsets)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['order'], arrays['offsets'])
+
+    def to_arrays(self):
+        return {'order': self.order, 'offsets': self.offsets}
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.offsets.nbytes
+
+    @property
+    def n_frames(self):
+        return len(self.offsets) - 1
+
+    def _clip(self, frame):
+        return min(max(int(frame), 0), self.n_frames)
+
+    def objects_in_frames(self, start, stop):
+        """Objects with start <= time_idx < stop, ordered by frame"""
+        start, stop = self._clip(start), self._clip(stop)
+        if stop <= start:
+            return self.order[:0]
+        return self.order[self.offsets[start]:self.offsets[stop]]
+
+    def objects_in_frame(self, frame):
+        return self.objects_in_frames(frame, frame + 1)
+
+    def objects_of(self, frames):
+        """Objects in any of the given frames, in ascending object index
+           (same result as numpy.nonzero(numpy.in1d(time_idx, frames))[0])"""
+        frames = numpy.unique(numpy.asarray(frames).ravel())
+        if frames.dtype.kind == 'f':
+            frames = frames[frames == numpy.floor(frames)]
+        frames = frames.astype(numpy.int64)
+        frames = frames[(frames >= 0) & (frames < self.n_frames)]
+
+        starts = self.offsets[frames]
+        idx = ragged_arange(starts, self.offsets[frames + 1] - starts)
+        return numpy.sort(self.order[idx])
+
+    def counts(self, start=0, stop=None):
+        """Number of objects per frame for frames start <= t < stop"""
+        if stop is None:
+            stop = self.n_frames
+        start, stop = self._clip(start), self._clip(stop)
+        return numpy.diff(self.offsets[start:max(start, stop) + 1])
+
+    def count(self, frame):
+        return len(self.objects_in_frame(frame))
+
+class CH5PublishedTables(object):
+    """Rows of the logged tables of a position published so far by a
+       streaming writer. Every row is read once, when its frame is published."""
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.counts = numpy.zeros(len(self.paths), dtype=numpy.int64)
+        self.frames = numpy.zeros((0,), dtype=numpy.int64)
+        self.n_log_rows = 0
+        self.closed = False
+        self._blocks = dict((path, []) for path in self.paths)
+
+    def __contains__(self, path):
+        return path in self._blocks
+
+    def append(self, path, rows):
+        self._blocks[path].append(rows)
+
+    def get(self, path):
+        blocks = self._blocks[path]
+        if len(blocks) > 1:
+            blocks[:] = [numpy.concatenate(blocks)]
+        return blocks[0]
+
+    def add_log_rows(self, log_rows):
+        """Account for new rows of the publication log, returns the new frames"""
+        self.n_log_rows += len(log_rows)
+        self.counts = numpy.asarray(log_rows[-1, 1:], dtype=numpy.int64)
+        time_idx = numpy.asarray(log_rows[:, 0], dtype=numpy.int64)
+        self.closed = self.closed or bool((time_idx == CH5Const.STREAM_CLOSED).any())
+        frames = time_idx[time_idx != CH5Const.STREAM_CLOSED]
+        self.frames = numpy.r_[self.frames, frames]
+        return frames
+
+class CH5TrackingGraph(object):
+    """Tracking graph of a position as CSR adjacency arrays in both
+       directions. Successors of object i are
+       successors[succ_offsets[i]:succ_offsets[i + 1]] (predecessors
+       likewise), in the order of the edges in object/tracking."""
+    def __init__(self, succ_offsets, successors, pred_offsets, predecessors):
+        self.succ_offsets = numpy.asarray(succ_offsets, dtype=numpy.int64)
+        self.successors = numpy.asarray(successors, dtype=numpy.int64)
+        self.pred_offsets = numpy.asarray(pred_offsets, dtype=numpy.int64)
+        self.predecessors = numpy.asarray(predecessors, dtype=numpy.int64)
+
+    @staticmethod
+    def _csr(source, target, n_nodes):
+        order = numpy.argsort(source, kind='mergesort')
+        offsets = numpy.r_[0, numpy.cumsum(numpy.bincount(source, minlength=n_nodes))]
+        return offsets, target[order]
+
+    @classmethod
+    def from_tracking(cls, tracking):
+        """Build from a tracking table with fields obj_idx1 (from) and obj_idx2 (to)"""
+        idx1 = numpy.asarray(tracking['obj_idx1'], dtype=numpy.int64)
+        idx2 = numpy.asarray(tracking['obj_idx2'], dtype=numpy.int64)
+        n_nodes = int(max(idx1.max(), idx2.max())) + 1 if len(idx1) > 0 else 0
+        succ_offsets, successors = cls._csr(idx1, idx2, n_nodes)
+        pred_offsets, predecessors = cls._csr(idx2, idx1, n_nodes)
+        return cls(succ_offsets, successors, pred_offsets, predecessors)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['succ_offsets'], arrays['successors'], arrays['pred_offsets'], arrays['predecessors'])
+
+    def to_arrays(self):
+        return {'succ_offsets': self.succ_offsets, 'successors': self.successors,
+                'pred_offsets': self.pred_offsets, 'predecessors': self.predecessors}
+
+    @property
+    def n_nodes(self):
+        return len(self.succ_offsets) - 1
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.to_arrays().values())
+
+    def _degree(self, offsets, index):
+        index = to_index_array(index)
+        valid = (index >= 0) & (index < self.n_nodes)
+        degree = numpy.zeros(index.shape, dtype=numpy.int64)
+        degree[valid] = offsets[index[valid] + 1] - offsets[index[valid]]
+        return degree
+
+    def out_degree(self, index):
+        return self._degree(self.succ_offsets, index)
+
+    def in_degree(self, index):
+        return self._degree(self.pred_offsets, index)
+
+    def is_split(self, index):
+        return self.out_degree(index) > 1
+
+    def split_objects(self):
+        """Objects with more than one successor"""
+        return numpy.nonzero(numpy.diff(self.succ_offsets) > 1)[0]
+
+    def _neighbors(self, offsets, neighbors, idx):
+        if idx < 0 or idx >= self.n_nodes:
+            return neighbors[:0]
+        return neighbors[offsets[idx]:offsets[idx + 1]]
+
+    def get_successors(self, idx):
+        return self._neighbors(self.succ_offsets, self.successors, idx)
+
+    def get_predecessors(self, idx):
+        return self._neighbors(self.pred_offsets, self.predecessors, idx)
+
+    def _neighbors_many(self, offsets, neighbors, index):
+        index = to_index_array(index).ravel()
+        starts = numpy.zeros(len(index), dtype=numpy.int64)
+        lengths = numpy.zeros(len(index), dtype=numpy.int64)
+        valid = (index >= 0) & (index < self.n_nodes)
+        starts[valid] = offsets[index[valid]]
+        lengths[valid] = offsets[index[valid] + 1] - starts[valid]
+        return neighbors[ragged_arange(starts, lengths)], numpy.r_[0, numpy.cumsum(lengths)]
+
+    def get_successors_many(self, index):
+        """Successors of all objects in index as ragged array (flat, offsets)"""
+        return self._neighbors_many(self.succ_offsets, self.successors, index)
+
+    def get_predecessors_many(self, index):
+        """Predecessors of all objects in index as ragged array (flat, offsets)"""
+        return self._neighbors_many(self.pred_offsets, self.predecessors, index)
+
+    @staticmethod
+    def _select(flat, offsets, select):
+        counts = numpy.diff(offsets)
+        chosen = -numpy.ones(len(counts), dtype=numpy.int64)
+        has_next = counts > 0
+        if isinstance(select, str) and select == 'first':
+            chosen[has_next] = flat[offsets[:-1][has_next]]
+        elif isinstance(select, str) and select == 'last':
+            chosen[has_next] = flat[offsets[1:][has_next] - 1]
+        else:
+            # first neighbor with the largest weight, like numpy.argmax
+            segment = numpy.repeat(numpy.arange(len(counts)), counts)
+            order = numpy.lexsort((numpy.arange(len(flat)), -numpy.asarray(select)[flat], segment))
+            chosen[has_next] = flat[order[offsets[:-1][has_next]]]
+        return chosen
+
+    def next_objects(self, index, select='first'):
+        """Successor of each object in index chosen by select ('first',
+           'last' or an array of per-object weights, taking the largest),
+           -1 for objects without successor"""
+        flat, offsets = self.get_successors_many(index)
+        return self._select(flat, offsets, select)
+
+    def previous_objects(self, index, select='first'):
+        """Predecessor of each object in index, see next_objects"""
+        flat, offsets = self.get_predecessors_many(index)
+        return self._select(flat, offsets, select)
+
+class CH5LineageForest(object):
+    """Lineage forest of a position built from its tracking graph, as flat
+       arrays over all objects: parent (-1 for roots), first_child and
+       next_sibling (-1 if none, children in tracking edge order), depth,
+       division (more than one child), subtree size and preorder position.
+       Subtrees are contiguous in preorder, so descendants and leaves of an
+       object are slices. Objects with more than one predecessor (merges)
+       are attached to the first one only.
+    """
+    def __init__(self, parent, first_child, next_sibling, depth, size, preorder):
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.depth = depth
+        self.size = size
+        self.preorder = preorder
+        self.division = numpy.zeros(len(parent), dtype=bool)
+        has_child = first_child >= 0
+        self.division[has_child] = next_sibling[first_child[has_child]] >= 0
+        self.order = numpy.empty(len(parent), dtype=numpy.int64)
+        self.order[preorder] = numpy.arange(len(parent))
+
+    @classmethod
+    def from_graph(cls, graph):
+        n = graph.n_nodes
+        nodes = numpy.arange(n)
+        parent = graph.previous_objects(nodes)
+
+        # tree edges in tracking order, grouped by parent
+        children, offsets = graph.get_successors_many(nodes)
+        src = numpy.repeat(nodes, numpy.diff(offsets))
+        keep = parent[children] == src
+        children, src = children[keep], src[keep]
+        first_edge = numpy.ones(len(src), dtype=bool)
+        first_edge[1:] = src[1:] != src[:-1]
+        first_child = -numpy.ones(n, dtype=numpy.int64)
+        first_child[src[first_edge]] = children[first_edge]
+        next_sibling = -numpy.ones(n, dtype=numpy.int64)
+        next_sibling[children[:-1][~first_edge[1:]]] = children[1:][~first_edge[1:]]
+        child_offsets = numpy.r_[0, numpy.cumsum(numpy.bincount(src, minlength=n))]
+
+        # levels by breadth first search from the roots
+        depth = numpy.zeros(n, dtype=numpy.int64)
+        levels = [numpy.flatnonzero(parent < 0)]
+        while len(levels[-1]) > 0:
+            starts = child_offsets[levels[-1]]
+            level = children[ragged_arange(starts, child_offsets[levels[-1] + 1] - starts)]
+            depth[level] = len(levels)
+            levels.append(level)
+
+        # subtree sizes bottom up, preorder positions top down
+        size = numpy.ones(n, dtype=numpy.int64)
+        for level in reversed(levels[1:]):
+            numpy.add.at(size, parent[level], size[level])
+        sibling_size = size[children]
+        before = numpy.cumsum(sibling_size) - sibling_size
+        group_start = numpy.maximum.accumulate(numpy.where(first_edge, numpy.arange(len(src)), 0)) if len(src) else before
+        sibling_offset = numpy.zeros(n, dtype=numpy.int64)
+        sibling_offset[children] = before - before[group_start]
+
+        preorder = numpy.zeros(n, dtype=numpy.int64)
+        preorder[levels[0]] = numpy.cumsum(size[levels[0]]) - size[levels[0]]
+        for level in levels[1:]:
+            preorder[level] = preorder[parent[level]] + 1 + sibling_offset[level]
+        return cls(parent, first_child, next_sibling, depth, size, preorder)
+
+    @property
+    def n_nodes(self):
+        return len(self.parent)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.parent, self.first_child, self.next_sibling, self.depth,
+                                      self.size, self.preorder, self.order, self.division))
+
+    def _in_forest(self, idx):
+        return 0 <= idx < self.n_nodes
+
+    def roots(self):
+        return numpy.flatnonzero(self.parent < 0)
+
+    def children(self, idx):
+        result = []
+        child = self.first_child[idx] if self._in_forest(idx) else -1
+        while child >= 0:
+            result.append(child)
+            child = self.next_sibling[child]
+        return numpy.array(result, dtype=numpy.int64)
+
+    def ancestors(self, idx):
+        """Ancestors of an object, from its parent up to the root"""
+        result = []
+        idx = self.parent[idx] if self._in_forest(idx) else -1
+        while idx >= 0:
+            result.append(idx)
+            idx = self.parent[idx]
+        return numpy.array(result, dtype=numpy.int64)
+
+    def subtree(self, idx):
+        """The object and all its descendants in preorder"""
+        if not self._in_forest(idx):
+            return numpy.array([idx], dtype=numpy.int64)
+        return self.order[self.preorder[idx]:self.preorder[idx] + self.size[idx]]
+
+    def descendants(self, idx):
+        return self.subtree(idx)[1:]
+
+    def leaves(self, idx):
+        """Objects without children in the subtree of idx, in preorder"""
+        subtree = self.subtree(idx)
+        if not self._in_forest(idx):
+            return subtree
+        return subtree[self.first_child[subtree] < 0]
+
+    def paths(self, index):
+        """All paths from the objects in index to the leaves of their
+           subtrees, as ragged array (flat, offsets) in preorder of the leaves"""
+        index = to_index_array(index).ravel()
+        leaves = [self.leaves(idx) for idx in index]
+        starts = numpy.repeat(index, list(map(len, leaves))).astype(numpy.int64)
+        leaves = numpy.concatenate(leaves).astype(numpy.int64) if len(leaves) > 0 else starts
+        in_forest = (leaves >= 0) & (leaves < self.n_nodes)
+        lengths = numpy.ones(len(leaves), dtype=numpy.int64)
+        lengths[in_forest] += self.depth[leaves[in_forest]] - self.depth[starts[in_forest]]
+
+        offsets = numpy.r_[0, numpy.cumsum(lengths)]
+        flat = numpy.empty(offsets[-1], dtype=numpy.int64)
+        current, pos, active = leaves.copy(), offsets[1:] - 1, numpy.arange(len(leaves))
+        while len(active) > 0:
+            flat[pos[active]] = current[active]
+            active = active[pos[active] > offsets[:-1][active]]
+            pos[active] -= 1
+            current[active] = self.parent[current[active]]
+        return flat, offsets
+
+class CH5EventDecoder(object):
+    """Decodes an object/event table into event tracks.
+
+       The rows of an event (same obj_id) are the tracking edges idx1 -> idx2
+       of the event in track order, a split shows up as an idx1 value that
+       occurs twice. The table is sorted by obj_id once and boundaries and
+       split points of all events are found with array operations.
+    """
+    def __init__(self, evtable):
+        obj_id = numpy.asarray(evtable['obj_id'])
+        order = numpy.argsort(obj_id, kind='mergesort')
+        self.idx1 = numpy.asarray(evtable['idx1'])[order]
+        self.idx2 = numpy.asarray(evtable['idx2'])[order]
+        self.event_ids, self.starts, self.lengths = numpy.unique(obj_id[order], return_index=True, return_counts=True)
+        n_events, n_rows = len(self.event_ids), len(self.idx1)
+
+        # group equal idx1 values within each event, in row order
+        seg = numpy.repeat(numpy.arange(n_events), self.lengths)
+        rows = numpy.arange(n_rows)
+        o = numpy.lexsort((rows, self.idx1, seg))
+        new_group = numpy.ones(n_rows, dtype=bool)
+        new_group[1:] = (seg[o][1:] != seg[o][:-1]) | (self.idx1[o][1:] != self.idx1[o][:-1])
+        g_start = numpy.flatnonzero(new_group)
+        g_count = numpy.diff(numpy.r_[g_start, n_rows])
+        g_seg = seg[o[g_start]]
+
+        # most common idx1 value per event, ties go to the first seen (collections.Counter)
+        go = numpy.lexsort((o[g_start], -g_count, g_seg))
+        best = go[numpy.r_[True, g_seg[go][1:] != g_seg[go][:-1]]] if n_events > 0 else go
+        self.occurrence = g_count[best]
+        self.first = o[g_start[best]] - self.starts
+        self.second = o[numpy.minimum(g_start[best] + 1, n_rows - 1)] - self.starts
+
+        # first idx1 value that repeats an earlier one, with its first and last occurrence
+        group_of = numpy.empty(n_rows, dtype=numpy.int64)
+        group_of[o] = numpy.cumsum(new_group) - 1
+        repeats = o[~new_group]
+        self.repeat = self.lengths.copy()
+        numpy.minimum.at(self.repeat, seg[repeats], repeats - self.starts[seg[repeats]])
+        has_repeat = self.repeat < self.lengths
+        rep_group = group_of[self.starts[has_repeat] + self.repeat[has_repeat]]
+        self.repeat_first = numpy.zeros(n_events, dtype=numpy.int64)
+        self.repeat_last = numpy.zeros(n_events, dtype=numpy.int64)
+        self.repeat_first[has_repeat] = o[g_start[rep_group]] - self.starts[has_repeat]
+        self.repeat_last[has_repeat] = o[g_start[rep_group] + g_count[rep_group] - 1] - self.starts[has_repeat]
+
+    def _select(self, event_ids):
+        if event_ids is None:
+            return numpy.arange(len(self.event_ids))
+        event_ids = numpy.asarray(event_ids)
+        sel = numpy.minimum(numpy.searchsorted(self.event_ids, event_ids), max(len(self.event_ids) - 1, 0))
+        if len(event_ids) > 0 and (len(self.event_ids) == 0 or numpy.any(self.event_ids[sel] != event_ids)):
+            raise KeyError('Error: cellh5 - event ids not found in event table')
+        return sel
+
+    def tracks(self, event_ids=None):
+        """Tracks of the events in event_ids (all by default, in this order).
+           Returns (event_ids, branch, flat, offsets) with one row per branch,
+           the second branch (branch == 1) exists for split events only. The
+           track of row k is flat[offsets[k]:offsets[k + 1]]."""
+        sel = self._select(event_ids)
+        occurrence = self.occurrence[sel]
+        if numpy.any(occurrence > 2):
+            raise RuntimeError(("Split events with more than 2 childs are "
+                                "not suppored. How did it get there anyway?"))
+        split = occurrence == 2
+        starts, lengths = self.starts[sel], self.lengths[sel]
+        first, second = self.first[sel], self.second[sel]
+
+        ev = numpy.repeat(numpy.arange(len(sel)), 1 + split)
+        branch = numpy.zeros(len(ev), dtype=numpy.int64)
+        branch[1:][ev[1:] == ev[:-1]] = 1
+
+        # every branch is a range of idx1 followed by a range of idx2
+        n1 = numpy.where(split, second, lengths)[ev]
+        s2 = n1 - 1
+        n2 = numpy.ones(len(ev), dtype=numpy.int64)
+        b = branch == 1
+        n1[b] = first[ev[b]] + 1
+        s2[b] = second[ev[b]]
+        n2[b] = lengths[ev[b]] - second[ev[b]]
+
+        offsets = numpy.r_[0, numpy.cumsum(n1 + n2)]
+        flat = numpy.empty(offsets[-1], dtype=numpy.result_type(self.idx1, self.idx2))
+        flat[ragged_arange(offsets[:-1], n1)] = self.idx1[ragged_arange(starts[ev], n1)]
+        flat[ragged_arange(offsets[:-1] + n1, n2)] = self.idx2[ragged_arange(starts[ev] + s2, n2)]
+        return self.event_ids[sel][ev], branch, flat, offsets
+
+    def items(self, output_second_branch=False):
+        """Event items as returned by CH5Position.get_event_items"""
+        events = []
+        if len(self.event_ids) == 0:
+            return events
+        row_of = dict((e, k) for k, e in enumerate(self.event_ids))
+        for event_id in range(self.event_ids.max() + 1):
+            if event_id not in row_of:
+                events.append((event_id, []))
+                continue
+            k = row_of[event_id]
+            idx1 = self.idx1[self.starts[k]:self.starts[k] + self.lengths[k]]
+            event_list = list(idx1[:self.repeat[k]])
+            if output_second_branch and self.repeat[k] < self.lengths[k]:
+                event_list2 = list(idx1[:self.repeat_first[k]]) + list(idx1[self.repeat_last[k]:])
+                events.append((event_id, event_list, event_list2))
+            else:
+                events.append((event_id, event_list))
+        return events
 
 class CH5Position(object):
     """Main class for interacting with CH5 objects"""
@@ -332,6 +1328,7 @@ class CH5Position(object):
         self.coord = CH5PositionCoordinate(plate, well, pos)
         self.grp_pos_path = grp_pos
         self.definitions = parent
+        self._published_tables = None
 
     @property
     def filename(self):
@@ -339,38 +1336,105 @@ class CH5Position(object):
         save in linked file or not.
         """
         path = self.coord.get_path()
-        return self.definitions[path].file.filename
+        return self.get_file_handle()[path].file.filename
+
+    def get_file_handle(self):
+        """File handle the position group is read from"""
+        return self.definitions.get_position_file_handle(self.well, self.pos)
 
     def __getitem__(self, key):
         path = "%s/%s" % (self.grp_pos_path, key)
-        return self.definitions.get_file_handle()[path]
+        return self.get_file_handle()[path]
 
     def get_group(self, sub_group=None):
         if sub_group is None:
-            return self.definitions.get_file_handle()[self.grp_pos_path]
+            return self.get_file_handle()[self.grp_pos_path]
         else:
-            return self.definitions.get_file_handle()[self.grp_pos_path + "/" + sub_group]
+            return self.get_file_handle()[self.grp_pos_path + "/" + sub_group]
 
 
     def channel_color_by_region(self, region):
         """Return the the channel information."""
 
-        path = '/definition/image/region'
-        rdef = self.definitions.get_file_handle()[path].value
+        return self.definitions.get_definitions().channel_color(region)
+
+    def refresh(self):
+        """Read what a streaming writer (see CH5FileWriter.start_swmr) has
+           published since the last call, without reopening the file. Only the
+           rows of the new frames are read, afterwards the table accessors
+           return the published rows. Returns the time indices of the new frames"""
+        if CH5Const.PUBLISHED not in self.get_group():
+            return numpy.zeros((0,), dtype=numpy.int64)
+        swmr = self.get_file_handle().swmr_mode
+        log = self[CH5Const.PUBLISHED]
+        if swmr:
+            log.refresh()
+        if self._published_tables is None:
+            self._published_tables = CH5PublishedTables(p.decode() for p in log.attrs['tables'])
+            for path in self._published_tables.paths:
+                self._published_tables.append(path, self[path][0:0])
+        tables = self._published_tables
+
+        log_rows = log[tables.n_log_rows:]
+        if len(log_rows) == 0:
+            return numpy.zeros((0,), dtype=numpy.int64)
+        counts = log_rows[-1, 1:]
+        for path, start, stop in zip(tables.paths, tables.counts, counts):
+            if stop > start:
+                dset = self[path]
+                if swmr:
+                    dset.refresh()
+                tables.append(path, dset[start:stop])
+        if swmr and CH5Const.IMAGE in self.get_group():
+            for dset in self[CH5Const.IMAGE].values():
+                dset.refresh()
+
+        CH5_CACHE.invalidate(self)
+        return tables.add_log_rows(log_rows)
+
+    def iter_frames(self, poll_interval=1.0, timeout=None):
+        """Time indices of the frames published by a streaming writer, waiting
+           for new ones until the writer is closed or nothing is published for
+           timeout seconds"""
+        last = time.time()
+        while True:
+            frames = self.refresh()
+            for t in frames:
+                yield int(t)
+            if self._published_tables is None or self._published_tables.closed:
+                return
+            if len(frames) > 0:
+                last = time.time()
+            elif timeout is not None and time.time() - last > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
 
-        i = rdef['channel_idx'][rdef['region_name'] == 'region___%s' % region][0]
-        path = '/definition/image/channel'
-        return self.definitions.get_file_handle()[path]['color'][i]
+    def _get_published(self, path):
+        """Published rows of a table, None if the position is not streamed"""
+        if self._published_tables is not None and path in self._published_tables:
+            return self._published_tables.get(path)
+        return None
 
     def get_tracking(self):
-        return self['object']['tracking'].value
-
-    def _get_tracking_lookup(self, tracking_table, obj_idx='obj_idx1', ):
-        dset_tracking_idx1 = tracking_table[obj_idx]
-        tracking_lookup_idx1 = collections.defaultdict()
-        for i, o in enumerate(dset_tracking_idx1):
-            tracking_lookup_idx1.setdefault(o, []).append(i)
-        return tracking_lookup_idx1
+        published = self._get_published('object/tracking')
+        if published is not None:
+            return published
+        return self['object']['tracking'][()]
+
+    def get_tracking_graph(self):
+        """Tracking graph of this position (CH5TrackingGraph), taken from the
+           sidecar store of the file if there is one"""
+        store = getattr(self.definitions, 'sidecar', None)
+        key = 'tracking_graph/%s/%s' % (self.well, self.pos)
+        if store is not None:
+            arrays = store.load(key)
+            if arrays is not None:
+                return CH5TrackingGraph.from_arrays(arrays)
+        graph = CH5TrackingGraph.from_tracking(self.get_tracking())
+        if store is not None:
+            store.save(key, graph.to_arrays())
+        return graph
 
     def get_class_prediction(self, object_='primary__primary', label_type=''):
         path = 'feature/%s/object_classification/prediction' % object_
@@ -379,27 +1443,18 @@ class CH5Position(object):
     def get_prediction_probabilities(self, indices=None,
                                      object_="primary__primary"):
         path = 'feature/%s/object_classification/probability' % object_
+        published = self._get_published(path)
+        if published is not None:
+            return published if indices is None else published[indices]
 
         if indices is None:
-            return self[path].value
+            return self[path][()]
         else:
             # read probs only once per cell, reading from share is too slow
-            ishape = indices.shape
-            indices = indices.flatten()
-            indices2 = numpy.unique(indices)
-            _, nclasses = self[path].shape
-            probs = numpy.empty((indices.size, nclasses))
-
-            for i, j in enumerate(indices2):
-                k = numpy.where(indices == j)[0]
-                probs[k, :] = self[path][j, :]
-
-            return probs.reshape(ishape + (nclasses,))
+            return read_coalesced(self[path], indices)
 
     def has_classification(self, object_):
-        fh = self.definitions.get_file_handle()
-        path = 'definition/feature/%s/object_classification' % object_
-        return path in fh
+        return self.definitions.has_classification(object_)
 
     def get_crack_contour(self, index, object_='primary__primary',
                           bb_corrected=True, size=None):
@@ -407,14 +1462,16 @@ class CH5Position(object):
             size = GALLERY_SIZE
         index = to_index_array(index)
         crack_list = []
-        for ind in index:
-            crack_str = self['feature'][object_]['crack_contour'][ind]
+        crack_strs = read_coalesced(self['feature'][object_]['crack_contour'], index)
+        if bb_corrected:
+            centers = self.get_center(index, object_)
+        for k, crack_str in enumerate(crack_strs):
             crack = numpy.asarray(zlib.decompress(
-                             base64.b64decode(crack_str)).split(','),
+                             base64.b64decode(crack_str)).split(b','),
                              dtype=numpy.float32).reshape(-1, 2)
 
             if bb_corrected:
-                bb = self['feature'][object_]['center'][ind]
+                bb = centers[k]
                 crack[:, 0] -= bb['x'] - size / 2
                 crack[:, 1] -= bb['y'] - size / 2
                 crack = crack.clip(0, size-1)
@@ -424,23 +1481,73 @@ class CH5Position(object):
         return crack_list
 
     def has_object_entries(self, object_='primary__primary'):
-        return len(self['object'][object_]) > 0
+        return self.get_object_count(object_) > 0
 
     def get_object_count(self, object_='primary__primary'):
+        index = self.definitions.index
+        if index is not None:
+            count = index.get_object_count(self.well, self.pos, object_)
+            if count is not None:
+                return count
+        published = self._get_published('object/%s' % object_)
+        if published is not None:
+            return len(published)
         return len(self['object'][object_])
 
     def get_object_features(self, object_='primary__primary', index=None):
         if index is not None and len(index) == 0:
             return []
+        published = self._get_published('feature/%s/object_features' % object_)
+        if published is not None:
+            return published if index is None else published[index]
         if len(self['feature'][object_]['object_features']) > 0:
             if index is None:
-                return self['feature'][object_]['object_features'].value
+                return self['feature'][object_]['object_features'][()]
             else:
-                return self['feature'][object_]['object_features'][index, :]
+                return read_coalesced(self['feature'][object_]['object_features'], index)
 
         else:
             return []
 
+    def get_track_features(self, tracks, features=None, object_='primary__primary',
+                           align=None, window=None, ragged=False, fill=numpy.nan):
+        """Object features of many tracks, read in one coalesced pass.
+
+           tracks: list of object index arrays or ragged (flat, offsets) tuple
+           features: feature names or columns, None for all features
+
+           Returns the ragged (values, offsets) form if ragged is True, else the
+           padded (n_tracks, length, n_features) array and the onset column (see
+           pad_tracks for align and window).
+        """
+        if isinstance(tracks, tuple):
+            flat, offsets = tracks
+        else:
+            offsets = numpy.r_[0, numpy.cumsum([len(t) for t in tracks])].astype(numpy.int64)
+            flat = numpy.concatenate(tracks) if len(tracks) > 0 else numpy.zeros((0,), dtype=numpy.int64)
+        flat = numpy.asarray(flat, dtype=numpy.int64)
+
+        dset = self['feature'][object_]['object_features']
+        columns = self._get_feature_columns(features, object_)
+        if len(flat) > 0:
+            values = read_coalesced(dset, flat)
+        else:
+            values = numpy.zeros((0,) + dset.shape[1:], dtype=dset.dtype)
+        if columns is not None:
+            values = values[:, columns]
+
+        if ragged:
+            return values, offsets
+        return pad_tracks(values, offsets, align, window, fill)
+
+    def _get_feature_columns(self, features, object_):
+        if features is None:
+            return None
+        if isinstance(features, (str, int, numpy.integer)):
+            features = [features]
+        return numpy.array([self.definitions.get_object_feature_idx_by_name(object_, f)
+                            if isinstance(f, str) else f for f in features], dtype=numpy.int64)
+
     def get_object_feature_by_name(self, name, object_='primary__primary'):
         if len(self['feature'][object_][name]) > 0:
             return self['feature'] \
@@ -449,12 +1556,22 @@ class CH5Position(object):
         else:
             return []
 
+    def get_time_stamps(self):
+        """Relative time stamps of all frames or None if the position has
+        no time lapse information."""
+        index = self.definitions.index
+        if index is not None:
+            return index.get_time_stamps(self.well, self.pos)
+        if 'time_lapse' in self['image']:
+            return self['image/time_lapse']['timestamp_rel']
+        return None
+
     def get_time_of_frame(self, frame):
-        return self['image/time_lapse']['timestamp_rel'][frame]
+        return self.get_time_stamps()[frame]
 
     def get_time_lapse(self):
-        if 'time_lapse' in self['image']:
-            time_stamps = self['image/time_lapse']['timestamp_rel']
+        time_stamps = self.get_time_stamps()
+        if time_stamps is not None:
             time_lapses = numpy.diff(time_stamps)
             time_lapse = time_lapses.mean()
         else:
@@ -462,53 +1579,99 @@ class CH5Position(object):
         return time_lapse
 
     def get_time_lapse_per_frame(self):
-        if 'time_lapse' in self['image']:
-            time_stamps = self['image/time_lapse']['timestamp_rel']
+        time_stamps = self.get_time_stamps()
+        if time_stamps is not None:
             time_lapse = list(numpy.diff(time_stamps))
         else:
             time_lapse = None
         return time_lapse
 
     def get_object_idx(self, object_='primary__primary', frame=None):
-        ot = self.get_object_table(object_)
         if frame is None:
-            return ot
+            return self.get_object_table(object_)
         else:
-            return numpy.nonzero(ot['time_idx'] == frame)[0]
+            return self.get_frame_index(object_).objects_in_frame(frame)
+
+    def get_frame_index(self, object_='primary__primary'):
+        """Objects of this position grouped by time frame (CH5FrameIndex),
+           taken from the sidecar store of the file if there is one"""
+        store = getattr(self.definitions, 'sidecar', None)
+        key = 'frame_index/%s/%s/%s' % (self.well, self.pos, object_)
+        if store is not None:
+            arrays = store.load(key)
+            if arrays is not None:
+                return CH5FrameIndex.from_arrays(arrays)
+        frame_index = CH5FrameIndex.from_time_idx(self.get_all_time_idx(object_))
+        if store is not None:
+            store.save(key, frame_index.to_arrays())
+        return frame_index
 
     def get_image(self, t, c, z=0):
         return self['image'] \
                     ['channel'] \
                     [c, t, z, :, :]
 
-    def get_gallery_image(self, index,
-                          object_='primary__primary', size=None):
-        if size is None:
-            size=GALLERY_SIZE
-        index = to_index_array(index)
-        images = list()
+    def _get_gallery_channel_idx(self, object_):
+        return self.definitions.get_definitions().region_channel_idx(object_)
 
-        channel_idx = self.definitions.image_definition['region'] \
-            ['channel_idx'][self.definitions.image_definition['region']['region_name'] == ('region___%s' % object_).encode()][0]
+    def get_gallery_images(self, index, object_='primary__primary', size=None):
+        """Return the gallery images of all objects in index as array of shape
+           (len(index), size, size) in the order of index.
 
-        image_width = self['image']['channel'].shape[3]
-        image_height = self['image']['channel'].shape[4]
-        centers = self['feature'][object_]['center'][index.tolist()]
+           Objects are grouped by time frame, for each frame the bounding box
+           of all its crops is read once and the crops are cut from it.
+           Crops at the image border are zero padded like in get_gallery_image.
+        """
+        if size is None:
+            size = GALLERY_SIZE
+        index = to_index_array(index).ravel()
+        image_dset = self['image']['channel']
+        images = numpy.zeros((len(index), size, size), dtype=image_dset.dtype)
+        if len(index) == 0:
+            return images
+
+        channel_idx = self._get_gallery_channel_idx(object_)
+        image_width = image_dset.shape[3]
+        image_height = image_dset.shape[4]
         size_2 = int(size / 2)
-        for i, cen in zip(index, centers):
-            time_idx = self['object'][object_][i]['time_idx']
-            tmp_img = self['image']['channel'][channel_idx, time_idx, 0,
-                                               max(0, cen[1] - size_2):min(image_width, cen[1] + size_2),
-                                               max(0, cen[0] - size_2):min(image_height, cen[0] + size_2)]
-
-            if tmp_img.shape != (size, size):
-                image = numpy.zeros((size, size), dtype=numpy.uint8)
-                image[(image.shape[0] - tmp_img.shape[0]):, :tmp_img.shape[1]] = tmp_img
-                images.append(image)
-            else:
-                images.append(tmp_img)
 
-        if len(index) > 1:
+        time_idx = self.get_time_indecies(index, object_)
+        centers = self.get_center(index, object_)
+        cx = centers['x'].astype(numpy.int64)
+        cy = centers['y'].astype(numpy.int64)
+
+        y0 = numpy.maximum(0, cy - size_2)
+        y1 = numpy.minimum(image_width, cy + size_2)
+        x0 = numpy.maximum(0, cx - size_2)
+        x1 = numpy.minimum(image_height, cx + size_2)
+        # crops are aligned to the lower left corner of the gallery image
+        row_offset = size - (y1 - y0)
+        rng = numpy.arange(size)
+
+        order = numpy.argsort(time_idx, kind='mergesort')
+        frames, starts = numpy.unique(time_idx[order], return_index=True)
+        for frame, sel in zip(frames, numpy.split(order, starts[1:])):
+            sy0, sy1 = y0[sel].min(), y1[sel].max()
+            sx0, sx1 = x0[sel].min(), x1[sel].max()
+            if sy1 <= sy0 or sx1 <= sx0:
+                continue
+            slab = image_dset[channel_idx, frame, 0, sy0:sy1, sx0:sx1]
+
+            rows = (y0[sel] - row_offset[sel] - sy0)[:, None] + rng[None, :]
+            cols = (x0[sel] - sx0)[:, None] + rng[None, :]
+            valid = ((rng[None, :] >= row_offset[sel][:, None])[:, :, None] &
+                     (rng[None, :] < (x1[sel] - x0[sel])[:, None])[:, None, :])
+            crops = slab[numpy.clip(rows, 0, sy1 - sy0 - 1)[:, :, None],
+                         numpy.clip(cols, 0, sx1 - sx0 - 1)[:, None, :]]
+            crops[~valid] = 0
+            images[sel] = crops
+
+        return images
+
+    def get_gallery_image(self, index,
+                          object_='primary__primary', size=None):
+        images = self.get_gallery_images(index, object_, size)
+        if len(images) > 1:
             return numpy.concatenate(images, axis=1)
         return images[0]
 
@@ -530,11 +1693,9 @@ class CH5Position(object):
                     img[:, :, c] = self.get_gallery_image(index, object_[c])
 
         if color is None:
-            class_color = self.get_class_color(index)
+            col_tmp = self.get_class_rgb(index).reshape(-1, 3)[0]
         else:
-            class_color = color
-
-        col_tmp = hex2rgb(class_color)
+            col_tmp = hex2rgb(color)
         for c in range(3):
             img[:10, :10, c] = col_tmp[c]
 
@@ -563,69 +1724,18 @@ class CH5Position(object):
         return img
 
     def get_gallery_image_list(self, index, object_='primary__primary', size=None):
-        image_list = []
-        channel_idx = self.definitions.image_definition['region']['channel_idx'][self.definitions.image_definition['region']['region_name'] == 'region___%s' % object_][0]
-        image_width = self['image']['channel'].shape[3]
-        image_height = self['image']['channel'].shape[4]
-
-        if size is None:
-            size=GALLERY_SIZE
-
-
-        time_idxs = [self['object'][object_][ind]['time_idx'] for ind in index]
-        center_idxs = [self['feature'][object_]['center'][ind] for ind in index]
-
-        for k in range(len(index)):
-            time_idx = time_idxs[k]
-            cen1 = center_idxs[k]
-            image = numpy.zeros((size, size), dtype=numpy.uint8)
-
-            tmp_img = self['image/channel'][channel_idx, time_idx, 0,
-                                 max(0, cen1[1] - size / 2):min(image_width, cen1[1] + size / 2),
-                                 max(0, cen1[0] - size / 2):min(image_height, cen1[0] + size / 2)]
-
-            image[(image.shape[0] - tmp_img.shape[0]):, :tmp_img.shape[1]] = tmp_img
-            image_list.append(image)
-
-        return image_list
-
-    def get_gallery_image_generator(self, index, object_='primary__primary', size=None):
-        channel_idx = self.definitions.image_definition['region']['channel_idx'][self.definitions.image_definition['region']['region_name'] == ('region___%s' % object_).encode()][0]
-        image_width = self['image']['channel'].shape[3]
-        image_height = self['image']['channel'].shape[4]
+        return list(self.get_gallery_images(index, object_, size))
 
-        if size is None:
-            size=GALLERY_SIZE
-
-        try:
-            test_iter = iter(index)
-        except TypeError as te:
-            index = [index]
-
-        for ind in index:
-            time_idx = self['object'][object_][ind]['time_idx']
-            cen1 = self['feature'][object_]['center'][ind]
-            image = numpy.zeros((size, size, 3), dtype=numpy.uint8)
-            size_2 = int(size / 2)
-            tmp_img = self['image/channel'][channel_idx, time_idx, 0,
-                                 max(0, cen1[1] - size_2):min(image_width, cen1[1] + size_2),
-                                 max(0, cen1[0] - size_2):min(image_height, cen1[0] + size_2)]
-
-            for c in range(3):
-                image[(image.shape[0] - tmp_img.shape[0]):, :tmp_img.shape[1], c] = tmp_img
+    def get_gallery_image_generator(self, index, object_='primary__primary', size=None, batch_size=256):
+        index = to_index_array(index).ravel()
 
-#             crack = self.get_crack_contour(ind, object_)
-#             class_color = ['#FFFF00'] * len(crack)
-#             for i, (cr, col) in enumerate(zip(crack, class_color)):
-#                 col_tmp = hex2rgb(col)
-#                 for x, y in cr:
-#                     for c in range(3):
-#                         y = min(y, GALLERY_SIZE-1)
-#                         x = min(x, GALLERY_SIZE-1)
-#                         image[y, x + i * GALLERY_SIZE, c] = col_tmp[c]
-
-
-            yield image
+        # images are extracted in batches, consumers often stop early
+        for b in range(0, len(index), batch_size):
+            images = self.get_gallery_images(index[b:b + batch_size], object_, size)
+            for img in images:
+                image = numpy.empty(img.shape + (3,), dtype=numpy.uint8)
+                image[...] = img[:, :, None]
+                yield image
 
     def get_gallery_image_matrix(self, index, shape, object_='primary__primary', size=None):
         if size is None:
@@ -659,13 +1769,13 @@ class CH5Position(object):
                              size * shape[1], 3), dtype=numpy.uint8)
         i, j = 0, 0
         img_gen = self.get_gallery_image_generator(index, object_)
-        class_colors = self.get_class_color(index)
+        class_rgb = self.get_class_rgb(index).reshape(-1, 3)
         cnt = 0
         for i in range(shape[0]):
             for j in range(shape[1]):
                 try:
                     img = next(img_gen)
-                    color = class_colors[cnt]
+                    col_rgb = class_rgb[cnt]
                     cnt += 1
                 except StopIteration:
                     break
@@ -676,10 +1786,8 @@ class CH5Position(object):
 
                 if (c, d) > image.shape:
                     break
-                for c in range(3): image[a:c, b:d, c] = img
-
-                col_rgb = hex2rgb(color)
-                for c in range(3): image[a:a + 10, b:b + 10, c] = col_rgb[c]
+                image[a:c, b:d, :] = img
+                image[a:a + 10, b:b + 10, :] = col_rgb
 
         return image
 
@@ -692,116 +1800,138 @@ class CH5Position(object):
         for obj_id in object_:
             crack = self.get_crack_contour(index, obj_id)
 
-            if color is None:
-                class_color = self.get_class_color(index, obj_id)
-                if class_color is None:
-                    class_color = ['#FFFFFF'] * len(crack)
-
-                if not isinstance(class_color, (list, tuple)):
-                    class_color = [class_color]
+            if color is None and self.has_classification(obj_id):
+                class_rgb = self.get_class_rgb(index, obj_id).reshape(-1, 3)
             else:
-                class_color = [color] * len(crack)
+                class_rgb = [hex2rgb(color or CH5Const.UNPREDICTED_COLOR)] * len(crack)
 
-            for i, (cr, col) in enumerate(zip(crack, class_color)):
-                col_tmp = hex2rgb(col)
-                for x, y in cr:
-                    for c in range(3):
-                        img[y, x + i * size, c] = col_tmp[c]
+            for i, (cr, col_tmp) in enumerate(zip(crack, class_rgb)):
+                cr = cr.astype(int)
+                img[cr[:, 1], cr[:, 0] + i * size, :] = col_tmp
         return img
 
-    def get_class_label(self, index, object_='primary__primary'):
-        """Map prediction indices according to the class definition and
-        return an array with the shape of index."""
+    def _get_class_lookup_rows(self, index, object_):
+        """Rows of the class lookup arrays (CH5Definitions.class_lookup) for
+           the objects in index, unpredicted objects map to the last row"""
         index = to_index_array(index)
+        n_classes = len(self.definitions.get_definitions().class_lut(object_)[0])
+        prediction = self.get_class_prediction(object_)
 
-        index2label = self.definitions.class_definition(object_)["label"]
-        predidx = self.get_class_prediction(object_)['label_idx']
-        labels = numpy.ones(index.size, dtype=int) * CH5Const.UNPREDICTED_LABEL
+        flat = index.ravel()
+        rows = numpy.full(flat.shape, n_classes, dtype=numpy.int64)
+        valid = (flat >= -len(prediction)) & (flat < len(prediction))
+        if valid.any():
+            label_idx = numpy.asarray(CH5Table(prediction)[flat[valid].astype(numpy.int64), 'label_idx'], dtype=numpy.int64)
+            rows[valid] = numpy.where((label_idx >= 0) & (label_idx < n_classes), label_idx, n_classes)
+        return rows.reshape(index.shape)
 
-        for i, j in enumerate(index.flatten()):
-            try:
-                labels[i] = index2label[predidx[j]]
-            except IndexError as e:
-                # unlabled objects
-                pass
+    def get_class_label(self, index, object_='primary__primary'):
+        """Map prediction indices according to the class definition and
+        return an array with the shape of index."""
+        labels = self.definitions.get_definitions().class_lookup(object_)[0]
+        return labels[self._get_class_lookup_rows(index, object_)]
 
-        return labels.reshape(index.shape)
+    def get_class_rgb(self, index, object_='primary__primary'):
+        """Class colors of the objects in index as uint8 RGB array of shape index.shape + (3,)"""
+        rgb = self.definitions.get_definitions().class_lookup(object_)[3]
+        return rgb[self._get_class_lookup_rows(index, object_)]
 
     def get_class_label_index(self, index, object_='primary__primary'):
         """return prediction indices """
         index = to_index_array(index)
-        predidx = self.get_class_prediction(object_)['label_idx'][index]
+        predidx = CH5Table(self.get_class_prediction(object_))[index, 'label_idx']
 
         return predidx
 
     def get_center(self, index, object_='primary__primary'):
         index = to_index_array(index)
-        center_list = self.get_feature_table(object_, 'center')[index]
+        center_list = self.get_table('%s/%s/center' % (CH5Const.FEATURE, object_))[index]
         return center_list
 
     def get_orientation(self, index, object_='primary__primary'):
         index = to_index_array(index)
-        angle_list = self.get_feature_table(object_, 'orientation')[index]['angle']
+        angle_list = self.get_table('%s/%s/orientation' % (CH5Const.FEATURE, object_))[index, 'angle']
         return angle_list
 
     def get_class_color(self, index, object_='primary__primary'):
         if not self.has_classification(object_):
             return
 
-        res = list(map(str, self.class_color_def(tuple(self.get_class_label(index, object_)), object_)))
+        colors = self.definitions.get_definitions().class_lookup(object_)[2]
+        res = list(map(str, colors[self._get_class_lookup_rows(index, object_)].ravel()))
         if len(res) == 1:
             return res[0]
         return res
 
+    def get_class_counts(self, object_='primary__primary', n_frames=None):
+        """Number of objects per time frame and class as array of shape
+           (n_frames, n_classes + 1), the last column counts unpredicted objects"""
+        n_classes = len(self.definitions.get_definitions().class_lut(object_)[0])
+        time_idx = numpy.asarray(self.get_all_time_idx(object_), dtype=numpy.int64)
+        if n_frames is None:
+            n_frames = int(time_idx.max()) + 1 if len(time_idx) > 0 else 0
+        rows = self._get_class_lookup_rows(numpy.arange(len(time_idx)), object_)
+
+        valid = time_idx < n_frames
+        counts = numpy.bincount(time_idx[valid] * (n_classes + 1) + rows[valid],
+                                minlength=n_frames * (n_classes + 1))
+        return counts.reshape(n_frames, n_classes + 1)
+
     def get_all_time_idx(self, object_='primary__primary'):
-        return self['object'][object_][:]['time_idx']
+        return self.get_table('%s/%s' % (CH5Const.OBJECT, object_))['time_idx']
+
+    def _read_object_field(self, index, field, object_):
+        return self.get_table('%s/%s' % (CH5Const.OBJECT, object_))[index, field]
 
     def get_time_idx(self, index, object_='primary__primary'):
-        return self['object'][object_][index]['time_idx']
+        return self._read_object_field(index, 'time_idx', object_)
 
     def get_time_idx2(self, index, object_='primary__primary'):
-        return self['object'][object_]['time_idx'][index]
+        return self._read_object_field(index, 'time_idx', object_)
 
     def get_obj_label_id(self, index, object_='primary__primary'):
-        return self['object'][object_][index]['obj_label_id']
+        return self._read_object_field(index, 'obj_label_id', object_)
 
     def get_time_indecies(self, index, object_='primary__primary'):
-        inv_sort = numpy.argsort(numpy.argsort(numpy.array(index)))
-        index.sort()
-        tmp = self['object'][object_][index]['time_idx']
-        return tmp[inv_sort]
+        return self._read_object_field(numpy.asarray(index), 'time_idx', object_)
 
     def get_class_name(self, index, object_='primary__primary'):
-        res = list(map(str, self.class_name_def(tuple(self.get_class_label(index)), object_)))
+        names = self.definitions.get_definitions().class_lookup(object_)[1]
+        res = list(map(str, names[self._get_class_lookup_rows(index, object_)].ravel()))
         if len(res) == 1:
             return res[0]
         return res
 
     def class_color_def(self, class_labels, object_='primary__primary'):
-        label2color = OrderedDict()
-        class_mapping = self.definitions.class_definition(object_)
-        for cm in range(len(class_mapping)):
-            label2color[class_mapping["label"][cm]] = class_mapping["color"][cm].decode()
-        return [label2color[cl] for cl in class_labels]
+        definitions = self.definitions.get_definitions()
+        colors, label2row = definitions.class_lookup(object_)[2], definitions.class_label_rows(object_)
+        return [colors[label2row[cl]] for cl in class_labels]
 
     def class_name_def(self, class_labels, object_):
-        label2name = OrderedDict()
-        class_mapping = self.definitions.class_definition(object_)
-        for cm in range(len(class_mapping)):
-            label2name[class_mapping["label"][cm]] = class_mapping["name"][cm].decode()
-        return [label2name[cl] for cl in class_labels]
+        definitions = self.definitions.get_definitions()
+        names, label2row = definitions.class_lookup(object_)[1], definitions.class_label_rows(object_)
+        return [names[label2row[cl]] for cl in class_labels]
 
     def object_feature_def(self, object_='primary__primary'):
-        return [x[0].decode() for x in self.definitions.feature_definition['%s/object_features' % object_].value]
+        return list(self.definitions.get_definitions().feature_names(object_))
+
+    def get_table(self, path):
+        """Lazy view (CH5Table) on a table of this position, e.g. 'object/tracking'"""
+        published = self._get_published(path)
+        if published is not None:
+            return CH5Table(published)
+        return CH5Table(self[path])
 
     def get_object_table(self, object_):
-        if len(self['object'][object_]) > 0:
-            return self['object'][object_].value
-        else:
-            return self['object'][object_]
+        """The table object/<object_> as numpy array, use get_table() for a
+           lazy view"""
+        return self.get_table('%s/%s' % (CH5Const.OBJECT, object_)).read()
 
     def get_feature_table(self, object_, feature):
-        return self['feature'][object_][feature].value
+        published = self._get_published('feature/%s/%s' % (object_, feature))
+        if published is not None:
+            return published
+        return self['feature'][object_][feature][()]
 
     def has_events(self):
         # either group is emtpy or key does not exist
@@ -814,7 +1944,7 @@ class CH5Position(object):
         assert isinstance(output_second_branch, bool)
         assert isinstance(random, (type(None), int))
 
-        evtable = self.get_object_table('event')
+        evtable = self.get_table('object/event')
         if len(evtable) == 0:
             return numpy.array([])
         event_ids = numpy.unique(evtable['obj_id'])
@@ -823,133 +1953,69 @@ class CH5Position(object):
             numpy.random.shuffle(event_ids)
             event_ids = event_ids[:random]
 
-        tracks = list()
-        for event_id in event_ids:
-            i = numpy.where(evtable['obj_id'] == event_id)[0]
-            idx1 = evtable['idx1'][i]
-            idx2 = evtable['idx2'][i]
-
-            # find the index of the common elements in the array
-            mc, occurence = collections.Counter(idx1).most_common(1)[0]
-
-            if occurence == 1:
-                track = numpy.hstack((idx1, idx2[-1]))
-                tracks.append(track)
-            elif occurence == 2:
-                i1, i2 = numpy.where(idx1 == mc)[0]
-                track = numpy.hstack((idx1[:i2], idx2[i2 - 1]))
-                tracks.append(track)
-                if output_second_branch:
-                    track = numpy.hstack((idx1[:(i1 + 1)], idx2[i2:]))
-                    tracks.append(track)
-            else:
-                raise RuntimeError(("Split events with more than 2 childs are "
-                                    "not suppored. How did it get there anyway?"))
+        _, branch, flat, offsets = CH5EventDecoder(evtable).tracks(event_ids)
+        rows = numpy.arange(len(branch)) if output_second_branch else numpy.flatnonzero(branch == 0)
+        tracks = [flat[offsets[k]:offsets[k + 1]] for k in rows]
 
+        if len(set(map(len, tracks))) > 1:
+            ragged = numpy.empty(len(tracks), dtype=object)
+            for k, track in enumerate(tracks):
+                ragged[k] = track
+            return ragged
         return numpy.array(tracks)
 
-
     def get_event_items(self, output_second_branch=False):
-        events = []
-        dset_event = self.get_object_table('event')
-        if len(dset_event)==0:
-            return events
-        for event_id in range(dset_event['obj_id'].max()+1):
-            idx = numpy.where(dset_event['obj_id'] == event_id)
-            idx1 = dset_event[idx]['idx1']
-            idx2 = dset_event[idx]['idx2']
-            second_branch_found = False
-            event_list = []
-            for p1, _ in zip(idx1, idx2):
-                if p1 in event_list:
-                    # branch ends
-                    second_branch_found = True
-                    break
-                else:
-                    event_list.append(p1)
-            if second_branch_found and output_second_branch:
-                a = list(idx1).index(p1)
-                b = len(idx1) - list(idx1)[-1:0:-1].index(p1) - 1
-                event_list2 = list(idx1[0:a]) + list(idx1[b:])
-                events.append((event_id, event_list, event_list2))
-            else:
-                events.append((event_id, event_list))
-        return events
-
+        dset_event = self.get_table('object/event')
+        if len(dset_event) == 0:
+            return []
+        return CH5EventDecoder(dset_event).items(output_second_branch)
 
-    def _track_single(self, start_idx, type_, max_length=None, object_="primary__primary"):
-        track_on_feature = False
-        if type_ == 'first':
-            sel = 0
-        elif type_ == 'last':
-            sel = -1
+    def _get_track_selector(self, type_, object_):
+        if type_ in ('first', 'last'):
+            return type_
         elif type_ == 'biggest':
-            track_on_feature = True
-            roisize_ind = [str(feature_name[0]) for feature_name in self.definitions.feature_definition[object_]['object_features']].index('roisize')
-            track_feature = self.get_feature_table(object_, 'object_features')[:, roisize_ind]
-
+            roisize_ind = self.definitions.get_definitions().feature_index(object_)['roisize']
+            path = '%s/%s/object_features' % (CH5Const.FEATURE, object_)
+            published = self._get_published(path)
+            if published is not None:
+                return published[:, roisize_ind]
+            # the roisize column only
+            return self[path][:, roisize_ind]
         else:
             raise NotImplementedError('type not supported')
 
-        dset_tracking = self.get_tracking()
-        dset_tracking_idx2 = dset_tracking['obj_idx2']
-        tracking_lookup_idx1 = self._get_tracking_lookup(dset_tracking)
-
+    @staticmethod
+    def _walk(neighbors, select, idx, max_length):
         idx_list = []
-        idx = start_idx
         while True:
-            if idx in tracking_lookup_idx1:
-                next_p_idx = tracking_lookup_idx1[idx]
-            else:
+            next_idx = neighbors(idx)
+            if len(next_idx) == 0:
                 break
-            if track_on_feature:
-                sel = numpy.argmax(track_feature[next_p_idx])
-            idx = dset_tracking_idx2[next_p_idx[sel]]
+            if isinstance(select, str):
+                idx = next_idx[0] if select == 'first' else next_idx[-1]
+            else:
+                idx = next_idx[numpy.argmax(select[next_idx])]
             idx_list.append(idx)
             if max_length is not None and len(idx_list) > max_length - 1:
                 break
-
         return idx_list
 
-    def _track_backwards_single(self, end_idx, type_, max_length=None, object_="primary__primary"):
-        track_on_feature = False
-        if type_ == 'first':
-            sel = 0
-        elif type_ == 'last':
-            sel = -1
-        elif type_ == 'biggest':
-            track_on_feature = True
-            roisize_ind = [str(feature_name[0]) for feature_name in self.definitions.feature_definition[object_]['object_features']].index('roisize')
-            track_feature = self.get_feature_table(object_, 'object_features')[:, roisize_ind]
-
-        else:
-            raise NotImplementedError('type not supported')
-
-        dset_tracking = self.get_tracking()
-        dset_tracking_idx2 = dset_tracking['obj_idx1']
-        tracking_lookup_idx1 = self._get_tracking_lookup(dset_tracking, 'obj_idx2')
-
-        idx_list = []
-        idx = end_idx
-        while True:
-            if idx in tracking_lookup_idx1:
-                next_p_idx = tracking_lookup_idx1[idx]
-            else:
-                break
-            if track_on_feature:
-                sel = numpy.argmax(track_feature[next_p_idx])
-            idx = dset_tracking_idx2[next_p_idx[sel]]
-            idx_list.append(idx)
-            if max_length is not None and len(idx_list) > max_length - 1:
-                break
+    def _track_single(self, start_idx, type_, max_length=None, object_="primary__primary"):
+        select = self._get_track_selector(type_, object_)
+        graph = self.get_tracking_graph()
+        return self._walk(graph.get_successors, select, start_idx, max_length)
 
+    def _track_backwards_single(self, end_idx, type_, max_length=None, object_="primary__primary"):
+        select = self._get_track_selector(type_, object_)
+        graph = self.get_tracking_graph()
+        idx_list = self._walk(graph.get_predecessors, select, end_idx, max_length)
         idx_list.reverse()
 
         return idx_list
 
     def del_object_feature_data(self, feature_name, object_='primary__primary'):
         # Check file mode
-        if self.definitions._file_handle.mode not in ('w', 'a', 'r+'):
+        if self.get_file_handle().mode not in ('w', 'a', 'r+'):
             raise IOError('Error: Cannot write to CellH5 file, since it is opened read-only')
         path = 'feature/%s/' % object_
         feature_grp = self[path]
@@ -959,7 +2025,7 @@ class CH5Position(object):
 
     def set_object_feature_data(self, feature_name, data, object_='primary__primary', overwrite=True):
         # Check file mode
-        if self.definitions._file_handle.mode not in ('w', 'a', 'r+'):
+        if self.get_file_handle().mode not in ('w', 'a', 'r+'):
             raise IOError('Error: Cannot write to CellH5 file, since it is opened read-only')
 
         path = 'feature/%s/' % object_
@@ -994,30 +2060,80 @@ class CH5Position(object):
     def track_backwards(self, end_idx, max_length=None):
         return self._track_backwards_single(end_idx, 'first', max_length=max_length)
 
-    def track_all(self, start_idx):
-        dset_tracking = self.get_tracking()
-        next_p_idx = (dset_tracking['obj_idx1'] == start_idx).nonzero()[0]
-        if len(next_p_idx) == 0:
-            return [None]
-        else:
-            def all_paths_of_tree(id_):
-                found_ids = dset_tracking['obj_idx2'][(dset_tracking['obj_idx1'] == id_).nonzero()[0]]
+    def _track_many(self, start_idx, type_, max_length=None, object_="primary__primary", backwards=False):
+        select = self._get_track_selector(type_, object_)
+        graph = self.get_tracking_graph()
+        step = graph.previous_objects if backwards else graph.next_objects
+        if max_length is not None:
+            max_length = max(max_length, 1)
+
+        frontier = to_index_array(start_idx).ravel().copy()
+        active = numpy.arange(len(frontier))
+        rows, values = [], []
+        while len(active) > 0 and (max_length is None or len(rows) < max_length):
+            next_idx = step(frontier[active], select)
+            found = next_idx >= 0
+            active = active[found]
+            frontier[active] = next_idx[found]
+            rows.append(active)
+            values.append(next_idx[found])
+
+        lengths = numpy.zeros(len(frontier), dtype=numpy.int64)
+        for active in rows:
+            lengths[active] += 1
+        offsets = numpy.r_[0, numpy.cumsum(lengths)]
+        flat = numpy.empty(offsets[-1], dtype=numpy.int64)
+        for k, (active, next_idx) in enumerate(zip(rows, values)):
+            if backwards:
+                flat[offsets[active + 1] - 1 - k] = next_idx
+            else:
+                flat[offsets[active] + k] = next_idx
+        return flat, offsets
 
-                if len(found_ids) == 0:
-                    return [[id_]]
-                else:
-                    all_paths_ = []
-                    for out_id in found_ids:
-                        for path_ in all_paths_of_tree(out_id):
-                            all_paths_.append([id_] + path_)
+    def track_first_many(self, start_idx, max_length=None, object_='primary__primary'):
+        """track_first for all objects in start_idx at once. Returns the tracks
+           as ragged array (flat, offsets), track k is flat[offsets[k]:offsets[k + 1]]"""
+        return self._track_many(start_idx, 'first', max_length=max_length, object_=object_)
+
+    def track_last_many(self, start_idx, max_length=None, object_='primary__primary'):
+        return self._track_many(start_idx, 'last', max_length=max_length, object_=object_)
+
+    def track_biggest_many(self, start_idx, max_length=None, object_='primary__primary'):
+        return self._track_many(start_idx, 'biggest', max_length=max_length, object_=object_)
+
+    def track_backwards_many(self, end_idx, max_length=None, object_='primary__primary'):
+        """track_backwards for all objects in end_idx at once, see track_first_many"""
+        return self._track_many(end_idx, 'first', max_length=max_length, object_=object_, backwards=True)
 
-                    return all_paths_
+    def get_lineage_forest(self):
+        """Lineage forest of this position (CH5LineageForest)"""
+        return CH5LineageForest.from_graph(self.get_tracking_graph())
 
-            head_ids = dset_tracking['obj_idx2'][(dset_tracking['obj_idx1'] == start_idx).nonzero()[0]]
-            res = []
-            for head_id in head_ids:
-                res.extend(all_paths_of_tree(head_id))
-            return res
+    def track_all(self, start_idx):
+        """All paths from the successors of start_idx to the ends of their
+           tracks, following every successor (splits and merges), depth first"""
+        graph = self.get_tracking_graph()
+        head_ids = graph.get_successors(start_idx)
+        if len(head_ids) == 0:
+            return [None]
+
+        # one row per path, extended by one object per step; a path is
+        # replaced in place by one copy per successor of its last object
+        paths = head_ids.reshape(-1, 1)
+        while True:
+            ends = paths[:, -1]
+            successors, offsets = graph.get_successors_many(ends[ends >= 0])
+            if len(successors) == 0:
+                break
+            counts = numpy.ones(len(paths), dtype=numpy.int64)
+            counts[ends >= 0] = numpy.maximum(numpy.diff(offsets), 1)
+            step = -numpy.ones(counts.sum(), dtype=numpy.int64)
+            has_next = numpy.zeros(len(paths), dtype=bool)
+            has_next[ends >= 0] = numpy.diff(offsets) > 0
+            starts = numpy.cumsum(counts) - counts
+            step[ragged_arange(starts[has_next], counts[has_next])] = successors
+            paths = numpy.c_[numpy.repeat(paths, counts, axis=0), step]
+        return [list(path[path >= 0]) for path in paths]
 
 class CH5CachedPosition(CH5Position):
     """Same as CH5Position using a cache for all inhereted methods"""
@@ -1040,6 +2156,14 @@ class CH5CachedPosition(CH5Position):
     def get_object_idx(self, *args, **kwargs):
         return super(CH5CachedPosition, self).get_object_idx(*args, **kwargs)
 
+    @memoize
+    def get_all_time_idx(self, *args, **kwargs):
+        return super(CH5CachedPosition, self).get_all_time_idx(*args, **kwargs)
+
+    @memoize
+    def get_frame_index(self, *args, **kwargs):
+        return super(CH5CachedPosition, self).get_frame_index(*args, **kwargs)
+
     @memoize
     def get_feature_table(self, *args, **kwargs):
         return super(CH5CachedPosition, self).get_feature_table(*args, **kwargs)
@@ -1049,8 +2173,12 @@ class CH5CachedPosition(CH5Position):
         return super(CH5CachedPosition, self).get_tracking(*args, **kwargs)
 
     @memoize
-    def _get_tracking_lookup(self, *args, **kwargs):
-        return super(CH5CachedPosition, self)._get_tracking_lookup(*args, **kwargs)
+    def get_tracking_graph(self, *args, **kwargs):
+        return super(CH5CachedPosition, self).get_tracking_graph(*args, **kwargs)
+
+    @memoize
+    def get_lineage_forest(self, *args, **kwargs):
+        return super(CH5CachedPosition, self).get_lineage_forest(*args, **kwargs)
 
     @memoize
     def get_class_prediction(self, object_='primary__primary'):
@@ -1088,39 +2216,660 @@ class CH5CachedPosition(CH5Position):
         return super(CH5CachedPosition, self).get_time_lapse_per_frame(*args, **kwargs)
 
     def clear_cache(self):
-        if hasattr(self, '_memoize__cache'):
-            self._memoize__cache = {}
+        CH5_CACHE.invalidate(self)
+
+class CH5Definitions(object):
+    """Snapshot of the /definition tables of a CellH5 file. It is read once
+       per CH5File (see CH5File.get_definitions), shared by all positions of
+       the file and dropped when definitions are written. Channel, region,
+       class and feature lookups derived from the tables are built on first
+       use and kept with the snapshot."""
+    REGION_PREFIX = 'region___'
+
+    def __init__(self, tables):
+        self.tables = tables
+        self._luts = {}
+
+        self.channels = self.tables.get('%s/channel' % CH5Const.IMAGE)
+        self.region_channel = OrderedDict()
+        regions = self.tables.get('%s/region' % CH5Const.IMAGE)
+        if regions is not None:
+            for name, channel_idx in zip(regions['region_name'], regions['channel_idx']):
+                name = name.decode() if isinstance(name, bytes) else str(name)
+                if name.startswith(self.REGION_PREFIX):
+                    name = name[len(self.REGION_PREFIX):]
+                self.region_channel[name] = int(channel_idx)
+
+    @staticmethod
+    def read_tables(file_handle):
+        """All tables below /definition of an opened h5py file, keyed by
+           their path relative to /definition (groups map to None)"""
+        tables = {}
+        if CH5Const.DEFINITION in file_handle:
+            def _collect_(name, obj):
+                if isinstance(obj, h5py.Dataset):
+                    tables[name] = obj[()]
+                else:
+                    tables[name] = None
+            file_handle[CH5Const.DEFINITION].visititems(_collect_)
+        return tables
+
+    def has_table(self, path):
+        return path.strip('/') in self.tables
+
+    def get_table(self, path):
+        table = self.tables[path.strip('/')]
+        if table is None:
+            raise KeyError("'%s' is not a table" % path)
+        return table
+
+    def _lut(self, key, builder):
+        if key not in self._luts:
+            self._luts[key] = builder()
+        return self._luts[key]
+
+    def region_channel_idx(self, region):
+        return self.region_channel[region]
+
+    def channel_color(self, region):
+        return self.channels['color'][self.region_channel_idx(region)]
+
+    def class_definition(self, object_='primary__primary'):
+        return self.get_table('%s/%s/object_classification/class_labels' % (CH5Const.FEATURE, object_))
+
+    def class_lut(self, object_='primary__primary'):
+        """Class labels, names and colors of an object as arrays, in the order
+           of the class definition (i.e. indexed by prediction label_idx)"""
+        def _build_():
+            class_def = self.class_definition(object_)
+            return (numpy.asarray(class_def['label']),
+                    numpy.array([n.decode() for n in class_def['name']], dtype=str),
+                    numpy.array([c.decode() for c in class_def['color']], dtype=str))
+        return self._lut(('class', object_), _build_)
+
+    def class_lookup(self, object_='primary__primary'):
+        """Class label, name, color and RGB arrays of an object with one row
+           per class (indexed by prediction label_idx) and a last row for
+           unpredicted objects"""
+        def _build_():
+            labels, names, colors = self.class_lut(object_)
+            colors = numpy.r_[colors, [CH5Const.UNPREDICTED_COLOR]]
+            rgb = numpy.array([hex2rgb(c) for c in colors], dtype=numpy.uint8)
+            return (numpy.r_[labels.astype(int), CH5Const.UNPREDICTED_LABEL],
+                    numpy.r_[names, [CH5Const.UNPREDICTED_NAME]], colors, rgb)
+        return self._lut(('class_lookup', object_), _build_)
+
+    def class_label_rows(self, object_='primary__primary'):
+        """Mapping class label -> row of the class_lookup arrays"""
+        return self._lut(('class_label_rows', object_),
+                         lambda: dict((label, i) for i, label in enumerate(self.class_lookup(object_)[0])))
+
+    def feature_names(self, object_='primary__primary'):
+        def _build_():
+            table = self.get_table('%s/%s/object_features' % (CH5Const.FEATURE, object_))
+            return [x[0].decode() if isinstance(x[0], bytes) else str(x[0]) for x in table]
+        return self._lut(('feature_names', object_), _build_)
+
+    def feature_index(self, object_='primary__primary'):
+        """Mapping feature name -> column of the object feature matrix"""
+        return self._lut(('feature_index', object_),
+                         lambda: dict((name, i) for i, name in enumerate(self.feature_names(object_))))
+
+class CH5Index(object):
+    """Sidecar index of a CellH5 file, stored as small HDF5 file next to it.
+
+       Holds the plate layout, the object counts per position, the time
+       stamps of all positions and a copy of the /definition tables, such
+       that opening a plate does not need to walk the HDF5 groups. The index
+       is invalidated when modification time or size of the CellH5 file
+       changes (changes in externally linked files are not detected). This
+       includes opening the file for writing, so the index is rebuilt on the
+       next open after any write access.
+    """
+    VERSION = 1
+    SUFFIX = '.idx'
+
+    def __init__(self, plate, positions, object_counts, time_stamps, definition_tables, source_stat):
+        self.plate = plate
+        self.positions = positions
+        self.object_counts = object_counts
+        self.time_stamps = time_stamps
+        self.definition_tables = definition_tables
+        self.source_stat = source_stat
+
+        self._position_rows = {}
+        for row, (well, site) in enumerate(self._iter_keys()):
+            self._position_rows[(well, site)] = row
+
+    def _iter_keys(self):
+        for well, sites in self.positions.items():
+            for site in sites:
+                yield well, site
+
+    @staticmethod
+    def index_filename(filename):
+        return filename + CH5Index.SUFFIX
+
+    @staticmethod
+    def get_source_stat(filename):
+        stat = os.stat(filename)
+        return stat.st_mtime, stat.st_size
+
+    @classmethod
+    def build(cls, ch5file):
+        """Walk all positions of an opened CH5File once and collect the index"""
+        fh = ch5file.get_file_handle()
+        keys = [(c.well, c.site) for c in ch5file.get_coordinates()]
+
+        object_counts = {}
+        time_stamps = []
+        for row, (well, site) in enumerate(keys):
+            pos_grp = fh[CH5PositionCoordinate(ch5file.plate, well, site).get_path()]
+            if CH5Const.OBJECT in pos_grp:
+                for name, dset in pos_grp[CH5Const.OBJECT].items():
+                    if isinstance(dset, h5py.Dataset):
+                        counts = object_counts.setdefault(name, -numpy.ones(len(keys), dtype=numpy.int64))
+                        counts[row] = len(dset)
+            if 'time_lapse' in pos_grp.get(CH5Const.IMAGE, {}):
+                time_stamps.append(numpy.asarray(pos_grp['image/time_lapse']['timestamp_rel'], dtype=numpy.float64))
+            else:
+                time_stamps.append(None)
+
+        definition_tables = CH5Definitions.read_tables(fh)
+
+        return cls(ch5file.plate, ch5file.positions, object_counts, time_stamps,
+                   definition_tables, cls.get_source_stat(ch5file.filename))
+
+    def write(self, filename):
+        with h5py.File(filename, 'w') as f:
+            f.attrs['version'] = self.VERSION
+            f.attrs['plate'] = self.plate
+            f.attrs['source_mtime'], f.attrs['source_size'] = self.source_stat
+
+            keys = list(self._iter_keys())
+            f.create_dataset('positions', data=numpy.array(keys, dtype=h5py.special_dtype(vlen=str)).reshape(-1, 2))
+            for name, counts in self.object_counts.items():
+                f.create_dataset('object_count/%s' % name, data=counts)
+
+            has_time = numpy.array([ts is not None for ts in self.time_stamps], dtype=bool)
+            lengths = [len(ts) if ts is not None else 0 for ts in self.time_stamps]
+            f.create_dataset('time_stamps/offsets', data=numpy.r_[0, numpy.cumsum(lengths, dtype=numpy.int64)])
+            f.create_dataset('time_stamps/valid', data=has_time)
+            f.create_dataset('time_stamps/values',
+                             data=numpy.concatenate([ts for ts in self.time_stamps if ts is not None] or [numpy.zeros((0,))]))
+
+            def_grp = f.create_group(CH5Const.DEFINITION)
+            for name in sorted(self.definition_tables):
+                table = self.definition_tables[name]
+                if table is None:
+                    def_grp.require_group(name)
+                else:
+                    def_grp.create_dataset(name, data=table)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the index of a CellH5 file, returns None if there is no index
+           file or if it is outdated"""
+        index_filename = cls.index_filename(filename)
+        if not os.path.exists(index_filename):
+            return None
+        source_stat = cls.get_source_stat(filename)
+        try:
+            with h5py.File(index_filename, 'r') as f:
+                if f.attrs['version'] != cls.VERSION or \
+                   (f.attrs['source_mtime'], f.attrs['source_size']) != source_stat:
+                    return None
+
+                positions = collections.OrderedDict()
+                for well, site in f['positions'][()]:
+                    well = well.decode() if isinstance(well, bytes) else well
+                    site = site.decode() if isinstance(site, bytes) else site
+                    positions.setdefault(well, []).append(site)
+
+                object_counts = {}
+                for name, dset in f.get('object_count', {}).items():
+                    object_counts[name] = dset[()]
+
+                offsets = f['time_stamps/offsets'][()]
+                valid = f['time_stamps/valid'][()]
+                values = f['time_stamps/values'][()]
+                time_stamps = [values[a:b] if v else None for a, b, v in zip(offsets[:-1], offsets[1:], valid)]
+
+                definition_tables = CH5Definitions.read_tables(f)
+
+                plate = f.attrs['plate']
+                plate = plate.decode() if isinstance(plate, bytes) else str(plate)
+        except (IOError, OSError, KeyError) as e:
+            warnings.warn("Warning: cellh5 - index file '%s' could not be read (%s)" % (index_filename, e))
+            return None
+
+        return cls(plate, positions, object_counts, time_stamps, definition_tables, source_stat)
+
+    def get_object_count(self, well, site, object_):
+        """Object count of a position, None if not known"""
+        if object_ not in self.object_counts:
+            return None
+        count = self.object_counts[object_][self._position_rows[(well, str(site))]]
+        if count < 0:
+            return None
+        return int(count)
+
+    def get_time_stamps(self, well, site):
+        return self.time_stamps[self._position_rows[(well, str(site))]]
+
+class CH5SidecarStore(object):
+    """Persistent store for arrays derived from a CellH5 file (e.g. the
+       CH5FrameIndex of each position), kept in a HDF5 file next to it.
+       Entries are keyed by path and dropped together when the CellH5 file
+       changes, using the same check as CH5Index."""
+    VERSION = 1
+    SUFFIX = '.derived'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.store_filename = filename + self.SUFFIX
+        self.source_stat = CH5Index.get_source_stat(filename)
+        self._lock = threading.Lock()
+
+    def _is_valid(self, f):
+        return f.attrs.get('version') == self.VERSION and \
+               (f.attrs.get('source_mtime'), f.attrs.get('source_size')) == self.source_stat
+
+    def load(self, key):
+        """Arrays stored under key as dict, None if not stored or outdated"""
+        if not os.path.exists(self.store_filename):
+            return None
+        try:
+            with self._lock, h5py.File(self.store_filename, 'r') as f:
+                if not self._is_valid(f) or key not in f:
+                    return None
+                return dict((name, dset[()]) for name, dset in f[key].items())
+        except (IOError, OSError) as e:
+            warnings.warn("Warning: cellh5 - sidecar store '%s' could not be read (%s)" % (self.store_filename, e))
+            return None
+
+    def save(self, key, arrays):
+        try:
+            with self._lock, h5py.File(self.store_filename, 'a') as f:
+                if not self._is_valid(f):
+                    for name in list(f.keys()):
+                        del f[name]
+                    f.attrs['version'] = self.VERSION
+                    f.attrs['source_mtime'], f.attrs['source_size'] = self.source_stat
+                if key in f:
+                    del f[key]
+                grp = f.create_group(key)
+                for name, data in arrays.items():
+                    grp.create_dataset(name, data=data)
+        except (IOError, OSError) as e:
+            warnings.warn("Warning: cellh5 - sidecar store '%s' could not be written (%s)" % (self.store_filename, e))
+
+def _open_for_reading(filename):
+    if os.path.isdir(filename):
+        return CH5VirtualFile(filename, mode='r')
+    return CH5File(filename, 'r', cached=False)
+
+def _class_counts_worker(args):
+    filename, well, site, object_ = args
+    ch5file = _open_for_reading(filename)
+    try:
+        return ch5file.get_position(well, site).get_class_counts(object_)
+    finally:
+        ch5file.close()
+
+def _track_events_position(ch5_pos, event_flat, event_offsets, object_):
+    # events extended by their first successors and the class label indices
+    # of all track objects, as flat arrays with track offsets
+    event_flat = numpy.asarray(event_flat, dtype=numpy.int64)
+    event_lengths = numpy.diff(event_offsets)
+    if len(event_lengths) == 0:
+        return event_flat, numpy.zeros((1,), dtype=numpy.int64), numpy.zeros((0,), dtype=numpy.int64)
+    next_flat, next_offsets = ch5_pos.track_first_many(event_flat[numpy.asarray(event_offsets[1:]) - 1],
+                                                       object_=object_)
+    next_lengths = numpy.diff(next_offsets)
+    offsets = numpy.r_[0, numpy.cumsum(event_lengths + next_lengths)]
+    flat = numpy.empty(offsets[-1], dtype=numpy.int64)
+    flat[ragged_arange(offsets[:-1], event_lengths)] = event_flat
+    flat[ragged_arange(offsets[:-1] + event_lengths, next_lengths)] = next_flat
+    return flat, offsets, ch5_pos.get_class_label_index(flat, object_=object_)
+
+def _track_events_worker(args):
+    filename, well, site, event_flat, event_offsets, object_ = args
+    ch5file = _open_for_reading(filename)
+    try:
+        return _track_events_position(ch5file.get_position(well, site), event_flat, event_offsets, object_)
+    finally:
+        ch5file.close()
+
+def _hmm_predict_worker(args):
+    decoder, label_flat, offsets = args
+    return decoder.decode_ragged(label_flat, offsets)[0]
+
+def _to_ragged(arrays):
+    offsets = numpy.r_[0, numpy.cumsum([len(a) for a in arrays])].astype(numpy.int64)
+    flat = numpy.concatenate([numpy.asarray(a) for a in arrays]) if len(arrays) > 0 else numpy.zeros((0,), dtype=numpy.int64)
+    return flat, offsets
+
+def _split_ragged(flat, offsets):
+    return [flat[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+class CH5ClassCounts(object):
+    """Object counts per (position, time frame, class) of a plate or screen.
+
+       counts: array of shape (n_positions, n_frames, n_classes + 1), the last
+               class counts unpredicted objects
+       positions: pandas.DataFrame with one row per position (Plate, Well,
+                  Site and the mapping columns, if any)
+       class_labels, class_names: labels and names of the class axis
+    """
+    def __init__(self, counts, positions, class_labels, class_names):
+        self.counts = counts
+        self.positions = positions.reset_index(drop=True)
+        self.class_labels = numpy.asarray(class_labels)
+        self.class_names = [str(n) for n in class_names]
+
+    @classmethod
+    def compute(cls, units, object_='primary__primary', n_workers=0):
+        """Count cube for units, a list of (ch5file, well, site). Counts of
+           positions are taken from / written to the sidecar store of their
+           file if there is one, the others are computed in n_workers
+           processes (0 computes in the calling process)."""
+        results = [None] * len(units)
+        keys = ['class_counts/%s/%s/%s' % (object_, well, site) for _, well, site in units]
+        todo = []
+        for k, (ch5file, _, _) in enumerate(units):
+            if ch5file.sidecar is not None:
+                arrays = ch5file.sidecar.load(keys[k])
+                if arrays is not None:
+                    results[k] = arrays['counts']
+                    continue
+            todo.append(k)
+
+        if n_workers != 0 and len(todo) > 1:
+            jobs = [(units[k][0].filename, units[k][1], units[k][2], object_) for k in todo]
+            for k, counts in zip(todo, _pool_map(_class_counts_worker, jobs, n_workers)):
+                results[k] = counts
+        else:
+            for k in todo:
+                ch5file, well, site = units[k]
+                results[k] = ch5file.get_position(well, site).get_class_counts(object_)
+
+        for k in todo:
+            if units[k][0].sidecar is not None:
+                units[k][0].sidecar.save(keys[k], {'counts': results[k]})
+
+        if len(units) == 0:
+            return numpy.zeros((0, 0, 0), dtype=numpy.int64)
+        n_frames = max(len(r) for r in results)
+        cube = numpy.zeros((len(results), n_frames, results[0].shape[1]), dtype=numpy.int64)
+        for k, counts in enumerate(results):
+            cube[k, :len(counts)] = counts
+        return cube
+
+    @property
+    def n_frames(self):
+        return self.counts.shape[1]
+
+    def class_index(self, class_):
+        """Column of the class axis for a class name or label"""
+        if isinstance(class_, str):
+            return self.class_names.index(class_)
+        return int(numpy.flatnonzero(self.class_labels == class_)[0])
+
+    def fractions(self, include_unpredicted=False):
+        """Fraction of objects per class for each position and frame"""
+        counts = self.counts if include_unpredicted else self.counts[:, :, :-1]
+        total = counts.sum(axis=2, keepdims=True)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return counts / total.astype(numpy.float64)
+
+    def mitotic_index(self, classes):
+        """Fraction of (predicted) objects in any of classes (names or labels)
+           as DataFrame with one row per position and one column per frame"""
+        columns = [self.class_index(c) for c in classes]
+        index = self.fractions()[:, :, columns].sum(axis=2)
+        return pandas.DataFrame(index, index=pandas.MultiIndex.from_frame(self.positions),
+                                columns=pandas.Index(numpy.arange(self.n_frames), name='Time'))
+
+    def to_frame(self):
+        """Counts as long DataFrame indexed by the position columns and Time,
+           with one column per class"""
+        n_positions = len(self.positions)
+        frame = pandas.DataFrame(self.counts.reshape(n_positions * self.n_frames, -1), columns=self.class_names)
+        for col in self.positions.columns:
+            frame[col] = numpy.repeat(self.positions[col].values, self.n_frames)
+        frame['Time'] = numpy.tile(numpy.arange(self.n_frames), n_positions)
+        return frame.set_index(list(self.positions.columns) + ['Time'])
+
+    def to_xarray(self):
+        """Counts as xarray.DataArray with dims (position, time, class), the
+           position columns become coordinates of the position dim"""
+        import xarray
+        coords = dict(('%s' % col, ('position', self.positions[col].values)) for col in self.positions.columns)
+        coords['time'] = numpy.arange(self.n_frames)
+        coords['class'] = self.class_names
+        return xarray.DataArray(self.counts, dims=('position', 'time', 'class'), coords=coords)
+
+class CH5EventCatalog(object):
+    """Columnar catalog of the event tracks of one or several plates.
+
+       events: pandas.DataFrame with one row per event branch and columns
+               position (row of positions), event_id, branch, onset (time
+               frame of the onset object, -1 if the track is too short) and
+               length; rows of a position are contiguous
+       positions: pandas.DataFrame with Plate, Well, Site (and mapping) columns
+       objects, offsets: object indices of all tracks as ragged array, the
+                         track of event row k is objects[offsets[k]:offsets[k + 1]]
+
+       Catalogs are built from the event tables in bulk and can be filtered
+       (select) before labels or features of the tracks are read.
+    """
+    def __init__(self, events, positions, objects, offsets, units):
+        self.events = events.reset_index(drop=True)
+        self.positions = positions.reset_index(drop=True)
+        self.objects = objects
+        self.offsets = offsets
+        self.units = units
+
+    @classmethod
+    def build(cls, units, positions=None, onset_frame=0, object_='primary__primary'):
+        """Catalog of all events of units, a list of (ch5file, well, site)"""
+        if positions is None:
+            positions = pandas.DataFrame({'Plate': [f.plate for f, _, _ in units],
+                                          'Well': [w for _, w, _ in units],
+                                          'Site': [s for _, _, s in units]}, columns=['Plate', 'Well', 'Site'])
+        columns = dict((c, []) for c in ('position', 'event_id', 'branch', 'onset', 'length'))
+        objects = []
+        for k, (ch5file, well, site) in enumerate(units):
+            ch5_pos = ch5file.get_position(well, site)
+            if not ch5_pos.has_events():
+                continue
+            event_ids, branch, flat, offsets = CH5EventDecoder(ch5_pos.get_table('object/event')).tracks()
+            lengths = numpy.diff(offsets)
+            onset = -numpy.ones(len(lengths), dtype=numpy.int64)
+            long_enough = lengths > onset_frame
+            onset[long_enough] = ch5_pos.get_time_idx(flat[offsets[:-1][long_enough] + onset_frame], object_)
+
+            for name, values in zip(('position', 'event_id', 'branch', 'onset', 'length'),
+                                    (numpy.repeat(k, len(lengths)), event_ids, branch, onset, lengths)):
+                columns[name].append(numpy.asarray(values, dtype=numpy.int64))
+            objects.append(numpy.asarray(flat, dtype=numpy.int64))
+
+        events = pandas.DataFrame(dict((name, numpy.concatenate(values) if len(values) > 0 else
+                                        numpy.zeros((0,), dtype=numpy.int64)) for name, values in columns.items()),
+                                  columns=['position', 'event_id', 'branch', 'onset', 'length'])
+        objects = numpy.concatenate(objects) if len(objects) > 0 else numpy.zeros((0,), dtype=numpy.int64)
+        return cls(events, positions, objects, numpy.r_[0, numpy.cumsum(events['length'].values)], units)
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def table(self):
+        """Events joined with their position columns"""
+        return self.positions.iloc[self.events['position'].values].reset_index(drop=True).join(self.events)
+
+    def select(self, onset_window=None, min_length=None, branch=None, treatment=None, **columns):
+        """Subset of the catalog, filtered on the event columns only.
+
+           onset_window: (first, last) onset frames, inclusive, None for open ends
+           min_length: minimum track length
+           branch: 0 for the first branch of each event, 1 for second branches
+           treatment: value or list of values of 'Gene Symbol' or 'siRNA ID'
+           columns: further position columns and their allowed value(s), e.g. Group='neg'
+        """
+        keep = numpy.ones(len(self.events), dtype=bool)
+        onset = self.events['onset'].values
+        if onset_window is not None:
+            first, last = onset_window
+            keep &= onset >= (0 if first is None else first)
+            if last is not None:
+                keep &= onset <= last
+        if min_length is not None:
+            keep &= self.events['length'].values >= min_length
+        if branch is not None:
+            keep &= self.events['branch'].values == branch
+
+        position_keep = numpy.ones(len(self.positions), dtype=bool)
+        if treatment is not None:
+            values = treatment if isinstance(treatment, (list, tuple, set)) else [treatment]
+            treated = numpy.zeros(len(self.positions), dtype=bool)
+            for name in ('Gene Symbol', 'siRNA ID'):
+                if name in self.positions:
+                    treated |= self.positions[name].isin(values).values
+            position_keep &= treated
+        for name, values in columns.items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            position_keep &= self.positions[name].isin(values).values
+        keep &= position_keep[self.events['position'].values]
+
+        rows = numpy.flatnonzero(keep)
+        starts = self.offsets[rows]
+        objects = self.objects[ragged_arange(starts, self.offsets[rows + 1] - starts)]
+        events = self.events.iloc[rows]
+        return CH5EventCatalog(events, self.positions, objects,
+                               numpy.r_[0, numpy.cumsum(events['length'].values)], self.units)
+
+    def split(self, flat):
+        """Split an array aligned with objects into per event arrays"""
+        return [flat[a:b] for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def tracks(self):
+        return self.split(self.objects)
+
+    def iter_positions(self):
+        """Yields (position row, CH5Position, slice of event rows) for all
+           positions with events in the catalog"""
+        position = self.events['position'].values
+        bounds = numpy.r_[0, numpy.flatnonzero(numpy.diff(position)) + 1, len(position)] if len(position) > 0 else []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            ch5file, well, site = self.units[position[a]]
+            yield position[a], ch5file.get_position(well, site), slice(a, b)
+
+    def get_features(self, features=None, object_='primary__primary', align=None, window=None,
+                     ragged=False, fill=numpy.nan):
+        """Object features of all tracks (see CH5Position.get_track_features),
+           read with one coalesced pass per position"""
+        values = []
+        for _, ch5_pos, rows in self.iter_positions():
+            a, b = self.offsets[rows.start], self.offsets[rows.stop]
+            values.append(ch5_pos.get_track_features((self.objects[a:b], self.offsets[rows.start:rows.stop + 1] - a),
+                                                     features, object_, ragged=True)[0])
+        values = numpy.concatenate(values) if len(values) > 0 else numpy.zeros((0, 0))
+        if ragged:
+            return values, self.offsets
+        return pad_tracks(values, self.offsets, align, window, fill)
+
+    def get_class_labels(self, object_='primary__primary'):
+        """Class labels of all track objects, aligned with objects (one read per position)"""
+        labels = numpy.empty(len(self.objects), dtype=int)
+        for _, ch5_pos, rows in self.iter_positions():
+            a, b = self.offsets[rows.start], self.offsets[rows.stop]
+            labels[a:b] = ch5_pos.get_class_label(self.objects[a:b], object_)
+        return labels
 
 class CH5File(object):
-    """CH5File object to open CH5 files"""
-    def __init__(self, filename, mode='a', cached=True):
+    """CH5File object to open CH5 files
+
+       index: if True, plate layout, object counts, time stamps and
+              definition tables are taken from a sidecar index file
+              (see CH5Index), which is created on first use. Derived
+              per-position structures (e.g. CH5FrameIndex) are persisted
+              in a CH5SidecarStore.
+       mode:  h5py file mode, defaults to 'r' with index (opening for
+              writing invalidates the index) and to 'a' otherwise
+       swmr:  open a file written in streaming mode by CH5FileWriter for
+              reading while it is written (mode 'r'), see CH5Position.refresh
+    """
+    def __init__(self, filename, mode=None, cached=True, index=False, swmr=False):
+        if mode is None:
+            mode = 'r' if index else 'a'
         self._cached = cached
+        self.index = None
+        self.sidecar = None
+        self._definitions = None
         if isinstance(filename, str):
             self.filename = filename
-            self._file_handle = h5py.File(filename, mode)
+            # validate the index before opening, h5py touches files opened for writing
+            if index:
+                self._load_index()
+            self._file_handle = h5py.File(filename, mode, swmr=swmr)
         else:
             self._file_handle = filename
             self.filename = filename.filename
+            if index:
+                self._load_index()
 
-        try:
-            self.plate = self._get_group_members('/sample/0/plate/')[0]
-        except KeyError:
-            return
+        if self.index is not None:
+            self.plate = self.index.plate
+            self.wells = list(self.index.positions.keys())
+            self.positions = self.index.positions
+        else:
+            try:
+                self.plate = self._get_group_members('/sample/0/plate/')[0]
+            except KeyError:
+                return
 
-        self.wells = self._get_group_members('/sample/0/plate/%s/experiment/' % self.plate)
-        self.positions = collections.OrderedDict()
-        for w in sorted(self.wells):
-            self.positions[w] = self._get_group_members('/sample/0/plate/%s/experiment/%s/position/' % (self.plate, w))
+            self.wells = self._get_group_members('/sample/0/plate/%s/experiment/' % self.plate)
+            self.positions = collections.OrderedDict()
+            for w in sorted(self.wells):
+                self.positions[w] = self._get_group_members('/sample/0/plate/%s/experiment/%s/position/' % (self.plate, w))
 
+        self._init_position_registry()
+
+        if index and self.index is None:
+            self.index = CH5Index.build(self)
+            try:
+                self.index.write(CH5Index.index_filename(self.filename))
+            except (IOError, OSError) as e:
+                warnings.warn("Warning: cellh5 - index file for '%s' could not be written (%s)" % (self.filename, e))
+
+    def _load_index(self):
+        if os.path.exists(self.filename):
+            self.index = CH5Index.load(self.filename)
+            self.sidecar = CH5SidecarStore(self.filename)
+
+    def _init_position_registry(self):
+        # positions are only registered by name here, the position objects
+        # (and external links they point to) are created on first access
         self._position_group = {}
         self._coordinates = []
         for well, positions in self.positions.items():
             for pos in positions:
                 self._coordinates.append(CH5PositionCoordinate(self.plate, well, pos))
-                self._position_group[(well, pos)] = self._open_position(
-                    self.plate, well, pos)
+        self._position_keys = set((c.well, c.site) for c in self._coordinates)
+
+        self._current_pos = None
 
-        self.current_pos = list(self._position_group.values())[0]
+    @property
+    def current_pos(self):
+        if self._current_pos is None and len(self._coordinates) > 0:
+            self._current_pos = self.get_position_from_coord(self._coordinates[0])
+        return self._current_pos
+
+    @current_pos.setter
+    def current_pos(self, position):
+        self._current_pos = position
 
     def get_coordinates(self):
         return self._coordinates
@@ -1142,21 +2891,46 @@ class CH5File(object):
         return self.get_position(coord.well, coord.site)
 
     def get_position(self, well, pos):
-        return self._position_group[(well, str(pos))]
+        key = (well, str(pos))
+        if key not in self._position_group:
+            if key not in self._position_keys:
+                raise KeyError("Position (%s, %s) not found in '%s'" % (well, pos, self.filename))
+            self._position_group[key] = self._open_position(self.plate, *key)
+        return self._position_group[key]
 
     def has_position(self, well, pos):
-        return (well, str(pos)) in self._position_group
+        return (well, str(pos)) in self._position_keys
 
     def get_file_handle(self):
         return self._file_handle
 
+    def get_position_file_handle(self, well, pos):
+        return self._file_handle
+
     def get_definition_root(self):
+        """The /definition group, for writing. Drops the definition snapshot."""
+        self.invalidate_definitions()
         return self._file_handle[CH5Const.DEFINITION]
 
+    def get_definitions(self):
+        """Snapshot of the /definition tables (CH5Definitions), read once"""
+        if self._definitions is None:
+            if self.index is not None:
+                tables = self.index.definition_tables
+            else:
+                tables = CH5Definitions.read_tables(self._file_handle)
+            self._definitions = CH5Definitions(tables)
+        return self._definitions
+
+    def invalidate_definitions(self):
+        if self._definitions is not None:
+            self._definitions = None
+            self.clear_cache()
+
     def iter_positions(self):
         for well, positions in list(self.positions.items()):
             for pos in positions:
-                yield self._position_group[(well, pos)]
+                yield self.get_position(well, pos)
 
     def set_current_pos(self, well, pos):
         self.current_pos = self.get_position(well, pos)
@@ -1164,12 +2938,18 @@ class CH5File(object):
     def _get_group_members(self, path):
         return list(map(str, list(self._file_handle[path].keys())))
 
-    @memoize
+    def get_definition_table(self, path):
+        """Table below /definition, e.g. 'image/region'"""
+        return self.get_definitions().get_table(path)
+
+    def has_definition(self, path):
+        return self.get_definitions().has_table(path)
+
     def class_definition(self, object_="primary__primary"):
-        return self._file_handle['/definition/feature/%s/object_classification/class_labels' % object_].value
+        return self.get_definitions().class_definition(object_)
 
     def classification_info(self, object_="primary__primary"):
-        return pandas.DataFrame(self._file_handle['/definition/feature/%s/object_classification/class_labels' % object_].value)
+        return pandas.DataFrame(self.class_definition(object_))
 
     @property
     def feature_definition(self):
@@ -1184,23 +2964,19 @@ class CH5File(object):
         return self._file_handle['/definition/object']
 
     def has_classification(self, object_):
-        if object_ in self.feature_definition:
-            return 'object_classification' in self.feature_definition[object_]
-        else:
-            return False
+        return self.has_definition('feature/%s/object_classification' % object_)
 
     def has_object_features(self, object_):
-        if object_ in self.feature_definition:
-            return 'object_features' in self.feature_definition[object_]
-        else:
-            return False
+        return self.has_definition('feature/%s/object_features' % object_)
 
     def object_feature_def(self, object_='primary__primary'):
-        return [str(x[0]) for x in self.feature_definition['%s/object_features' % object_].value]
+        return list(self.get_definitions().feature_names(object_))
 
     def get_object_feature_idx_by_name(self, object_, feature_name):
-        object_feature_names = self.object_feature_def(object_)
-        return list(object_feature_names).index(feature_name)
+        try:
+            return self.get_definitions().feature_index(object_)[feature_name]
+        except KeyError:
+            raise ValueError("'%s' is not an object feature of '%s'" % (feature_name, object_))
 
     def gallery_image_matrix_gen(self, index_tpl, object_='primary__primary'):
         gen_list = []
@@ -1255,6 +3031,21 @@ class CH5File(object):
                 image[a:c, b:d,:] = img
         return image
 
+    def get_class_counts(self, object_='primary__primary', n_workers=0):
+        """Object counts per (position, time frame, class) of all positions (CH5ClassCounts)"""
+        coords = self.get_coordinates()
+        counts = CH5ClassCounts.compute([(self, c.well, c.site) for c in coords], object_, n_workers)
+        positions = pandas.DataFrame({'Plate': [c.plate for c in coords],
+                                      'Well': [c.well for c in coords],
+                                      'Site': [c.site for c in coords]}, columns=['Plate', 'Well', 'Site'])
+        labels, names, _, _ = self.get_definitions().class_lookup(object_)
+        return CH5ClassCounts(counts, positions, labels, names)
+
+    def get_event_catalog(self, onset_frame=0, object_='primary__primary'):
+        """Event tracks of all positions (CH5EventCatalog)"""
+        return CH5EventCatalog.build([(self, c.well, c.site) for c in self.get_coordinates()],
+                                     onset_frame=onset_frame, object_=object_)
+
     def get_gallery_image_matrix(self, index_tpl, shape, object_='primary__primary'):
         img_gen = self.gallery_image_matrix_gen(index_tpl=index_tpl, object_=object_)
         return CH5File.gallery_image_matrix_layouter(img_gen, shape)
@@ -1263,12 +3054,142 @@ class CH5File(object):
         img_gen = self.gallery_image_matrix_gen(index_tpl=index_tpl, object_=object_)
         return CH5File.gallery_image_matrix_layouter(img_gen, shape)
 
+    def clear_cache(self):
+        """Drop all cached results of this file and its positions"""
+        CH5_CACHE.invalidate(self)
+        for position in self._position_group.values():
+            if position is not None:
+                CH5_CACHE.invalidate(position)
+
     def close(self):
+        if hasattr(self, '_position_group'):
+            self.clear_cache()
         try:
             self._file_handle.close()
         except:
             pass
 
+class CH5FilePool(object):
+    """Bounded pool of open h5py file handles. If more than max_open files
+       are requested, the least recently used handle is closed."""
+    def __init__(self, max_open=64, mode='r', on_close=None):
+        if max_open < 2:
+            raise ValueError("CH5FilePool needs to hold at least 2 open files")
+        self.max_open = max_open
+        self.mode = mode
+        self.on_close = on_close
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, filename):
+        if filename in self._handles:
+            self._handles.move_to_end(filename)
+            return self._handles[filename]
+
+        while len(self._handles) >= self.max_open:
+            old_filename, old_handle = self._handles.popitem(last=False)
+            self._close_handle(old_filename, old_handle)
+
+        handle = h5py.File(filename, self.mode)
+        self._handles[filename] = handle
+        return handle
+
+    def _close_handle(self, filename, handle):
+        try:
+            handle.close()
+        except:
+            pass
+        if self.on_close is not None:
+            self.on_close(filename)
+
+    def close(self):
+        while len(self._handles) > 0:
+            self._close_handle(*self._handles.popitem(last=False))
+
+class CH5VirtualFile(CH5File):
+    """Virtual plate over a folder of per-position CellH5 files (as written
+       by CellCognition), usable instead of a file created by repack_cellh5.
+
+       The files are opened on demand through a CH5FilePool, at most
+       max_open_files are kept open at the same time. Definitions are read
+       from the first file.
+    """
+    def __init__(self, cellh5_folder, cached=True, check_reg=r'^[A-Z]\d{2}_\d{2}', max_open_files=64, mode='r'):
+        import glob, re
+        self._cached = cached
+        self.index = None
+        self.sidecar = None
+        self._definitions = None
+        self.filename = cellh5_folder
+        self._pool = CH5FilePool(max_open_files, mode, on_close=self._on_file_closed)
+
+        if check_reg is not None:
+            reg = re.compile(check_reg)
+        else:
+            reg = None
+        flist = [fname for fname in sorted(glob.glob(os.path.join(cellh5_folder, '*.ch5')))
+                 if reg is None or reg.search(os.path.split(fname)[1]) is not None]
+        if len(flist) == 0:
+            raise IOError("No CellH5 files found in '%s'" % cellh5_folder)
+
+        self._definition_file = flist[0]
+        self._position_files = {}
+        self._position_group = {}
+        positions = {}
+        self.plate = None
+        for fname in flist:
+            fh = self._pool.get(fname)
+            plate = self._get_first_member(fh, '/sample/0/plate/')
+            well = self._get_first_member(fh, '/sample/0/plate/%s/experiment/' % plate)
+            site = self._get_first_member(fh, '/sample/0/plate/%s/experiment/%s/position/' % (plate, well))
+            if self.plate is None:
+                self.plate = plate
+            if (well, site) in self._position_files:
+                warnings.warn("Warning: cellh5 - well, position (%s, %s) found in '%s' and '%s', ignoring the latter" %
+                              (well, site, self._position_files[(well, site)][0], fname))
+                continue
+            self._position_files[(well, site)] = (fname, plate)
+            positions.setdefault(well, []).append(site)
+
+        self.wells = sorted(positions.keys())
+        self.positions = collections.OrderedDict()
+        for w in self.wells:
+            self.positions[w] = positions[w]
+
+        self._init_position_registry()
+
+    @staticmethod
+    def _get_first_member(fh, path):
+        return str(list(fh[path].keys())[0])
+
+    @property
+    def _file_handle(self):
+        return self._pool.get(self._definition_file)
+
+    def _on_file_closed(self, filename):
+        # positions read from a closed file may hold cached h5py objects
+        for key, (fname, _) in self._position_files.items():
+            if fname == filename and key in self._position_group:
+                position = self._position_group.pop(key)
+                if isinstance(position, CH5CachedPosition):
+                    position.clear_cache()
+
+    def _open_position(self, plate, well, position):
+        # each file may carry its own plate name
+        return super(CH5VirtualFile, self)._open_position(self._position_files[(well, position)][1], well, position)
+
+    def get_position_file_handle(self, well, pos):
+        return self._pool.get(self._position_files[(well, str(pos))][0])
+
+    def get_position_filename(self, well, pos):
+        return self._position_files[(well, str(pos))][0]
+
+    def close(self):
+        self.clear_cache()
+        self._pool.close()
+
 class CH5MappedFile(CH5File):
     """Combine a CellH5 file with meta information from a mapping file, which contains information for each well"""
     def read_mapping(self, mapping_file, sites=None, rows=None, cols=None, locations=None, plate_name=''):
@@ -1314,7 +3235,7 @@ class CH5MappedFile(CH5File):
 class CH5MappedFileCollection(object):
     """Several CellH5 files together with a mapping"""
     def __init__(self, name="CH5MappedFileCollection", mapping_files=None, cellh5_files=None,
-                       sites=None, rows=None, cols=None, locations=None, init=True):
+                       sites=None, rows=None, cols=None, locations=None, init=True, index=False):
         self.name = name
         self.mapping_files = mapping_files
         self.cellh5_files = cellh5_files
@@ -1330,7 +3251,7 @@ class CH5MappedFileCollection(object):
                     raise RuntimeError("Plate name %s not found" % plate_name)
                 cellh5_file = cellh5_files[plate_name]
 
-                mapped_ch5 = CH5MappedFile(cellh5_file)
+                mapped_ch5 = CH5MappedFile(cellh5_file, index=index)
                 mapped_ch5.read_mapping(mapping_file, sites=sites, rows=rows, cols=cols, locations=locations, plate_name=plate_name)
 
                 time_lapse = mapped_ch5.current_pos.get_time_lapse()
@@ -1361,6 +3282,28 @@ class CH5MappedFileCollection(object):
     def get_ch5_position(self, plate, well, site):
         return self.cellh5_handles[plate].get_position(well, site)
 
+    def get_class_counts(self, object_='primary__primary', n_workers=0):
+        """Object counts per (position, time frame, class) for all rows of the
+           mapping (CH5ClassCounts), with the mapping columns as position labels"""
+        units = [(self.cellh5_handles[plate], well, str(site))
+                 for plate, well, site in self.mapping[['Plate', 'Well', 'Site']].values]
+        counts = CH5ClassCounts.compute(units, object_, n_workers)
+        positions = self._get_position_columns()
+        labels, names, _, _ = list(self.cellh5_handles.values())[0].get_definitions().class_lookup(object_)
+        return CH5ClassCounts(counts, positions, labels, names)
+
+    def get_event_catalog(self, onset_frame=0, object_='primary__primary'):
+        """Event tracks of all rows of the mapping (CH5EventCatalog)"""
+        units = [(self.cellh5_handles[plate], well, str(site))
+                 for plate, well, site in self.mapping[['Plate', 'Well', 'Site']].values]
+        return CH5EventCatalog.build(units, self._get_position_columns(), onset_frame=onset_frame, object_=object_)
+
+    def _get_position_columns(self):
+        # position labels are the scalar mapping columns, not e.g. per position event lists
+        columns = [c for c in self.mapping.columns if c != 'index' and
+                   not any(isinstance(v, (list, tuple, numpy.ndarray)) for v in self.mapping[c])]
+        return self.mapping[columns]
+
     def get_object_classificaiton_dict(self, prop="name", object_='primary__primary'):
         res = OrderedDict()
         data = list(self.cellh5_handles.values())[0].class_definition(object_)
@@ -1375,9 +3318,9 @@ class CH5MappedFileCollection(object):
 class CH5Analysis(CH5MappedFileCollection):
     """Basic class used for common analysis task using CellH5, e. g. already contains PCA, etc"""
     def __init__(self, name="CH5Analysis", mapping_files=None, cellh5_files=None,
-                       sites=None, rows=None, cols=None, locations=None, output_dir=None, init=True):
+                       sites=None, rows=None, cols=None, locations=None, output_dir=None, init=True, index=False):
         CH5MappedFileCollection.__init__(self, name=name, mapping_files=mapping_files, cellh5_files=cellh5_files,
-                       sites=sites, rows=rows, cols=cols, locations=locations, init=True)
+                       sites=sites, rows=rows, cols=cols, locations=locations, init=True, index=index)
 
         self.output_dir = output_dir
         self.set_output_dir(output_dir)
@@ -1541,15 +3484,16 @@ class CH5Analysis(CH5MappedFileCollection):
             treatment = "%s %s" % (row['Gene Symbol'], row['siRNA ID'])
 
             ch5_pos = self.get_ch5_position(plate, well, site)
-            all_times = ch5_pos.get_all_time_idx(object_)
+            frame_index = ch5_pos.get_frame_index(object_)
             self.log.info('Reading %s %s %s %s for object %s using time %r' % (plate,well,site,treatment,object_,time_frames))
 
             # there are data points
-            if len(all_times) > 0:
+            if len(frame_index) > 0:
                 if time_frames is not None:
-                    time_idx = numpy.in1d(all_times, time_frames)
+                    time_idx = numpy.zeros(len(frame_index), dtype=bool)
+                    time_idx[frame_index.objects_of(time_frames)] = True
                 else:
-                    time_idx = numpy.ones(len(all_times), dtype=numpy.bool)
+                    time_idx = numpy.ones(len(frame_index), dtype=bool)
                 idx_bool = time_idx
 
                 # TODO
@@ -1558,11 +3502,11 @@ class CH5Analysis(CH5MappedFileCollection):
 
                 idx = numpy.nonzero(idx_bool)[0]
                 if len(idx) > 0:
-                    feature_matrix = ch5_pos.get_object_features(object_=object_, index=tuple(idx))
+                    feature_matrix = ch5_pos.get_object_features(object_=object_, index=idx)
                     feature_matrix = feature_matrix[:, features_keep]
 
                     if read_classification:
-                        classification_labels = ch5_pos.get_class_prediction(object_=object_)[idx_bool]['label_idx']
+                        classification_labels = ch5_pos.get_class_label_index(idx, object_=object_)
                     else:
                         classification_labels = []
                     object_count = len(feature_matrix)
@@ -1733,19 +3677,20 @@ class CH5FateAnalysis(CH5Analysis):
     fate categories (e.g. death in mitosis), and correlations to kinetics in a additional
     channel / color
     """
-    def read_events(self, onset_frame=0, time_limits=(0, numpy.Inf), object_="primary__primary"):
-        event_ids_all = []
-        event_labels_all = []
-        for _, (plate, well, site) in self.mapping[['Plate', 'Well', 'Site']].iterrows():
-            self.log.info('Reading %s %s %s for object' % (plate, well, site))
-            ch5_pos = self.get_ch5_position(plate, well, site)
-
-            event_ids = ch5_pos.get_events()
-            event_ids = [e for e in event_ids if ch5_pos.get_time_idx(time_limits[0] <= e[onset_frame]) <= time_limits[1]]
-            event_ids_all.append(event_ids)
-
-            event_labels = [ch5_pos.get_class_label(e, object_=object_) for e in event_ids]
-            event_labels_all.append(event_labels)
+    def read_events(self, onset_frame=0, time_limits=(0, numpy.inf), object_="primary__primary"):
+        """Events of all positions with onset (time of the onset_frame-th
+           event object) within time_limits (inclusive)"""
+        first, last = time_limits
+        catalog = self.get_event_catalog(onset_frame=onset_frame, object_=object_)
+        catalog = catalog.select(onset_window=(first, None if numpy.isinf(last) else last), branch=0)
+
+        event_ids = catalog.split(catalog.objects)
+        event_labels = catalog.split(catalog.get_class_labels(object_))
+        event_ids_all = [[] for _ in range(len(self.mapping))]
+        event_labels_all = [[] for _ in range(len(self.mapping))]
+        for k, row in enumerate(catalog.events['position'].values):
+            event_ids_all[row].append(event_ids[k])
+            event_labels_all[row].append(event_labels[k])
 
         self.mapping["Event IDs"] = event_ids_all
         self.mapping["Event labels"] = event_labels_all
@@ -1771,30 +3716,31 @@ class CH5FateAnalysis(CH5Analysis):
         str_+= "Caution: Class index will be used for all processing\n\n"
         return str_
 
-    def track_events(self, object_="primary__primary"):
-        def _track_events_(xxx):
-            plate = xxx["Plate"]
-            well = xxx["Well"]
-            site = xxx["Site"]
-            ch5_pos = self.get_ch5_position(plate, well, site)
-            self.log.info('Tracking events  %s %s %s' % (plate, well, site))
-
-            event_ids = xxx["Event IDs"]
-            track_ids = []
-            track_labels = []
-            for _, event_idx in enumerate(event_ids):
-                start_idx = event_idx[-1]
-                track = list(event_idx) + ch5_pos.track_first(start_idx, object_=object_)
-                class_labels = ch5_pos.get_class_label_index(track, object_=object_)
-                track_labels.append(class_labels)
-                track_ids.append(track)
+    def track_events(self, object_="primary__primary", n_workers=0):
+        """Extend the events of all positions by their first successors.
 
-            return track_ids, track_labels
+           n_workers: number of processes, each reading its positions from a
+                      read-only handle (None for one per CPU), 0 tracks all
+                      positions in the calling process
+        """
+        rows = self.mapping[['Plate', 'Well', 'Site', 'Event IDs']].values
+        events = [_to_ragged(event_ids) for _, _, _, event_ids in rows]
+        if n_workers != 0 and len(rows) > 1:
+            self.log.info('Tracking events of %d positions in parallel' % len(rows))
+            jobs = [(self.cellh5_handles[plate].filename, well, site, flat, offsets, object_)
+                    for (plate, well, site, _), (flat, offsets) in zip(rows, events)]
+            results = _pool_map(_track_events_worker, jobs, n_workers)
+        else:
+            results = []
+            for (plate, well, site, _), (flat, offsets) in zip(rows, events):
+                self.log.info('Tracking events  %s %s %s' % (plate, well, site))
+                results.append(_track_events_position(self.get_ch5_position(plate, well, site), flat, offsets, object_))
 
-        track_ids, track_labels = pandas_apply(self.mapping, _track_events_)
+        track_ids = [[list(t) for t in _split_ragged(flat, offsets)] for flat, offsets, _ in results]
+        track_labels = [_split_ragged(labels, offsets) for _, offsets, labels in results]
 
-        self.mapping["Track IDs"] = pandas.Series(track_ids)
-        self.mapping["Track Labels"] = pandas.Series(track_labels)
+        self.mapping["Track IDs"] = pandas.Series(track_ids, index=self.mapping.index)
+        self.mapping["Track Labels"] = pandas.Series(track_labels, index=self.mapping.index)
 
     def setup_hmm(self, transmat, constraint_xml, eps=0.001):
         k_classes = transmat.shape[0]
@@ -1802,36 +3748,34 @@ class CH5FateAnalysis(CH5Analysis):
         transmat = normalize(transmat, axis=1, eps=eps)
         est = HMMAgnosticEstimator(k_classes, transmat, numpy.ones((k_classes, k_classes)), numpy.ones((k_classes, )) )
         est.constrain(constraints)
-        self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
-        self.hmm._set_emissionprob(est.emis)
-
-    def predict_hmm(self):
-        def _hmm_predict_(xxx):
-            plate = xxx["Plate"]
-            well = xxx["Well"]
-            site = xxx["Site"]
-            self.log.info('HMM prediction %s %s %s' % (plate, well, site))
-
-            track_ids = xxx["Track IDs"]
-            track_labels = xxx["Track Labels"]
-
-            hmm_labels_list = []
-
-
-            for _, track_labels in enumerate(track_labels):
-
-                class_labels = track_labels
-                if not isinstance(track_labels, list):
-                    class_labels = list(track_labels)
-                hmm_class_labels = self.hmm.predict(class_labels)
-                hmm_labels_list.append(hmm_class_labels)
-
-            return hmm_labels_list, track_ids
+        if hmm is not None:
+            self.hmm = hmm.MultinomialHMM(n_components=est.nstates, transmat=transmat, startprob=est.startprob, init_params="")
+            self.hmm._set_emissionprob(est.emis)
+        # same matrices as the sklearn model, which floors zeros in place
+        self.hmm_decoder = HMMViterbiDecoder(est.startprob, transmat, est.emis)
+
+    def predict_hmm(self, n_workers=0):
+        """HMM smoothing of the track labels of all positions, all tracks of a
+           position are decoded at once (see HMMViterbiDecoder).
+
+           n_workers: number of processes (None for one per CPU), 0 predicts
+                      in the calling process
+        """
+        labels = [_to_ragged(track_labels) for track_labels in self.mapping["Track Labels"]]
+        if n_workers != 0 and len(labels) > 1:
+            self.log.info('HMM prediction of %d positions in parallel' % len(labels))
+            results = _pool_map(_hmm_predict_worker, [(self.hmm_decoder, flat, offsets) for flat, offsets in labels],
+                                n_workers)
+        else:
+            results = []
+            for (plate, well, site), (flat, offsets) in zip(self.mapping[['Plate', 'Well', 'Site']].values, labels):
+                self.log.info('HMM prediction %s %s %s' % (plate, well, site))
+                results.append(_hmm_predict_worker((self.hmm_decoder, flat, offsets)))
 
-        hmm_track_labels, hmm_track_ids = pandas_apply(self.mapping, _hmm_predict_)
+        hmm_track_labels = [_split_ragged(predicted, offsets) for predicted, (_, offsets) in zip(results, labels)]
 
-        self.mapping["HMM Track IDs"] = pandas.Series(hmm_track_ids)
-        self.mapping["HMM Track Labels"] = pandas.Series(hmm_track_labels)
+        self.mapping["HMM Track IDs"] = self.mapping["Track IDs"]
+        self.mapping["HMM Track Labels"] = pandas.Series(hmm_track_labels, index=self.mapping.index)
 
     def print_tracks(self, track_name="HMM Track Labels", pattern="%d", ident=" "):
         if track_name not in self.mapping:
@@ -1953,6 +3897,13 @@ class TestCH5Basic(CH5TestBase):
         self.assertTrue(numpy.all(a1 == a2))
         self.assertFalse(numpy.all(a1 == b1))
 
+    def testGalleryBatch(self):
+        index = numpy.array([5, 1, 2, 1, 100])
+        images = self.pos.get_gallery_images(index)
+        self.assertEqual(images.shape, (len(index), GALLERY_SIZE, GALLERY_SIZE))
+        for img, i in zip(images, index):
+            self.assertTrue(numpy.all(img == self.pos.get_gallery_image(int(i))))
+
     def testGallery2(self):
         event = self.pos.track_first(5)
         a1 = self.pos.get_gallery_image(tuple(event))
@@ -1984,10 +3935,37 @@ class TestCH5Basic(CH5TestBase):
         self.pos.get_class_color((1, 221, 3233, 44244))
         self.pos.get_class_name((1, 221, 3233, 44244))
 
+    def testClassLookup(self):
+        index = numpy.array([[1, 221], [3233, 10 ** 9]])
+        labels = self.pos.get_class_label(index)
+        self.assertEqual(labels.shape, index.shape)
+        self.assertEqual(labels[1, 1], CH5Const.UNPREDICTED_LABEL)
+        self.assertEqual(self.pos.get_class_color(10 ** 9), CH5Const.UNPREDICTED_COLOR)
+        self.assertEqual(self.pos.get_class_rgb(index).shape, index.shape + (3,))
+        self.assertListEqual(self.pos.get_class_name(index[0]), self.pos.class_name_def(labels[0], 'primary__primary'))
+
     def testEvents(self):
         self.assertTrue(len(self.pos.get_events()) > 0)
         self.assertTrue(len(self.pos.get_events()[0]) > 0)
 
+    def testEventDecoder(self):
+        decoder = CH5EventDecoder(self.pos.get_table('object/event'))
+        event_ids, branch, tracks, offsets = decoder.tracks()
+        first_branch = numpy.flatnonzero(branch == 0)
+        self.assertEqual(len(first_branch), len(self.pos.get_events()))
+        for k, track in zip(first_branch, self.pos.get_events()):
+            self.assertTrue(numpy.all(tracks[offsets[k]:offsets[k + 1]] == track))
+        self.assertEqual(len(branch), len(self.pos.get_events(output_second_branch=True)))
+
+    def testLineageForest(self):
+        forest = self.pos.get_lineage_forest()
+        for root in forest.roots()[:20]:
+            descendants = forest.descendants(root)
+            self.assertEqual(len(descendants) + 1, forest.size[root])
+            for leaf in forest.leaves(root):
+                self.assertEqual(forest.ancestors(leaf)[-1], root)
+                self.assertEqual(len(forest.ancestors(leaf)), forest.depth[leaf])
+
     def testTrack(self):
         self.assertTrue(len(self.pos.track_first(42)) > 0)
 
@@ -1999,10 +3977,110 @@ class TestCH5Basic(CH5TestBase):
         self.assertListEqual(self.pos.track_last(1111),
                              self.pos.track_all(1111)[-1])
 
+    def testCoalescedRead(self):
+        features = self.pos.get_object_features()
+        index = numpy.array([[40, 3], [3, 1000]])
+        for max_gap in (0, 10, 10000):
+            res = read_coalesced(self.pos['feature/primary__primary/object_features'], index, max_gap=max_gap)
+            self.assertTrue(numpy.all(res == features[index]))
+        time_idx = self.pos.get_object_table('primary__primary')['time_idx']
+        self.assertTrue(numpy.all(self.pos.get_time_indecies([40, 3, 3]) == time_idx[[40, 3, 3]]))
+
+    def testTableView(self):
+        table = self.pos.get_table('object/primary__primary')
+        full = self.pos['object/primary__primary'][()]
+        mask = full['time_idx'] == 3
+        self.assertEqual(table['time_idx'].dtype, full.dtype['time_idx'])
+        self.assertTrue(numpy.all(table[mask, 'obj_label_id'] == full['obj_label_id'][mask]))
+        self.assertTrue(numpy.all(table[10:20] == full[10:20]))
+
+    def testFrameIndex(self):
+        time_idx = self.pos.get_all_time_idx()
+        frame_index = self.pos.get_frame_index()
+        self.assertTrue(numpy.all(frame_index.counts() == numpy.bincount(time_idx)))
+        self.assertTrue(numpy.all(frame_index.objects_in_frame(3) == numpy.nonzero(time_idx == 3)[0]))
+        self.assertTrue(numpy.all(frame_index.objects_in_frames(2, 5) ==
+                                  numpy.nonzero((time_idx >= 2) & (time_idx < 5))[0]))
+        self.assertTrue(numpy.all(frame_index.objects_of([4, 1]) == numpy.nonzero(numpy.in1d(time_idx, [4, 1]))[0]))
+
+    def testDefinitions(self):
+        definitions = self.fh.get_definitions()
+        self.assertTrue(definitions is self.fh.get_definitions())
+        self.assertEqual(definitions.feature_names()[definitions.feature_index()['n2_avg']], 'n2_avg')
+        labels, names, colors = definitions.class_lut()
+        self.assertEqual(len(labels), len(self.fh.class_definition()))
+        self.assertEqual(self.pos.channel_color_by_region('primary__primary'), definitions.channels['color'][0])
+
+    def testTrackingGraph(self):
+        tracking = self.pos.get_tracking()
+        graph = self.pos.get_tracking_graph()
+        index = numpy.unique(tracking['obj_idx1'])[:50]
+        successors, offsets = graph.get_successors_many(index)
+        for k, i in enumerate(index):
+            self.assertTrue(numpy.all(successors[offsets[k]:offsets[k + 1]] ==
+                                      tracking['obj_idx2'][tracking['obj_idx1'] == i]))
+        self.assertTrue(numpy.all(graph.out_degree(index) == numpy.diff(offsets)))
+        self.assertTrue(numpy.all(graph.next_objects(index) == successors[offsets[:-1]]))
+
+    def testTrackMany(self):
+        start_idx = numpy.arange(0, 1000, 50)
+        tracks, offsets = self.pos.track_first_many(start_idx, max_length=20)
+        for k, i in enumerate(start_idx):
+            self.assertListEqual(list(tracks[offsets[k]:offsets[k + 1]]), self.pos.track_first(i, max_length=20))
+        tracks, offsets = self.pos.track_backwards_many(start_idx)
+        for k, i in enumerate(start_idx):
+            self.assertListEqual(list(tracks[offsets[k]:offsets[k + 1]]), self.pos.track_backwards(i))
+
     def testObjectFeature(self):
         self.assertTrue('n2_avg' in  self.pos.object_feature_def())
         self.assertTrue(self.pos.get_object_features().shape[1] == 239)
 
+    def testSidecarIndex(self):
+        index_file = CH5Index.index_filename(self.fh.filename)
+        fh = CH5File(self.fh.filename, 'r', index=True)
+        self.assertTrue(os.path.exists(index_file))
+        fh.close()
+        fh = CH5File(self.fh.filename, 'r', index=True)
+        pos = fh.get_position(self.well_str, self.pos_str)
+        self.assertEqual(pos.get_object_count(), self.pos.get_object_count())
+        self.assertEqual(pos.get_time_lapse(), self.pos.get_time_lapse())
+        self.assertTrue((fh.class_definition() == self.fh.class_definition()).all())
+        fh.close()
+        os.remove(index_file)
+
+    def testVirtualFile(self):
+        vf = CH5VirtualFile(os.path.dirname(self.fh.filename), check_reg=r'^0038\.ch5$')
+        pos = vf.get_position(self.well_str, self.pos_str)
+        self.assertEqual(pos.get_object_count(), self.pos.get_object_count())
+        self.assertListEqual(pos.track_first(42), self.pos.track_first(42))
+        vf.close()
+
+    def testCache(self):
+        CH5_CACHE.reset_statistics()
+        pos = CH5File(self.fh.filename, 'r').get_position(self.well_str, self.pos_str)
+        a = pos.get_object_features(index=numpy.arange(10))
+        b = pos.get_object_features(index=numpy.arange(10))
+        self.assertTrue(a is b)
+        stats = CH5_CACHE.statistics().loc['CH5CachedPosition.get_object_features']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        pos.clear_cache()
+        self.assertFalse(pos.get_object_features(index=numpy.arange(10)) is a)
+
+        CH5_CACHE.set_max_bytes(a.nbytes)
+        pos.get_object_features(index=numpy.arange(5))
+        self.assertTrue(CH5_CACHE.nbytes <= a.nbytes)
+        CH5_CACHE.set_max_bytes(CH5Cache.DEFAULT_MAX_BYTES)
+
+    def testLazyPositions(self):
+        fh = CH5File(self.fh.filename, 'r')
+        self.assertEqual(len(fh._position_group), 0)
+        self.assertTrue(fh.has_position(self.well_str, self.pos_str))
+        pos = fh.get_position(self.well_str, self.pos_str)
+        self.assertTrue(pos is fh.get_position(self.well_str, self.pos_str))
+        self.assertEqual(len(fh._position_group), 1)
+        self.assertEqual(len(list(fh.iter_positions())), len(fh.get_coordinates()))
+        fh.close()
+
 class TestCH5Write(CH5TestBase):
     """Write unit tests"""
     def testSimpleWrite(self):
@@ -2107,6 +4185,42 @@ class TestCH5Examples(CH5TestBase):
         ax.legend(loc='upper left')
         fig.savefig('mitotic_index.pdf', format='pdf')
 
+    def testClassCounts(self):
+        nucleus = self.pos.get_object_table('primary__primary')
+        row = [(c.well, c.site) for c in self.fh.get_coordinates()].index((self.well_str, self.pos_str))
+        counts = self.fh.get_class_counts().counts[row]
+        labels = self.pos.get_class_label_index(numpy.arange(len(nucleus)))
+        for time_idx in (0, 10, 50):
+            x = labels[nucleus['time_idx'] == time_idx]
+            self.assertListEqual(list(counts[time_idx, :-1]), [len(numpy.nonzero(x == c)[0]) for c in range(counts.shape[1] - 1)])
+
+    def testEventCatalog(self):
+        catalog = self.fh.get_event_catalog()
+        selection = catalog.select(onset_window=(10, 50), min_length=5, branch=0)
+        self.assertTrue(numpy.all((selection.events['onset'] >= 10) & (selection.events['onset'] <= 50)))
+        self.assertTrue(numpy.all(selection.events['length'] >= 5))
+        self.assertEqual(len(selection.tracks()), len(selection))
+        self.assertEqual(len(selection.get_class_labels()), len(selection.objects))
+
+    def testTrackFeatures(self):
+        tracks = self.pos.get_events()[:5]
+        features = self.pos.get_object_features()
+        cube, origin = self.pos.get_track_features(tracks, ['roisize'], align=2)
+        self.assertEqual(origin, 2)
+        self.assertEqual(cube.shape[0], len(tracks))
+        column = self.fh.get_object_feature_idx_by_name('primary__primary', 'roisize')
+        for k, track in enumerate(tracks):
+            self.assertEqual(cube[k, origin, 0], features[track[2], column])
+
+    def testViterbiDecoder(self):
+        est = HMMAgnosticEstimator(3, normalize(numpy.eye(3) + 0.1, axis=1), numpy.eye(3) + 0.01, numpy.ones((3, )))
+        decoder = HMMViterbiDecoder.from_estimator(est)
+        states = decoder.predict_tracks([[0, 0, 1, 1, 2], [], [2, 2]])
+        self.assertEqual([list(s) for s in states], [[0, 0, 1, 1, 2], [], [2, 2]])
+        flat, offsets = decoder.decode([[0, 1, 2], [1, 0, 0]], [3, 1])
+        self.assertEqual(list(flat), [0, 1, 2, 1])
+        self.assertEqual(list(offsets), [0, 3, 4])
+
     def testShowMitoticEvents(self):
         """Extract the mitotic events and write them as gellery images"""
         events = self.pos.get_events()
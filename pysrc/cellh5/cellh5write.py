@@ -11,6 +11,8 @@
 
 import sys
 import os
+import zlib
+import base64
 import numpy
 import h5py
 import pandas
@@ -20,12 +22,13 @@ import unittest
 import functools
 import collections
 
+import itertools
 from itertools import chain
 from collections import OrderedDict
 from contextlib import contextmanager
 
 # from . 
-from cellh5 import CH5PositionCoordinate, CH5Const, CH5File, CH5Position
+from cellh5 import CH5PositionCoordinate, CH5Const, CH5File, CH5Position, repack_positions
 
 import logging
 
@@ -85,12 +88,142 @@ class CH5ImageRegionDefinition(CH5PositionDescription):
         super().__init__()
 
 
+class CH5ImageLayout(object):
+    """Chunking and compression of the 5D image datasets.
+
+       tile: (y, x) extent of the chunks, None for whole image planes, with a
+             chunk extent of 1 along c, t and z. No chunking at all, if
+             tile is False (contiguous layout, no compression possible)
+       compression, compression_opts, shuffle: HDF5 filter, see h5py.create_dataset
+    """
+    def __init__(self, tile=None, compression=None, compression_opts=None, shuffle=False):
+        self.tile = tile
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+
+    def chunks(self, shape, order=CH5Const.DEFAULT_IMAGE_ORDER):
+        if self.tile is False:
+            return None
+        chunks = []
+        for d, n in zip(order, shape):
+            if d == "y" and self.tile is not None:
+                chunks.append(min(self.tile[0], n))
+            elif d == "x" and self.tile is not None:
+                chunks.append(min(self.tile[1], n))
+            elif d in "yx":
+                chunks.append(n)
+            else:
+                chunks.append(1)
+        return tuple(max(1, c) for c in chunks)
+
+    def dataset_kwargs(self, shape, order=CH5Const.DEFAULT_IMAGE_ORDER):
+        chunks = self.chunks(shape, order)
+        if chunks is None:
+            return {}
+        return dict(chunks=chunks, compression=self.compression,
+                    compression_opts=self.compression_opts, shuffle=self.shuffle)
+
+IMAGE_LAYOUTS = {
+    # unchunked, uncompressed (default)
+    'contiguous': CH5ImageLayout(tile=False),
+    # one chunk per image plane, for full frame viewing
+    'plane': CH5ImageLayout(compression='gzip', compression_opts=4, shuffle=True),
+    'plane_lzf': CH5ImageLayout(compression='lzf', shuffle=True),
+    # tiles, for gallery crops
+    'tile': CH5ImageLayout(tile=(256, 256), compression='gzip', compression_opts=4, shuffle=True),
+    'tile_lzf': CH5ImageLayout(tile=(256, 256), compression='lzf', shuffle=True),
+}
+
+def get_image_layout(layout):
+    """CH5ImageLayout of a profile name (see IMAGE_LAYOUTS), None for the default"""
+    if layout is None:
+        layout = 'contiguous'
+    if isinstance(layout, CH5ImageLayout):
+        return layout
+    try:
+        return IMAGE_LAYOUTS[layout]
+    except KeyError:
+        raise ValueError("Unknown image layout '%s', use one of %s" % (layout, ", ".join(sorted(IMAGE_LAYOUTS))))
+
+
+def _deflate_chunk(data, shuffle, level):
+    # same byte stream as the HDF5 shuffle and deflate filters
+    if shuffle and data.dtype.itemsize > 1:
+        data = data.view(numpy.uint8).reshape(-1, data.dtype.itemsize).T
+    return zlib.compress(numpy.ascontiguousarray(data).tobytes(), level)
+
+class CH5ChunkCompressor(object):
+    """Compresses whole chunks of gzip datasets in a thread pool (zlib releases
+       the GIL) and writes them with h5py's direct chunk write. The files are
+       identical in format to ones written through the HDF5 filter pipeline.
+
+       n_workers: number of compressing threads, None for one per CPU
+    """
+    def __init__(self, n_workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self.n_workers)
+        self._pending = collections.deque()
+
+    @staticmethod
+    def supports(dset):
+        """True, if the only filters of dset are (shuffle and) gzip"""
+        return dset.chunks is not None and dset.compression == 'gzip' and \
+            not dset.fletcher32 and dset.scaleoffset is None
+
+    def write_chunk(self, dset, offset, data):
+        """Compress and write the chunk of dset starting at offset, data is
+           zero padded to the chunk shape at the dataset edges"""
+        data = numpy.asarray(data, dtype=dset.dtype)
+        if data.shape != dset.chunks:
+            padded = numpy.zeros(dset.chunks, dtype=dset.dtype)
+            padded[tuple(slice(0, n) for n in data.shape)] = data
+            data = padded
+        future = self._pool.submit(_deflate_chunk, numpy.ascontiguousarray(data), dset.shuffle,
+                                   dset.compression_opts)
+        self._pending.append((dset, tuple(int(o) for o in offset), future))
+        while len(self._pending) > 2 * self.n_workers:
+            self._write_next()
+
+    def _write_next(self):
+        dset, offset, future = self._pending.popleft()
+        dset.id.write_direct_chunk(offset, future.result())
+
+    def flush(self):
+        while len(self._pending) > 0:
+            self._write_next()
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown()
+
+
 class CH5FileWriter(CH5File):
+    """Writer of a cellh5 file. Row writers buffer up to buffer_size rows
+       in memory, close() finalizes all writers not finalized yet.
+
+       compression_workers: compress the chunks of gzip image and feature
+                            matrix datasets in that many threads (None for one
+                            per CPU), 0 leaves compression to the HDF5 library
+       swmr: stream the file to readers while it is written. After all
+             datasets are created, start_swmr() switches to single-writer/
+             multiple-reader mode, then each completed frame is made visible
+             with CH5PositionWriter.publish_frame
+    """
 
     def __init__(self, filename, sister_file=None, plate_layout=None, mode="w",
-                 cached=False):
+                 cached=False, buffer_size=4096, compression_workers=0, swmr=False):
+        if swmr:
+            # SWMR needs the latest file format
+            filename = h5py.File(filename, mode, libver="latest")
         super().__init__(filename, mode, cached)
         self._f = self._file_handle
+        self.swmr = swmr
+        self.buffer_size = buffer_size
+        self.compressor = CH5ChunkCompressor(compression_workers) if compression_workers != 0 else None
+        self._writers = []
+        self._position_writers = []
         self._init_basic_structure()
 
     def __enter__(self):
@@ -99,7 +232,31 @@ class CH5FileWriter(CH5File):
     def __exit__(self, type, value, traceback):
         self.close()
 
+    def register_writer(self, writer):
+        self._writers.append(writer)
+
+    def start_swmr(self):
+        """Switch to single-writer/multiple-reader mode. No datasets can be
+           created afterwards, so all writers need to be added before. The
+           row counts of their tables are logged per published frame."""
+        if not self.swmr:
+            raise ValueError("CH5FileWriter: open the file with swmr=True to stream it")
+        for pos_writer in self._position_writers:
+            pos_writer._init_publication_log()
+        self._f.swmr_mode = True
+
     def close(self):
+        for writer in self._writers:
+            if not writer.finished:
+                writer.finalize()
+        if self._f.swmr_mode:
+            for pos_writer in self._position_writers:
+                pos_writer._publish(CH5Const.STREAM_CLOSED)
+        self._writers = []
+        self._position_writers = []
+        if self.compressor is not None:
+            self.compressor.close()
+            self.compressor = None
         self._f.close()
 
     @staticmethod
@@ -125,34 +282,72 @@ class CH5FileWriter(CH5File):
         pos_grp.require_group(CH5Const.OBJECT)
         pos_grp.require_group(CH5Const.FEATURE)
 
-        return CH5PositionWriter(coord, path_to_grp, self)
+        pos_writer = CH5PositionWriter(coord, path_to_grp, self)
+        self._position_writers.append(pos_writer)
+        return pos_writer
 
 class CH5PositionWriter(CH5Position):
     def __init__(self, coord, pos_grp, parent):
         super().__init__(coord.plate, coord.well, coord.site, pos_grp, parent)
-
-    def add_image(self, data=None, shape=None, dtype=None, order=CH5Const.DEFAULT_IMAGE_ORDER):
-        if data is not None:
-            assert len(data.shape) == 5, "Image data must be 5-dimensional"
-            self.get_group(CH5Const.IMAGE).create_dataset(CH5Const.RAW_IMAGE, data=data)
-            return
-
-        elif shape is not None and dtype is not None:
-            assert len(shape) == 5, "Image data must be 5-dimensional"
-            img_dset = self.get_group(CH5Const.IMAGE).create_dataset(CH5Const.RAW_IMAGE, shape=shape, dtype=dtype)
-            return CH5ImageWriter(img_dset, order, self)
-        else:
-            raise ValueError("Specify data, or shape and dtype")
-
-    def add_label_image(self, data=None, shape=None, dtype=None, order=CH5Const.DEFAULT_IMAGE_ORDER):
+        self._publication_log = None
+        self._logged_writers = []
+
+    def _get_writers(self):
+        return [w for w in self.definitions._writers if w.parent_pos is self]
+
+    def _init_publication_log(self):
+        self._logged_writers = [w for w in self._get_writers() if w.offset is not None]
+        n_columns = 1 + len(self._logged_writers)
+        self._publication_log = self.get_group().create_dataset(
+            CH5Const.PUBLISHED, shape=(0, n_columns), dtype=numpy.int64,
+            maxshape=(None, n_columns), chunks=(256, n_columns))
+        paths = [w.dset.name[len(self.grp_pos_path) + 1:] for w in self._logged_writers]
+        self._publication_log.attrs["tables"] = numpy.array(paths, dtype=bytes)
+
+    def publish_frame(self, t):
+        """Make everything written so far visible to readers as frame t. The
+           frame appears in the publication log after all its rows and images
+           are flushed, so readers see it completely or not at all."""
+        if self._publication_log is None:
+            raise ValueError("CH5PositionWriter: not streaming, call CH5FileWriter.start_swmr() first")
+        self._publish(t)
+
+    def _publish(self, t):
+        writers = self._get_writers()
+        for writer in writers:
+            if writer.offset is not None:
+                writer.flush()
+        compressor = self.definitions.compressor
+        if compressor is not None:
+            compressor.flush()
+        for writer in writers:
+            if writer.dset is not None:
+                writer.dset.flush()
+
+        n = len(self._publication_log)
+        self._publication_log.resize(n + 1, axis=0)
+        self._publication_log[n] = [t] + [w.offset for w in self._logged_writers]
+        self._publication_log.flush()
+
+    def add_image(self, data=None, shape=None, dtype=None, order=CH5Const.DEFAULT_IMAGE_ORDER, layout=None):
+        """Raw image dataset, written at once from data or plane by plane through
+           the returned CH5ImageWriter. layout: profile name or CH5ImageLayout"""
+        return self._add_image_dataset(CH5Const.RAW_IMAGE, data, shape, dtype, order, layout)
+
+    def add_label_image(self, data=None, shape=None, dtype=None, order=CH5Const.DEFAULT_IMAGE_ORDER, layout=None):
+        return self._add_image_dataset(CH5Const.LABEL_IMAGE, data, shape, dtype, order, layout)
+
+    def _add_image_dataset(self, name, data, shape, dtype, order, layout):
+        layout = get_image_layout(layout)
         if data is not None:
             assert len(data.shape) == 5, "Image data must be 5-dimensional"
-            self.get_group(CH5Const.IMAGE).create_dataset(CH5Const.LABEL_IMAGE, data=data)
+            self.get_group(CH5Const.IMAGE).create_dataset(name, data=data, **layout.dataset_kwargs(data.shape, order))
             return
 
         elif shape is not None and dtype is not None:
             assert len(shape) == 5, "Image data must be 5-dimensional"
-            img_dset = self.get_group(CH5Const.IMAGE).create_dataset(CH5Const.LABEL_IMAGE, shape=shape, dtype=dtype)
+            img_dset = self.get_group(CH5Const.IMAGE).create_dataset(name, shape=shape, dtype=dtype,
+                                                                     **layout.dataset_kwargs(shape, order))
             return CH5ImageWriter(img_dset, order, self)
         else:
             raise ValueError("Specify data, or shape and dtype")
@@ -186,20 +381,125 @@ class CH5PositionWriter(CH5Position):
         obj_feat_grp = feat_grp.require_group(object_name)
         return CH5FeatureMatrixWriter(feature_name, object_name, obj_feat_grp, n_features, dtype, self)
 
+    def add_tracking(self, object_name='primary__primary'):
+        return CH5TrackingWriter(object_name, self.get_group(CH5Const.OBJECT), self)
+
+    def add_events(self, object_name='primary__primary'):
+        return CH5EventWriter(object_name, self.get_group(CH5Const.OBJECT), self)
+
+    def add_object_classification(self, object_name='primary__primary'):
+        obj_feat_grp = self.get_group(CH5Const.FEATURE).require_group(object_name)
+        return CH5ClassificationWriter(object_name, obj_feat_grp, self)
+
+    def add_crack_contour(self, object_name='primary__primary'):
+        obj_feat_grp = self.get_group(CH5Const.FEATURE).require_group(object_name)
+        return CH5CrackContourWriter(object_name, obj_feat_grp, self)
+
 class CH5PositionWriterBase(object):
+    # dataset written, and the number of rows appended for row writers
+    dset = None
+    offset = None
+
     def __init__(self, parent_pos):
         self.parent_pos = parent_pos
         self.finished = False
+        parent_pos.definitions.register_writer(self)
 
     def finalize(self):
         self.finished = True
 
+    def _init_rows(self, dset, offset):
+        # rows are appended through a memory buffer, which is written in
+        # blocks ending on chunk boundaries, while the dataset capacity grows
+        # geometrically; offset counts all rows appended, buffered or not
+        self.dset = dset
+        self.offset = offset
+        self._n_flushed = offset
+        self._buffer = []
+        self._n_buffered = 0
+        self.buffer_size = self.parent_pos.definitions.buffer_size
+
+    def _append_rows(self, rows):
+        self._buffer.append(rows)
+        self._n_buffered += len(rows)
+        self.offset += len(rows)
+        if self._n_buffered >= self.buffer_size:
+            self.flush(aligned=True)
+
+    def flush(self, aligned=False):
+        """Write the buffered rows, only up to the last complete chunk if aligned"""
+        if self._n_buffered == 0:
+            return
+        stop = self._n_flushed + self._n_buffered
+        if aligned:
+            chunk = self.dset.chunks[0] if self.dset.chunks else 1
+            stop = stop // chunk * chunk
+            if stop <= self._n_flushed:
+                return
+
+        capacity = self.dset.shape[0]
+        if stop > capacity:
+            chunk = self.dset.chunks[0] if self.dset.chunks else 1
+            capacity = max(stop, 2 * capacity)
+            self.dset.resize(-(-capacity // chunk) * chunk, axis=0)
+
+        rows = numpy.concatenate(self._buffer) if len(self._buffer) > 1 else self._buffer[0]
+        n = stop - self._n_flushed
+        self._write_rows(self._n_flushed, rows[:n])
+        self._n_flushed = stop
+        self._buffer = [rows[n:]] if n < len(rows) else []
+        self._n_buffered = len(rows) - n
+
+    def _write_rows(self, start, rows):
+        self.dset[start:start + len(rows)] = rows
+
+    def _finalize_rows(self):
+        self.flush()
+        compressor = self.parent_pos.definitions.compressor
+        if compressor is not None:
+            compressor.flush()
+        self.dset.resize(self.offset, axis=0)
+
     def write(self, *args, **kwargs):
         raise NotImplementedError("Abstract method")
 
     def write_definition(self, *args, **kwargs):
         raise NotImplementedError("Abstract method")
 
+    def _get_definition_group(self, *path):
+        grp = self.parent_pos.definitions.get_definition_root()
+        for name in path:
+            grp = grp.require_group(name)
+        return grp
+
+    def _write_object_definition(self, name, type_, source1='', source2=''):
+        # definitions are shared by all positions, written once
+        obj_def_grp = self._get_definition_group(CH5Const.OBJECT)
+        if name not in obj_def_grp:
+            obj_def_grp.create_dataset(name, data=numpy.array([(name, type_, source1, source2)], dtype=OBJECT_DEFINITION_DTYPE))
+
+class CH5RowWriter(CH5PositionWriterBase):
+    """Buffered writer appending rows to a (new or existing) dataset of grp"""
+    init_size = 10000
+    compression = "gzip"
+    def __init__(self, name, grp, dtype, parent_pos, row_shape=()):
+        super().__init__(parent_pos)
+        self.name = name
+        if name in grp:
+            self._init_rows(grp[name], len(grp[name]))
+        else:
+            compression = None if h5py.check_dtype(vlen=numpy.dtype(dtype)) is not None else self.compression
+            self._init_rows(grp.create_dataset(name, shape=(self.init_size,) + tuple(row_shape), dtype=dtype,
+                                               maxshape=(None,) + tuple(row_shape),
+                                               chunks=(self.init_size,) + tuple(row_shape), compression=compression), 0)
+
+    def write(self, rows):
+        self._append_rows(rows)
+
+    def finalize(self):
+        self._finalize_rows()
+        super(CH5RowWriter, self).finalize()
+
 class CH5ImageWriter(CH5PositionWriterBase):
     def __init__(self, dset, order, parent_pos):
         super().__init__(parent_pos)
@@ -212,7 +512,8 @@ class CH5ImageWriter(CH5PositionWriterBase):
 
     def insert_image(self, img, c, z, t):
         slices = []
-        for d in self.order:
+        plane_shape = []
+        for d, n in zip(self.order, self.dset.shape):
             if d == "c":
                 slices.append(c)
             elif d == "t":
@@ -221,13 +522,47 @@ class CH5ImageWriter(CH5PositionWriterBase):
                 slices.append(z)
             else:
                 slices.append(slice(None))
-
-        self.dset[tuple(slices)] = img
+                plane_shape.append(n)
+
+        if self.dset.chunks is not None:
+            # whole planes only: with one plane per chunk along c, t and z every
+            # chunk touched is written completely and compressed exactly once
+            img = numpy.asarray(img, dtype=self.dset.dtype)
+            if img.shape != tuple(plane_shape):
+                raise ValueError("Image of shape %s does not match the image plane %s" % (img.shape, tuple(plane_shape)))
+            compressor = self.parent_pos.definitions.compressor
+            if compressor is not None and compressor.supports(self.dset) and \
+                    all(n == 1 for d, n in zip(self.order, self.dset.chunks) if d in "ctz"):
+                self._write_plane_chunks(compressor, img, slices)
+            else:
+                self.dset.write_direct(numpy.ascontiguousarray(img), dest_sel=tuple(slices))
+        else:
+            self.dset[tuple(slices)] = img
 
         # write object information
         self.image_wide_object_writer.write(t, c, z)
         log.debug("CH5ImageWriter: inserted image c=%d t=%d z=%d..." % (c,t,z))
 
+    def finalize(self):
+        if not self.image_wide_object_writer.finished:
+            self.image_wide_object_writer.finalize()
+        if self.parent_pos.definitions.compressor is not None:
+            self.parent_pos.definitions.compressor.flush()
+        super(CH5ImageWriter, self).finalize()
+
+    def _write_plane_chunks(self, compressor, img, slices):
+        plane_axes = [i for i, s in enumerate(slices) if isinstance(s, slice)]
+        tiles = [range(0, self.dset.shape[i], self.dset.chunks[i]) for i in plane_axes]
+        chunk_shape = [self.dset.chunks[i] for i in plane_axes]
+        for starts in itertools.product(*tiles):
+            tile = img[tuple(slice(s, s + n) for s, n in zip(starts, chunk_shape))]
+            offset = list(slices)
+            shape = [1] * len(slices)
+            for i, s, n in zip(plane_axes, starts, tile.shape):
+                offset[i] = s
+                shape[i] = n
+            compressor.write_chunk(self.dset, offset, tile.reshape(shape))
+
     def write(self, *args, **kwargs):
         self.insert_image(*args, **kwargs)
 
@@ -243,11 +578,9 @@ class CH5ObjectWriter(CH5PositionWriterBase):
         self.name = name
         self.obj_grp = obj_grp
         if self.name in list(self.obj_grp.keys()):
-            self.dset = self.obj_grp[self.name]
-            self.offset = len(self.dset)
+            self._init_rows(self.obj_grp[self.name], len(self.obj_grp[self.name]))
         else:
-            self.dset = self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,), chunks=(self.init_size,), compression=compression)
-            self.offset = 0
+            self._init_rows(self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,), chunks=(self.init_size,), compression=compression), 0)
 
     def write(self, *args, **kwargs):
         raise NotImplementedError("Abstract method")
@@ -260,19 +593,10 @@ class CH5RegionWriter(CH5ObjectWriter):
 
 
     def write(self, t, object_labels):
-        if len(object_labels) + self.offset > len(self.dset) :
-            # resize
-            self.dset.resize((len(object_labels) + self.offset,))
-
-
-        object_labels = object_labels.astype(numpy.int32)
-        times = numpy.repeat(t, len(object_labels))
-
-        self.dset[self.offset:self.offset+len(object_labels)] = \
-            (numpy.c_[times, object_labels]).astype(numpy.int32).view(
-                dtype=self.dtype).T
-
-        self.offset+=len(object_labels)
+        rows = numpy.empty(len(object_labels), dtype=self.dtype)
+        rows['time_idx'] = t
+        rows['obj_label_id'] = object_labels
+        self._append_rows(rows)
 
     def write_definition(self):
         img_def_grp = self.parent_pos.definitions.get_definition_root().require_group(CH5Const.OBJECT)
@@ -280,7 +604,7 @@ class CH5RegionWriter(CH5ObjectWriter):
         def_dset[0] = [(self.name, 'region', '', '')]
 
     def finalize(self):
-        self.dset.resize((self.offset,))
+        self._finalize_rows()
         super(CH5RegionWriter, self).finalize()
 
 
@@ -289,18 +613,10 @@ class CH5FeatureCompoundWriter(CH5PositionWriterBase):
     def __init__(self, object_name, obj_grp, parent_pos):
         super().__init__(parent_pos)
         self.obj_grp = obj_grp
-        self.offset = 0
         self.object_name = object_name
 
     def write(self, data):
-        if len(data) + self.offset > len(self.dset) :
-            # resize
-            self.dset.resize((len(data) + self.offset,))
-
-        self.dset[self.offset:self.offset+len(data)] = \
-            data.astype(numpy.int32).view(dtype=self.dtype)[:,0]
-
-        self.offset+=len(data)
+        self._append_rows(numpy.ascontiguousarray(data, dtype=numpy.int32).view(dtype=self.dtype)[:, 0])
 
     def write_definition(self, column_names=None):
         if column_names is None:
@@ -315,7 +631,7 @@ class CH5FeatureCompoundWriter(CH5PositionWriterBase):
             def_dset[:] = numpy.array(column_names)
 
     def finalize(self):
-        self.dset.resize((self.offset,))
+        self._finalize_rows()
         super(CH5FeatureCompoundWriter, self).finalize()
 
 class CH5BoundingBoxWriter(CH5FeatureCompoundWriter):
@@ -323,7 +639,7 @@ class CH5BoundingBoxWriter(CH5FeatureCompoundWriter):
     def __init__(self, object_name, obj_grp, parent_pos):
         super().__init__(object_name, obj_grp, parent_pos)
         self.name = "bounding_box"
-        self.dset = self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,))
+        self._init_rows(self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,)), 0)
 
 
 class CH5CenterWriter(CH5FeatureCompoundWriter):
@@ -331,7 +647,7 @@ class CH5CenterWriter(CH5FeatureCompoundWriter):
     def __init__(self, object_name, obj_grp, parent_pos):
         super().__init__(object_name, obj_grp, parent_pos)
         self.name = "center"
-        self.dset = self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,))
+        self._init_rows(self.obj_grp.create_dataset(self.name, shape=(self.init_size,), dtype=self.dtype, maxshape=(None,)), 0)
 
 class CH5FeatureMatrixWriter(CH5PositionWriterBase):
     init_size = 10000
@@ -342,25 +658,28 @@ class CH5FeatureMatrixWriter(CH5PositionWriterBase):
 
 
         if self.name in list(self.obj_grp.keys()):
-            self.dset = self.obj_grp[self.name]
-            self.offset = self.dset.shape[0]
+            self._init_rows(self.obj_grp[self.name], self.obj_grp[self.name].shape[0])
         else:
-            self.dset = self.obj_grp.create_dataset(self.name, shape=(self.init_size, n_features), chunks=(self.init_size, n_features), dtype=dtype, maxshape=(None, n_features), compression=compression)
-            self.offset = 0
+            self._init_rows(self.obj_grp.create_dataset(self.name, shape=(self.init_size, n_features), chunks=(self.init_size, n_features), dtype=dtype, maxshape=(None, n_features), compression=compression), 0)
 
         self.dtype = dtype
         self.object_name = object_name
         self.n_features = n_features
 
     def write(self, data):
-        if data.shape[0] + self.offset > self.dset.shape[0]:
-            # resize
-            self.dset.resize(data.shape[0] + self.offset, axis=0)
-
-
-        self.dset[self.offset:self.offset+len(data), :] = data
-
-        self.offset+=len(data)
+        self._append_rows(numpy.asarray(data, dtype=self.dset.dtype).reshape(-1, self.n_features))
+
+    def _write_rows(self, start, rows):
+        compressor = self.parent_pos.definitions.compressor
+        chunk = self.dset.chunks[0] if self.dset.chunks is not None else 0
+        if compressor is None or not compressor.supports(self.dset) or start % chunk != 0 or \
+                self.dset.chunks[1] != self.n_features:
+            if compressor is not None:
+                # a queued chunk (zero padded at the end) may overlap these rows
+                compressor.flush()
+            return super(CH5FeatureMatrixWriter, self)._write_rows(start, rows)
+        for a in range(0, len(rows), chunk):
+            compressor.write_chunk(self.dset, (start + a, 0), rows[a:a + chunk])
 
     def write_definition(self, column_names=None):
         if column_names is None:
@@ -375,9 +694,134 @@ class CH5FeatureMatrixWriter(CH5PositionWriterBase):
             def_dset[:] = numpy.array(column_names)
 
     def finalize(self):
-        self.dset.resize(self.offset, axis=0)
+        self._finalize_rows()
         super(CH5FeatureMatrixWriter, self).finalize()
 
+OBJECT_DEFINITION_DTYPE = numpy.dtype([('name', '|S512'), ('type', '|S512'), ('source1', '|S512'), ('source2', '|S512')])
+
+class CH5TrackingWriter(CH5RowWriter):
+    """Tracking edges (object index pairs) of a position"""
+    dtype = numpy.dtype([('obj_idx1', 'uint32'), ('obj_idx2', 'uint32')])
+    def __init__(self, object_name, obj_grp, parent_pos):
+        super().__init__("tracking", obj_grp, self.dtype, parent_pos)
+        self.object_name = object_name
+
+    def write(self, idx1, idx2):
+        """Edges from objects idx1 to idx2, e. g. all edges into one frame"""
+        rows = numpy.empty(len(idx1), dtype=self.dtype)
+        rows['obj_idx1'] = idx1
+        rows['obj_idx2'] = idx2
+        self._append_rows(rows)
+
+    def write_definition(self):
+        self._write_object_definition(self.name, 'relation', self.object_name, self.object_name)
+
+class CH5EventWriter(CH5RowWriter):
+    """Event table of a position, the edges of each event's tracks"""
+    dtype = numpy.dtype([('obj_id', 'uint32'), ('idx1', 'uint32'), ('idx2', 'uint32')])
+    def __init__(self, object_name, obj_grp, parent_pos):
+        super().__init__("event", obj_grp, self.dtype, parent_pos)
+        self.object_name = object_name
+
+    def write(self, event_id, idx1, idx2):
+        rows = numpy.empty(len(idx1), dtype=self.dtype)
+        rows['obj_id'] = event_id
+        rows['idx1'] = idx1
+        rows['idx2'] = idx2
+        self._append_rows(rows)
+
+    def write_tracks(self, event_ids, tracks):
+        """Events given as object index paths, one per track. Tracks of the
+           same event (e.g. both daughters after a split) share their prefix,
+           edges are written once per event."""
+        if len(tracks) == 0:
+            return
+        flat = numpy.concatenate([numpy.asarray(t, dtype=numpy.int64) for t in tracks])
+        lengths = numpy.array([len(t) for t in tracks], dtype=numpy.int64)
+        ends = numpy.cumsum(lengths)
+        # all consecutive pairs, except across track boundaries
+        first = numpy.ones(len(flat), dtype=bool)
+        first[ends[lengths > 0] - 1] = False
+        first = numpy.flatnonzero(first[:-1]) if len(flat) > 0 else numpy.zeros((0,), dtype=numpy.int64)
+        eids = numpy.repeat(numpy.asarray(event_ids, dtype=numpy.int64), lengths)[first]
+        edges = numpy.c_[eids, flat[first], flat[first + 1]]
+        _, keep = numpy.unique(edges, axis=0, return_index=True)
+        keep.sort()
+        self.write(edges[keep, 0], edges[keep, 1], edges[keep, 2])
+
+    def write_definition(self):
+        self._write_object_definition(self.name, 'object', 'tracking', '')
+
+class CH5ClassificationWriter(CH5PositionWriterBase):
+    """Class predictions (rows of the class definition) and optionally the
+       class probabilities of the objects of a position"""
+    prediction_dtype = numpy.dtype([('label_idx', 'int32')])
+    def __init__(self, object_name, obj_grp, parent_pos):
+        super().__init__(parent_pos)
+        self.object_name = object_name
+        self.grp = obj_grp.require_group("object_classification")
+        self.prediction = CH5RowWriter("prediction", self.grp, self.prediction_dtype, parent_pos)
+        self.probability = None
+
+    def write(self, label_idx, probability=None):
+        rows = numpy.empty(len(label_idx), dtype=self.prediction_dtype)
+        rows['label_idx'] = label_idx
+        self.prediction.write(rows)
+        if probability is not None:
+            probability = numpy.asarray(probability, dtype=numpy.float64)
+            if self.probability is None:
+                self.probability = CH5RowWriter("probability", self.grp, numpy.float64, self.parent_pos,
+                                                row_shape=probability.shape[1:])
+            self.probability.write(probability)
+
+    def write_definition(self, labels, names, colors):
+        """Class labels, names and colors ('#RRGGBB') of the classifier"""
+        grp = self._get_definition_group(CH5Const.FEATURE, self.object_name, "object_classification")
+        if "class_labels" not in grp:
+            table = numpy.empty(len(labels), dtype=[('label', 'int32'), ('name', '|S50'), ('color', '|S7')])
+            table['label'] = labels
+            table['name'] = names
+            table['color'] = colors
+            grp.create_dataset("class_labels", data=table)
+
+    def finalize(self):
+        for writer in (self.prediction, self.probability):
+            if writer is not None and not writer.finished:
+                writer.finalize()
+        super(CH5ClassificationWriter, self).finalize()
+
+def encode_crack_contours(points, offsets):
+    """Crack contour strings (base64 of zlib compressed 'x1,y1,x2,y2,...')
+       of the ragged array points[offsets[i]:offsets[i + 1]] of (x, y) pairs"""
+    points = numpy.asarray(points)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    numbers = points.reshape(-1).astype(str)
+    if len(numbers) == 0:
+        return numpy.array([base64.b64encode(zlib.compress(b''))] * (len(offsets) - 1), dtype=object)
+    # format all numbers at once and cut the joined string at the contour ends
+    text = ','.join(numbers).encode()
+    ends = numpy.r_[0, numpy.cumsum(numpy.char.str_len(numbers) + 1)]
+    bounds = ends[2 * offsets]
+    return numpy.array([base64.b64encode(zlib.compress(text[a:max(a, b - 1)]))
+                        for a, b in zip(bounds[:-1], bounds[1:])], dtype=object)
+
+class CH5CrackContourWriter(CH5RowWriter):
+    """Crack contours (outlines) of the objects of a position"""
+    def __init__(self, object_name, obj_grp, parent_pos):
+        super().__init__("crack_contour", obj_grp, h5py.special_dtype(vlen=bytes), parent_pos)
+        self.object_name = object_name
+
+    def write(self, contours, offsets=None):
+        """Contours as list of (n, 2) arrays of (x, y), or flat points with offsets"""
+        if offsets is None:
+            offsets = numpy.r_[0, numpy.cumsum([len(c) for c in contours])]
+            contours = numpy.concatenate([numpy.asarray(c).reshape(-1, 2) for c in contours]) \
+                if len(contours) > 0 else numpy.zeros((0, 2), dtype=numpy.int32)
+        self._append_rows(encode_crack_contours(contours, offsets))
+
+    def write_definition(self):
+        pass
+
 class CH5Validator(CH5File):
     pass
 
@@ -397,9 +841,50 @@ class CH5MasterFile(h5py.File):
             # link to definition is already there
             print("Link to path '%s' already exists" % path)
 
-    def repack(self):
-        # do repacking
-        pass
+    def get_linked_positions(self):
+        """Return (coordinate, (filename, path)) for all positions linked
+           into the master file"""
+        links = []
+        plate_grp = self.get('/%s/%s' % (CH5Const.PREFIX, CH5Const.PLATE))
+        if plate_grp is None:
+            return links
+        for plate in plate_grp:
+            for well in plate_grp[plate][CH5Const.WELL]:
+                pos_grp = plate_grp[plate][CH5Const.WELL][well][CH5Const.SITE]
+                for site in pos_grp:
+                    link = pos_grp.get(site, getlink=True)
+                    if isinstance(link, h5py.ExternalLink):
+                        links.append((CH5PositionCoordinate(plate, well, site),
+                                      (self._resolve_link_file(link.filename), link.path)))
+        return links
+
+    def _resolve_link_file(self, filename):
+        # HDF5 resolves relative links next to the master file
+        if os.path.isabs(filename):
+            return filename
+        return os.path.join(os.path.dirname(os.path.abspath(self.filename)), filename)
+
+    def repack(self, output_file=None, n_workers=None, **kwargs):
+        """Copy all externally linked positions and definitions into one
+           self-contained file (default: <master>_repacked.ch5).
+           See cellh5.repack_positions for further options.
+
+           returns dict with throughput statistics
+        """
+        if output_file is None:
+            output_file = os.path.splitext(self.filename)[0] + "_repacked.ch5"
+
+        units = [[(filename, path, coord.get_path())] for coord, (filename, path) in self.get_linked_positions()]
+
+        definitions = []
+        link = self.get(CH5Const.DEFINITION, getlink=True)
+        if isinstance(link, h5py.ExternalLink):
+            definitions.append((self._resolve_link_file(link.filename), link.path, CH5Const.DEFINITION))
+        elif link is not None:
+            definitions.append((self.filename, CH5Const.DEFINITION, CH5Const.DEFINITION))
+
+        self.flush()
+        return repack_positions(units, output_file, definitions=definitions, n_workers=n_workers, **kwargs)
 
 
 class CH5ImageWideObjectWriter(CH5ObjectWriter):
@@ -410,15 +895,7 @@ class CH5ImageWideObjectWriter(CH5ObjectWriter):
         super().__init__(name, obj_grp, parent_pos)
 
     def write(self, t, c, z):
-        if 1 + self.offset > len(self.dset) :
-            # resize
-            self.dset.resize((1 + self.offset,))
-
-        self.dset[self.offset:self.offset+1] = \
-                numpy.array([self.offset, t,c,z], dtype=numpy.int32).view(
-                    dtype=self.dtype).T
-
-        self.offset+=1
+        self._append_rows(numpy.array([(self.offset, t, c, z)], dtype=self.dtype))
 
     def write_definition(self):
         img_def_grp = self.parent_pos.definitions.get_definition_root().require_group(CH5Const.OBJECT)
@@ -429,11 +906,72 @@ class CH5ImageWideObjectWriter(CH5ObjectWriter):
         def_dset[0] = [(self.name, 'image_xy', '', '')]
 
     def finalize(self):
-        self.dset.resize((self.offset,))
+        self._finalize_rows()
         super(CH5ImageWideObjectWriter, self).finalize()
 
 
 
+def benchmark_image_layouts(images, layouts=None, crop_size=64, n_crops=200, filename=None, seed=0):
+    """Write images, an array of shape (c, t, z, y, x), with each image layout
+       and measure file size, write time and read latency of full planes and of
+       random crops of crop_size (like the gallery images).
+
+       layouts: profile names or {name: CH5ImageLayout}, defaults to IMAGE_LAYOUTS
+       filename: file used for the measurements (removed afterwards), defaults
+                 to a temporary file
+
+       Returns a pandas.DataFrame with one row per layout
+    """
+    import time
+    import tempfile
+    if layouts is None:
+        layouts = IMAGE_LAYOUTS
+    if not isinstance(layouts, dict):
+        layouts = dict((name, get_image_layout(name)) for name in layouts)
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix=".ch5")
+        os.close(fd)
+
+    n_c, n_t, n_z, height, width = images.shape
+    rng = numpy.random.RandomState(seed)
+    planes = rng.randint(0, n_c * n_t * n_z, size=n_crops)
+    ys = rng.randint(0, max(1, height - crop_size), size=n_crops)
+    xs = rng.randint(0, max(1, width - crop_size), size=n_crops)
+
+    results = []
+    try:
+        for name in sorted(layouts):
+            start = time.time()
+            with CH5FileWriter(filename) as cfw:
+                cpw = cfw.add_position(CH5PositionCoordinate("benchmark", "A01", 1))
+                ciw = cpw.add_image(shape=images.shape, dtype=images.dtype, layout=layouts[name])
+                for c in range(n_c):
+                    for t in range(n_t):
+                        for z in range(n_z):
+                            ciw.write(images[c, t, z], c=c, t=t, z=z)
+            write_time = time.time() - start
+            size = os.path.getsize(filename)
+
+            with h5py.File(filename, "r") as f:
+                dset = f[CH5PositionCoordinate("benchmark", "A01", 1).get_path()][CH5Const.IMAGE][CH5Const.RAW_IMAGE]
+                start = time.time()
+                for p in planes[:max(1, n_crops // 10)]:
+                    dset[numpy.unravel_index(p, (n_c, n_t, n_z)) + (slice(None), slice(None))]
+                plane_time = (time.time() - start) / max(1, n_crops // 10)
+
+                start = time.time()
+                for p, y, x in zip(planes, ys, xs):
+                    dset[numpy.unravel_index(p, (n_c, n_t, n_z)) + (slice(y, y + crop_size), slice(x, x + crop_size))]
+                crop_time = (time.time() - start) / n_crops
+
+            results.append((name, size, size / float(images.nbytes), write_time, plane_time * 1000, crop_time * 1000))
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    return pandas.DataFrame(results, columns=["layout", "size", "ratio", "write_s", "plane_read_ms", "crop_read_ms"])
+
+
 if __name__ == "__main__":
 
     filename = "test.ch5"
@@ -242,4 +242,77 @@ class HMMTransitionCountEstimator(HMMEstimator):
         self._startprob = normalize(self._startprob, eps=0.0)
         return self._startprob
         
-      
\ No newline at end of file
+      
+
+class HMMViterbiDecoder(object):
+    """Log-space Viterbi decoding of many observation sequences of different
+    lengths at once, for hidden markov models with discrete emissions.
+
+    Gives the same state sequences as decoding each sequence with the
+    sklearn/hmmlearn MultinomialHMM.predict of the same model (ties are
+    resolved to the lowest state).
+    """
+
+    def __init__(self, startprob, transmat, emis):
+        with np.errstate(divide='ignore'):
+            self.log_startprob = np.log(np.asarray(startprob, dtype=float))
+            self.log_transmat = np.log(np.asarray(transmat, dtype=float))
+            self.log_emis = np.log(np.asarray(emis, dtype=float))
+        self.nstates = self.log_transmat.shape[0]
+
+    @classmethod
+    def from_estimator(cls, est):
+        return cls(est.startprob, est.trans, est.emis)
+
+    def decode(self, labels, lengths):
+        """Most likely state sequences for a padded (ntracks, maxlen) matrix
+        of observed symbols, entries beyond the track lengths are ignored.
+
+        Returns the states as ragged array (flat states, offsets).
+        """
+        labels = np.asarray(labels, dtype=int)
+        lengths = np.asarray(lengths, dtype=int)
+        offsets = np.r_[0, np.cumsum(lengths)]
+        ntracks = len(lengths)
+        maxlen = labels.shape[1] if labels.ndim == 2 else 0
+        if ntracks == 0 or maxlen == 0:
+            return np.zeros((0,), dtype=int), offsets
+
+        mask = np.arange(maxlen) < lengths[:, None]
+        framelogprob = self.log_emis.T[np.where(mask, labels, 0)]
+
+        # the lattice of a track is kept after its last observation
+        lattice = self.log_startprob + framelogprob[:, 0]
+        backptr = np.zeros((ntracks, maxlen, self.nstates), dtype=int)
+        for t in range(1, maxlen):
+            work = lattice[:, :, None] + self.log_transmat
+            backptr[:, t] = work.argmax(axis=1)
+            running = (t < lengths)[:, None]
+            lattice = np.where(running, work.max(axis=1) + framelogprob[:, t], lattice)
+
+        final = lattice.argmax(axis=1)
+        rows = np.arange(ntracks)
+        states = np.zeros((ntracks, maxlen), dtype=int)
+        state = final
+        for t in range(maxlen - 1, -1, -1):
+            state = np.where(lengths - 1 == t, final, state)
+            states[:, t] = state
+            state = backptr[rows, t, state]
+
+        return states[mask], offsets
+
+    def decode_ragged(self, labels, offsets):
+        """Decode the ragged array of sequences labels[offsets[i]:offsets[i+1]]"""
+        offsets = np.asarray(offsets, dtype=int)
+        lengths = np.diff(offsets)
+        maxlen = lengths.max() if len(lengths) > 0 else 0
+        padded = np.zeros((len(lengths), maxlen), dtype=int)
+        padded[np.arange(maxlen) < lengths[:, None]] = labels
+        return self.decode(padded, lengths)
+
+    def predict_tracks(self, tracks):
+        """State sequences of a list of observation sequences"""
+        offsets = np.r_[0, np.cumsum([len(t) for t in tracks])].astype(int)
+        labels = np.concatenate([np.asarray(t, dtype=int) for t in tracks]) if len(tracks) > 0 else []
+        states, offsets = self.decode_ragged(labels, offsets)
+        return [states[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
@@ -2,11 +2,74 @@ import sys
 import os
 sys.path.insert(0, os.getcwd() + "/pysrc/cellh5/")
 from cellh5 import cellh5,cellh5write
+import h5py
+import numpy
 import pytest
 
 ch5name = "test.ch5"
 defbase = "/definition/"
 samplebase = "/sample/0/"
+FEATURE_NAMES = ["roisize", "n2_avg", "f2"]
+CLASS_NAMES = ["inter", "pro", "meta"]
+CLASS_COLORS = ["#00FF00", "#FF8000", "#FF0000"]
+
+def _plate_image(t, site):
+    return ((numpy.add.outer(numpy.arange(100), 2 * numpy.arange(100)) + 10 * t + site) % 256).astype(numpy.uint8)
+
+def _write_plate(fname, sites=(1,), n_frames=6, split=3):
+    """Plate with one well of 100x100 images and three cells per position.
+       Cell 0 divides at frame split, the second daughter is the bigger one.
+       Object k has roisize 10 + k and class label_idx k % 3. Event 0 are
+       both branches of cell 0, event 1 the first frames of cell 1 + site % 2."""
+    with cellh5write.CH5FileWriter(fname) as cfw:
+        for site in sites:
+            cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", site))
+            ciw = cpw.add_image(shape=(1, n_frames, 1, 100, 100), dtype=numpy.uint8)
+            clw = cpw.add_label_image(shape=(1, n_frames, 1, 100, 100), dtype=numpy.uint16)
+            crw = cpw.add_region_object("primary__primary")
+            cfmw = cpw.add_object_feature_matrix("primary__primary", "object_features", len(FEATURE_NAMES), numpy.float32)
+            ccw = cpw.add_object_center("primary__primary")
+            ctw = cpw.add_tracking()
+            ccl = cpw.add_object_classification()
+
+            n, previous, paths = 0, [], {}
+            for t in range(n_frames):
+                cells = [0, 0, 1, 2] if t >= split else [0, 1, 2]
+                index = numpy.arange(n, n + len(cells))
+                crw.write(t=t, object_labels=numpy.arange(1, len(cells) + 1))
+                cfmw.write(numpy.c_[10 + index, index % 7, numpy.full(len(cells), t)])
+                ccw.write(numpy.c_[20 + 20 * numpy.arange(len(cells)), numpy.full(len(cells), 50)])
+                probs = numpy.eye(3)[index % 3]
+                ccl.write(index % 3, probs)
+                ciw.write(_plate_image(t, site), c=0, z=0, t=t)
+                clw.write(numpy.zeros((100, 100), dtype=numpy.uint16), c=0, z=0, t=t)
+                if t > 0:
+                    successors = index[[0, 1, 2, 3]] if t == split else index
+                    predecessors = previous[[0, 0, 1, 2]] if t == split else previous
+                    ctw.write(predecessors, successors)
+                for k, cell in enumerate(cells):
+                    paths.setdefault((cell, k if t >= split and cell == 0 else 0), []).append(index[k])
+                previous, n = index, n + len(cells)
+
+            # both branches of cell 0 form event 0, event 1 ends at frame split
+            first = paths[(0, 0)]
+            second = first[:split] + paths[(0, 1)]
+            cew = cpw.add_events()
+            cew.write_tracks([0, 0, 1], [first, second, paths[(1 + site % 2, 0)][:split + 1]])
+
+            if site == sites[0]:
+                c_def = cellh5write.CH5ImageChannelDefinition()
+                c_def.add_row(channel_name="1", description="h2b", is_physical=True, voxel_size=(1, 1, 1), color="#FF0000")
+                ciw.write_definition(c_def)
+                r_def = cellh5write.CH5ImageRegionDefinition()
+                r_def.add_row(region_name="region___primary__primary", channel_idx=0)
+                clw.write_definition(r_def)
+                crw.write_definition()
+                cfmw.write_definition(FEATURE_NAMES)
+                ctw.write_definition()
+                cew.write_definition()
+                ccl.write_definition([1, 2, 3], CLASS_NAMES, CLASS_COLORS)
+
 @pytest.mark.parametrize("ch5name", [(ch5name)])
 def test_empty_ch5(ch5name):
     cfw = cellh5write.CH5FileWriter(ch5name)
@@ -19,6 +82,662 @@ def test_empty_ch5(ch5name):
         assert fh.get_file_handle()[defbase+"object"]
     CH5FileWriter()
 
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_master_file_repack(tmpdir, n_workers):
+    files = []
+    for site in (1, 2):
+        fname = str(tmpdir.join("A01_%02d.ch5" % site))
+        with cellh5write.CH5FileWriter(fname) as cfw:
+            cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", site))
+            cpw.add_image(data=numpy.full((1, 2, 1, 8, 8), site, dtype=numpy.uint8))
+        files.append(fname)
+
+    master = str(tmpdir.join("master.ch5"))
+    mf = cellh5write.CH5MasterFile(master, "w")
+    for site, fname in zip((1, 2), files):
+        mf.add_link_to_coord(cellh5.CH5PositionCoordinate("plate", "A01", site), fname)
+    stats = mf.repack(n_workers=n_workers, progress=None)
+    assert stats["written"] == 2
+    # resume: nothing left to copy
+    assert mf.repack(n_workers=n_workers, progress=None)["skipped"] == 2
+    assert mf.repack(n_workers=n_workers, progress=None, verify=True)["skipped"] == 2
+    mf.close()
+
+    with cellh5.ch5open(str(tmpdir.join("master_repacked.ch5")), "r") as fh:
+        for site in (1, 2):
+            path = cellh5.CH5PositionCoordinate("plate", "A01", site).get_path()
+            assert not isinstance(fh.get_file_handle().get(path, getlink=True), h5py.ExternalLink)
+            assert (fh.get_position("A01", site).get_image(1, 0) == site).all()
+
 def test_tear_down():
     os.remove(ch5name)
     
+
+def test_buffered_row_writers(tmpdir):
+    fname = str(tmpdir.join("buffered.ch5"))
+    labels = [numpy.arange(n, dtype=numpy.int32) for n in (7, 0, 300, 45)]
+    features = numpy.random.randn(1234, 5).astype(numpy.float32)
+    with cellh5write.CH5FileWriter(fname, buffer_size=64) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        crw = cpw.add_region_object("primary__primary")
+        for t, l in enumerate(labels):
+            crw.write(t=t, object_labels=l)
+        cfmw = cpw.add_object_feature_matrix("primary__primary", "object_features", 5, numpy.float32)
+        for a in range(0, len(features), 100):
+            cfmw.write(features[a:a + 100])
+        cfmw.finalize()
+        cbw = cpw.add_object_bounding_box("primary__primary")
+        cbw.write(numpy.arange(12).reshape(3, 4))
+        ciw = cpw.add_image(shape=(1, 3, 1, 4, 4), dtype=numpy.uint8)
+        for t in range(3):
+            ciw.write(numpy.full((4, 4), t, dtype=numpy.uint8), c=0, z=0, t=t)
+        # region, bounding box and image writers are finalized on close
+
+    with h5py.File(fname, "r") as f:
+        pos = f[cellh5.CH5PositionCoordinate("plate", "A01", 1).get_path()]
+        region = pos["object/primary__primary"][()]
+        assert list(region["time_idx"]) == list(numpy.repeat(numpy.arange(4), [len(l) for l in labels]))
+        assert list(region["obj_label_id"]) == list(numpy.concatenate(labels))
+        assert (pos["feature/primary__primary/object_features"][()] == features).all()
+        assert pos["feature/primary__primary/bounding_box"][()]["bottom"].tolist() == [3, 7, 11]
+        assert pos["object/channel"][()]["time_idx"].tolist() == [0, 1, 2]
+
+@pytest.mark.parametrize("layout", ["contiguous", "plane", "tile"])
+def test_image_layouts(tmpdir, layout):
+    fname = str(tmpdir.join("layout.ch5"))
+    raw = numpy.random.randint(0, 255, (2, 3, 1, 300, 280)).astype(numpy.uint8)
+    with cellh5write.CH5FileWriter(fname) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        ciw = cpw.add_image(shape=raw.shape, dtype=raw.dtype, layout=layout)
+        for c in range(2):
+            for t in range(3):
+                ciw.write(raw[c, t, 0], c=c, t=t, z=0)
+
+    with cellh5.ch5open(fname, "r") as fh:
+        dset = fh.get_position("A01", 1)["image"]["channel"]
+        assert dset.chunks == cellh5write.IMAGE_LAYOUTS[layout].chunks(raw.shape)
+        assert (fh.get_position("A01", 1).get_image(2, 1) == raw[1, 2, 0]).all()
+
+def test_parallel_chunk_compression(tmpdir):
+    fname = str(tmpdir.join("compressed.ch5"))
+    raw = numpy.random.randint(0, 4000, (1, 4, 1, 300, 270)).astype(numpy.uint16)
+    features = numpy.random.randn(2500, 7).astype(numpy.float32)
+    with cellh5write.CH5FileWriter(fname, compression_workers=2) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        ciw = cpw.add_image(shape=raw.shape, dtype=raw.dtype,
+                            layout=cellh5write.CH5ImageLayout(tile=(128, 128), compression="gzip", shuffle=True))
+        for t in range(4):
+            ciw.write(raw[0, t, 0], c=0, t=t, z=0)
+        cfmw = cpw.add_object_feature_matrix("primary__primary", "object_features", 7, numpy.float32)
+        cfmw.write(features)
+
+    # read back through the HDF5 filter pipeline
+    with h5py.File(fname, "r") as f:
+        pos = f[cellh5.CH5PositionCoordinate("plate", "A01", 1).get_path()]
+        assert (pos["image/channel"][()] == raw).all()
+        assert (pos["feature/primary__primary/object_features"][()] == features).all()
+
+def test_tracking_event_classification_writers(tmpdir):
+    fname = str(tmpdir.join("bulk.ch5"))
+    # 4 frames of 3 objects, object k of frame t has index 3 * t + k
+    idx = numpy.arange(12).reshape(4, 3)
+    probs = numpy.random.dirichlet(numpy.ones(3), 12)
+    contours = [numpy.random.randint(0, 1000, (n, 2)) for n in [3, 1, 5] * 4]
+    with cellh5write.CH5FileWriter(fname, buffer_size=4) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        crw = cpw.add_region_object("primary__primary")
+        ctw = cpw.add_tracking()
+        ccw = cpw.add_object_classification()
+        ckw = cpw.add_crack_contour()
+        for t in range(4):
+            crw.write(t=t, object_labels=numpy.arange(1, 4))
+            if t > 0:
+                ctw.write(idx[t - 1], idx[t])
+            ccw.write(probs[idx[t]].argmax(1), probs[idx[t]])
+            ckw.write(contours[3 * t:3 * t + 3])
+        # object 0 splits into objects 0 and 1 after frame 1
+        ctw.write([3], [7])
+        cew = cpw.add_events()
+        cew.write_tracks([0, 0, 1], [[0, 3, 6, 9], [0, 3, 7, 10], [2, 5, 8]])
+        crw.write_definition()
+        ctw.write_definition()
+        cew.write_definition()
+        ccw.write_definition([0, 1, 2], ["a", "b", "c"], ["#FF0000", "#00FF00", "#0000FF"])
+
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        assert pos.has_classification("primary__primary")
+        assert pos.has_events()
+        events = pos["object/event"][()]
+        assert events["obj_id"].tolist() == [0] * 5 + [1] * 2
+        assert events["idx1"].tolist() == [0, 3, 6, 3, 7, 2, 5]
+        assert events["idx2"].tolist() == [3, 6, 9, 7, 10, 5, 8]
+        tracking = pos["object/tracking"][()]
+        assert tracking["obj_idx1"].tolist() == list(idx[:-1].ravel()) + [3]
+        assert tracking["obj_idx2"].tolist() == list(idx[1:].ravel()) + [7]
+        assert (pos.get_class_label(numpy.arange(12)) == probs.argmax(1)).all()
+        assert numpy.allclose(pos["feature/primary__primary/object_classification/probability"][()], probs)
+        for crack, contour in zip(pos.get_crack_contour(numpy.arange(12), bb_corrected=False), contours):
+            assert (crack == contour.reshape(-1, 2)).all()
+
+def test_write_tracks_empty(tmpdir):
+    fname = str(tmpdir.join("empty_events.ch5"))
+    with cellh5write.CH5FileWriter(fname) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        cew = cpw.add_events()
+        cew.write_tracks([], [])
+        cew.write_definition()
+
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        assert len(pos["object/event"]) == 0
+
+def _stream_position(fname, go, done):
+    with cellh5write.CH5FileWriter(fname, swmr=True) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        crw = cpw.add_region_object("primary__primary")
+        cfmw = cpw.add_object_feature_matrix("primary__primary", "object_features", 2, numpy.float32)
+        ctw = cpw.add_tracking()
+        ciw = cpw.add_image(shape=(1, 4, 1, 8, 8), dtype=numpy.uint8, layout="plane")
+        cfw.start_swmr()
+        done.put(None)
+        for t in range(4):
+            go.get()
+            crw.write(t=t, object_labels=numpy.arange(1, 4))
+            cfmw.write(numpy.full((3, 2), t, dtype=numpy.float32))
+            if t > 0:
+                ctw.write(numpy.arange(3 * t - 3, 3 * t), numpy.arange(3 * t, 3 * t + 3))
+            ciw.write(numpy.full((8, 8), t, dtype=numpy.uint8), c=0, z=0, t=t)
+            cpw.publish_frame(t)
+            done.put(t)
+
+def test_swmr_streaming(tmpdir):
+    import multiprocessing
+    fname = str(tmpdir.join("live.ch5"))
+    go, done = multiprocessing.Queue(), multiprocessing.Queue()
+    writer = multiprocessing.Process(target=_stream_position, args=(fname, go, done))
+    writer.start()
+    try:
+        done.get(timeout=60)
+        with cellh5.ch5open(fname, "r", swmr=True) as fh:
+            pos = fh.get_position("A01", 1)
+            assert len(pos.refresh()) == 0
+            for t in range(3):
+                go.put(t)
+                done.get(timeout=60)
+            assert list(pos.refresh()) == [0, 1, 2]
+            assert pos.get_object_count() == 9
+            assert pos.get_all_time_idx().tolist() == [0, 0, 0, 1, 1, 1, 2, 2, 2]
+            assert pos.get_tracking()["obj_idx2"].tolist() == [3, 4, 5, 6, 7, 8]
+            assert (pos.get_object_features()[:, 0] == numpy.repeat([0, 1, 2], 3)).all()
+            assert (pos.get_image(2, 0) == 2).all()
+            go.put(3)
+            # iterates until the writer is closed
+            assert list(pos.iter_frames(poll_interval=0.05, timeout=60)) == [3]
+            assert pos.get_object_count() == 12
+    finally:
+        writer.join(60)
+
+def test_parallel_chunk_compression_partial_flush(tmpdir):
+    fname = str(tmpdir.join("partial.ch5"))
+    features = numpy.random.randn(30, 4).astype(numpy.float32)
+    with cellh5write.CH5FileWriter(fname, compression_workers=2) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        cfmw = cpw.add_object_feature_matrix("primary__primary", "object_features", 4, numpy.float32)
+        # the first write ends inside a chunk, the second one starts there
+        cfmw.write(features[:10])
+        cfmw.flush()
+        cfmw.write(features[10:])
+
+    with h5py.File(fname, "r") as f:
+        pos = f[cellh5.CH5PositionCoordinate("plate", "A01", 1).get_path()]
+        assert (pos["feature/primary__primary/object_features"][()] == features).all()
+
+def test_track_all_merges(tmpdir):
+    fname = str(tmpdir.join("merge.ch5"))
+    with cellh5write.CH5FileWriter(fname) as cfw:
+        cpw = cfw.add_position(cellh5.CH5PositionCoordinate("plate", "A01", 1))
+        crw = cpw.add_region_object("primary__primary")
+        crw.write(t=0, object_labels=numpy.arange(1, 3))
+        crw.write(t=1, object_labels=numpy.arange(1, 2))
+        crw.write(t=2, object_labels=numpy.arange(1, 3))
+        crw.write(t=3, object_labels=numpy.arange(1, 2))
+        # objects 0 and 1 merge into 2, which splits into 3 and 4, 4 ends in 5
+        cpw.add_tracking().write([0, 1, 2, 2, 4], [2, 2, 3, 4, 5])
+
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        assert pos.track_all(0) == [[2, 3], [2, 4, 5]]
+        assert pos.track_all(1) == [[2, 3], [2, 4, 5]]
+        assert pos.track_all(4) == [[5]]
+        assert pos.track_all(5) == [None]
+
+def test_track_biggest_many(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        start_idx = numpy.arange(pos.get_object_count())
+        tracks, offsets = pos.track_biggest_many(start_idx)
+        for k, i in enumerate(start_idx):
+            assert list(tracks[offsets[k]:offsets[k + 1]]) == pos.track_biggest(i)
+        # cell 0 (object 0) divides into objects 9 and 10 at frame 3
+        assert pos.track_biggest(0) == [3, 6, 10, 14, 18]
+        assert pos.track_first(0) == [3, 6, 9, 13, 17]
+
+def test_table_view(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        full = pos["object/primary__primary"][()]
+        objects = pos.get_object_table("primary__primary")
+        assert isinstance(objects, numpy.ndarray)
+        assert (objects == full).all()
+
+        table = pos.get_table("object/primary__primary")
+        mask = full["time_idx"] == 3
+        assert len(table) == len(full)
+        assert table["time_idx"].dtype == full.dtype["time_idx"]
+        assert (table[mask, "obj_label_id"] == full["obj_label_id"][mask]).all()
+        assert (table[10:20] == full[10:20]).all()
+        assert (table[[12, 3, 3]] == full[[12, 3, 3]]).all()
+
+def test_sidecar_index_reused(tmpdir, monkeypatch):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    builds = []
+    build = cellh5.CH5Index.build
+    def counting_build(cls, ch5file):
+        builds.append(ch5file.filename)
+        return build(ch5file)
+    monkeypatch.setattr(cellh5.CH5Index, "build", classmethod(counting_build))
+
+    mtime = os.stat(fname).st_mtime
+    with cellh5.ch5open(fname, "r") as fh:
+        counts = [fh.get_position("A01", s).get_object_count() for s in ("1", "2")]
+        class_definition = fh.class_definition()
+    for _ in range(2):
+        fh = cellh5.CH5File(fname, index=True)
+        assert fh.index is not None
+        assert fh.positions == {"A01": ["1", "2"]}
+        assert [fh.get_position("A01", s).get_object_count() for s in ("1", "2")] == counts
+        assert (fh.class_definition() == class_definition).all()
+        fh.close()
+    assert builds == [fname]
+    assert os.stat(fname).st_mtime == mtime
+
+def test_fate_analysis_n_workers(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2, 3))
+    mapping = tmpdir.join("plate.txt")
+    mapping.write("Well\tSite\tRow\tColumn\n" + "".join("A01\t%d\tA\t1\n" % s for s in (1, 2, 3)))
+
+    results = []
+    for n_workers in (0, 2):
+        fa = cellh5.CH5FateAnalysis("fate", mapping_files={"plate": str(mapping)},
+                                    cellh5_files={"plate": fname}, output_dir=str(tmpdir))
+        try:
+            fa.read_events()
+            fa.track_events(n_workers=n_workers)
+            fa.hmm_decoder = cellh5.HMMViterbiDecoder(numpy.ones(3) / 3,
+                                                      [[0.8, 0.1, 0.1], [0.1, 0.8, 0.1], [0.1, 0.1, 0.8]],
+                                                      [[0.6, 0.2, 0.2], [0.2, 0.6, 0.2], [0.2, 0.2, 0.6]])
+            fa.predict_hmm(n_workers=n_workers)
+            results.append([[list(map(list, fa.mapping[c][k])) for c in ("Track IDs", "Track Labels", "HMM Track Labels")]
+                            for k in range(len(fa.mapping))])
+        finally:
+            fa.close()
+
+    assert results[0] == results[1]
+    # event 1 (cell 2 at site 1, cell 1 at site 2) is extended by its first successors
+    assert results[0][0][0] == [[0, 3, 6, 9, 13, 17], [2, 5, 8, 12, 16, 20]]
+    assert results[0][1][0] == [[0, 3, 6, 9, 13, 17], [1, 4, 7, 11, 15, 19]]
+    assert results[0][1][1] == [[0, 0, 0, 0, 1, 2], [1, 1, 1, 2, 0, 1]]
+
+def test_lazy_positions(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    with cellh5.ch5open(fname, "r") as fh:
+        assert len(fh._position_group) == 0
+        assert fh.has_position("A01", 2)
+        assert not fh.has_position("A01", 3)
+        pos = fh.get_position("A01", 2)
+        assert pos is fh.get_position("A01", 2)
+        assert len(fh._position_group) == 1
+        assert [(c.well, c.site) for c in fh.get_coordinates()] == [("A01", "1"), ("A01", "2")]
+        assert len(list(fh.iter_positions())) == 2
+
+def test_virtual_file(tmpdir):
+    for site in (1, 2, 3):
+        _write_plate(str(tmpdir.join("A01_%02d.ch5" % site)), sites=(site,))
+    _write_plate(str(tmpdir.join("plate.h5")), sites=(1, 2, 3))
+
+    vf = cellh5.CH5VirtualFile(str(tmpdir), max_open_files=2)
+    try:
+        with cellh5.ch5open(str(tmpdir.join("plate.h5")), "r") as fh:
+            assert vf.positions == fh.positions
+            assert (vf.class_definition() == fh.class_definition()).all()
+            for site in ("1", "2", "3", "1"):
+                pos, ref = vf.get_position("A01", site), fh.get_position("A01", site)
+                assert pos.get_object_count() == ref.get_object_count()
+                assert pos.track_first(2) == ref.track_first(2)
+                assert (pos.get_image(5, 0) == ref.get_image(5, 0)).all()
+    finally:
+        vf.close()
+
+def test_cache(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    cache = cellh5.CH5_CACHE
+    cache.reset_statistics()
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        a = pos.get_object_features(index=numpy.arange(10))
+        b = pos.get_object_features(index=numpy.arange(10))
+        assert a is b
+        stats = cache.statistics().loc["CH5CachedPosition.get_object_features"]
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+        pos.clear_cache()
+        assert pos.get_object_features(index=numpy.arange(10)) is not a
+
+        try:
+            cache.set_max_bytes(a.nbytes)
+            pos.get_object_features(index=numpy.arange(5))
+            assert cache.nbytes <= a.nbytes
+        finally:
+            cache.set_max_bytes(cellh5.CH5Cache.DEFAULT_MAX_BYTES)
+
+def test_gallery_images(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    size, size_2 = cellh5.GALLERY_SIZE, cellh5.GALLERY_SIZE // 2
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        # objects at the left and right image border and in between, over several frames
+        index = numpy.array([5, 0, 2, 1, 12, 0, 20])
+        images = pos.get_gallery_images(index)
+        assert images.shape == (len(index), size, size)
+        time_idx = pos["object/primary__primary"]["time_idx"]
+        centers = pos["feature/primary__primary/center"][()]
+        for img, i in zip(images, index):
+            cx, cy = centers[i]
+            crop = _plate_image(time_idx[i], 1)[max(0, cy - size_2):cy + size_2, max(0, cx - size_2):cx + size_2]
+            expected = numpy.zeros((size, size), dtype=numpy.uint8)
+            expected[size - crop.shape[0]:, :crop.shape[1]] = crop
+            assert (img == expected).all()
+        assert (pos.get_gallery_image(tuple(index[:3])) == numpy.concatenate(images[:3], axis=1)).all()
+
+def test_coalesced_read(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        features = pos.get_object_features()
+        assert features.shape == (21, len(FEATURE_NAMES))
+        dset = pos["feature/primary__primary/object_features"]
+        index = numpy.array([[20, 3], [3, -1], [0, 11]])
+        for max_gap in (0, 2, 100):
+            assert (cellh5.read_coalesced(dset, index, max_gap=max_gap) == features[index]).all()
+        assert cellh5.read_coalesced(dset, numpy.zeros((0,), dtype=int)).shape == (0, len(FEATURE_NAMES))
+        with pytest.raises(IndexError):
+            cellh5.read_coalesced(dset, [21])
+
+        objects = pos["object/primary__primary"][()]
+        assert (cellh5.read_coalesced(pos["object/primary__primary"], [7, 2, 7], fields="time_idx") ==
+                objects["time_idx"][[7, 2, 7]]).all()
+        assert (pos.get_time_indecies([20, 3, 3]) == objects["time_idx"][[20, 3, 3]]).all()
+
+def _check_frame_index(frame_index, time_idx):
+    assert (frame_index.counts() == numpy.bincount(time_idx)).all()
+    assert (frame_index.objects_in_frame(3) == numpy.nonzero(time_idx == 3)[0]).all()
+    assert (frame_index.objects_in_frames(2, 5) == numpy.nonzero((time_idx >= 2) & (time_idx < 5))[0]).all()
+    assert (frame_index.objects_of([4, 1]) == numpy.nonzero(numpy.in1d(time_idx, [4, 1]))[0]).all()
+
+def test_frame_index(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        time_idx = pos["object/primary__primary"]["time_idx"]
+        _check_frame_index(pos.get_frame_index(), time_idx)
+        assert (pos.get_object_idx(frame=4) == numpy.arange(13, 17)).all()
+
+    # persisted in the sidecar store and loaded from there on the next open
+    for _ in range(2):
+        fh = cellh5.CH5File(fname, index=True)
+        try:
+            _check_frame_index(fh.get_position("A01", 1).get_frame_index(), time_idx)
+        finally:
+            fh.close()
+    assert fh.sidecar.load("frame_index/A01/1/primary__primary") is not None
+
+def test_definitions(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    with cellh5.ch5open(fname, "r") as fh:
+        definitions = fh.get_definitions()
+        assert definitions is fh.get_definitions()
+        assert list(definitions.feature_names()) == FEATURE_NAMES
+        assert definitions.feature_index()["n2_avg"] == 1
+        assert fh.get_object_feature_idx_by_name("primary__primary", "f2") == 2
+        labels, names, colors = definitions.class_lut()
+        assert list(labels) == [1, 2, 3]
+        assert list(names) == CLASS_NAMES
+        assert list(colors) == CLASS_COLORS
+        assert definitions.region_channel_idx("primary__primary") == 0
+        for site in (1, 2):
+            pos = fh.get_position("A01", site)
+            assert pos.definitions.get_definitions() is definitions
+            assert pos.channel_color_by_region("primary__primary") == definitions.channels["color"][0]
+
+def test_tracking_graph(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        tracking = pos.get_tracking()
+        graph = pos.get_tracking_graph()
+        index = numpy.arange(pos.get_object_count())
+        successors, offsets = graph.get_successors_many(index)
+        predecessors, pred_offsets = graph.get_predecessors_many(index)
+        for k, i in enumerate(index):
+            assert (successors[offsets[k]:offsets[k + 1]] == tracking["obj_idx2"][tracking["obj_idx1"] == i]).all()
+            assert (predecessors[pred_offsets[k]:pred_offsets[k + 1]] == tracking["obj_idx1"][tracking["obj_idx2"] == i]).all()
+            assert list(graph.get_successors(i)) == list(successors[offsets[k]:offsets[k + 1]])
+        assert (graph.out_degree(index) == numpy.diff(offsets)).all()
+        assert (graph.in_degree(index) == numpy.diff(pred_offsets)).all()
+        # object 6 (cell 0 in frame 2) divides, objects of the last frame have no successors
+        assert list(graph.split_objects()) == [6]
+        assert list(graph.get_successors(6)) == [9, 10]
+        assert list(graph.out_degree(numpy.arange(17, 21))) == [0] * 4
+        has_next = graph.out_degree(index) > 0
+        assert (graph.next_objects(index[has_next]) == successors[offsets[:-1][has_next]]).all()
+
+def test_track_many(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        start_idx = numpy.array([0, 6, 2, 20, 0])
+        for max_length in (None, 2):
+            kwargs = {} if max_length is None else {"max_length": max_length}
+            tracks, offsets = pos.track_first_many(start_idx, **kwargs)
+            for k, i in enumerate(start_idx):
+                assert list(tracks[offsets[k]:offsets[k + 1]]) == pos.track_first(i, **kwargs)
+        tracks, offsets = pos.track_backwards_many(start_idx)
+        for k, i in enumerate(start_idx):
+            assert list(tracks[offsets[k]:offsets[k + 1]]) == pos.track_backwards(i)
+        assert pos.track_backwards(18) == [0, 3, 6, 10, 14]
+
+def test_events(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        events = pos.get_events()
+        # ragged, event 1 is shorter than event 0
+        assert [list(e) for e in events] == [[0, 3, 6, 9, 13, 17], [2, 5, 8, 12]]
+        both = pos.get_events(output_second_branch=True)
+        assert [list(e) for e in both] == [[0, 3, 6, 9, 13, 17], [0, 3, 6, 10, 14, 18], [2, 5, 8, 12]]
+        assert len(pos.get_events(random=1)) == 1
+
+        event_ids, branch, tracks, offsets = cellh5.CH5EventDecoder(pos.get_table("object/event")).tracks()
+        assert list(event_ids) == [0, 0, 1]
+        assert list(branch) == [0, 1, 0]
+        for k, track in enumerate(both):
+            assert (tracks[offsets[k]:offsets[k + 1]] == track).all()
+        # event items list the idx1 column, i.e. without the last object
+        assert pos.get_event_items() == [(0, [0, 3, 6, 9, 13]), (1, [2, 5, 8])]
+        assert pos.get_event_items(output_second_branch=True) == [(0, [0, 3, 6, 9, 13], [0, 3, 6, 10, 14]),
+                                                                  (1, [2, 5, 8])]
+
+def test_lineage_forest(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        forest = pos.get_lineage_forest()
+        assert list(forest.roots()) == [0, 1, 2]
+        assert list(forest.children(6)) == [9, 10]
+        assert list(forest.subtree(0)) == [0, 3, 6, 9, 13, 17, 10, 14, 18]
+        assert list(forest.leaves(0)) == [17, 18]
+        assert list(forest.ancestors(18)) == [14, 10, 6, 3, 0]
+        assert list(numpy.flatnonzero(forest.division)) == [6]
+        for root in forest.roots():
+            assert len(forest.descendants(root)) + 1 == forest.size[root]
+            for leaf in forest.leaves(root):
+                assert forest.ancestors(leaf)[-1] == root
+                assert len(forest.ancestors(leaf)) == forest.depth[leaf]
+        flat, offsets = forest.paths([0])
+        assert [list(flat[a:b]) for a, b in zip(offsets[:-1], offsets[1:])] == [[0] + t for t in pos.track_all(0)]
+
+def test_class_lookup(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname)
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        index = numpy.array([[1, 5], [12, 10 ** 9]])
+        labels = pos.get_class_label(index)
+        assert labels.tolist() == [[2, 3], [1, cellh5.CH5Const.UNPREDICTED_LABEL]]
+        assert pos.get_class_name(index[0]) == ["pro", "meta"]
+        assert pos.get_class_name(12) == "inter"
+        assert pos.get_class_color(index[0]) == CLASS_COLORS[1:]
+        assert pos.get_class_color(10 ** 9) == cellh5.CH5Const.UNPREDICTED_COLOR
+        assert pos.get_class_rgb(index).shape == index.shape + (3,)
+        assert pos.get_class_rgb([4]).tolist() == [[255, 128, 0]]
+        assert pos.class_name_def([3, 1]) == ["meta", "inter"]
+        assert pos.class_color_def([2]) == ["#FF8000"]
+        assert pos.get_class_label_index([7, 8]).tolist() == [1, 2]
+
+        probabilities = pos.get_prediction_probabilities()
+        assert (probabilities.argmax(1) == numpy.arange(21) % 3).all()
+        assert (pos.get_prediction_probabilities([4, 0]) == probabilities[[4, 0]]).all()
+
+def test_class_counts(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    # object k has label_idx k % 3, three objects in frames 0 to 2 and four afterwards
+    expected = [[1, 1, 1, 0]] * 3 + [[2, 1, 1, 0], [1, 2, 1, 0], [1, 1, 2, 0]]
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        assert pos.get_class_counts().tolist() == expected
+        for n_workers in (0, 2):
+            counts = fh.get_class_counts(n_workers=n_workers)
+            assert counts.counts.tolist() == [expected, expected]
+            assert list(counts.positions["Site"]) == ["1", "2"]
+        assert counts.class_names == CLASS_NAMES + [cellh5.CH5Const.UNPREDICTED_NAME]
+        mitotic_index = counts.mitotic_index(["pro", "meta"])
+        assert numpy.allclose(mitotic_index.values[0], [2 / 3.] * 3 + [0.5, 0.75, 0.75])
+
+    fh = cellh5.CH5File(fname, index=True)
+    try:
+        assert fh.get_class_counts().counts.tolist() == [expected, expected]
+        assert fh.sidecar.load("class_counts/primary__primary/A01/1") is not None
+    finally:
+        fh.close()
+
+def test_event_catalog(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    with cellh5.ch5open(fname, "r") as fh:
+        catalog = fh.get_event_catalog(onset_frame=4)
+        assert len(catalog) == 6
+        assert list(catalog.events["position"]) == [0, 0, 0, 1, 1, 1]
+        assert list(catalog.events["event_id"]) == [0, 0, 1] * 2
+        assert list(catalog.events["branch"]) == [0, 1, 0] * 2
+        assert list(catalog.events["length"]) == [6, 6, 4] * 2
+        # event 1 is too short for an onset at its fifth object
+        assert list(catalog.events["onset"]) == [4, 4, -1] * 2
+        assert [list(t) for t in catalog.tracks()[2:4]] == [[2, 5, 8, 12], [0, 3, 6, 9, 13, 17]]
+
+        selection = catalog.select(onset_window=(4, None), branch=0)
+        assert list(selection.events["position"]) == [0, 1]
+        assert [list(t) for t in selection.tracks()] == [[0, 3, 6, 9, 13, 17]] * 2
+        assert len(catalog.select(min_length=5)) == 4
+        selection = catalog.select(Site="2")
+        assert [list(t) for t in selection.tracks()] == [[0, 3, 6, 9, 13, 17], [0, 3, 6, 10, 14, 18], [1, 4, 7, 11]]
+        assert list(selection.get_class_labels()[-4:]) == [2, 2, 2, 3]
+        assert list(selection.table["Site"]) == ["2"] * 3
+
+def test_track_features(tmpdir):
+    fname = str(tmpdir.join("plate.ch5"))
+    _write_plate(fname, sites=(1, 2))
+    with cellh5.ch5open(fname, "r") as fh:
+        pos = fh.get_position("A01", 1)
+        tracks = [list(e) for e in pos.get_events()]
+        # roisize of object k is 10 + k, f2 its time frame
+        cube, origin = pos.get_track_features(tracks, ["roisize", "f2"], align=2)
+        assert origin == 2
+        assert cube.shape == (2, 6, 2)
+        assert cube[0, :, 0].tolist() == [10 + i for i in tracks[0]]
+        assert cube[1, :4, 0].tolist() == [10 + i for i in tracks[1]]
+        assert numpy.isnan(cube[1, 4:]).all()
+        assert cube[:, origin, 1].tolist() == [2, 2]
+
+        cube, origin = pos.get_track_features(tracks, "roisize", align=[3, 1], window=(1, 1))
+        assert origin == 1
+        assert cube[:, :, 0].tolist() == [[16, 19, 23], [12, 15, 18]]
+
+        values, offsets = pos.get_track_features(tracks, [0], ragged=True)
+        assert list(offsets) == [0, 6, 10]
+        assert values[:, 0].tolist() == [10 + i for track in tracks for i in track]
+
+        catalog = fh.get_event_catalog().select(branch=0)
+        cube, origin = catalog.get_features(["roisize"])
+        assert cube.shape == (4, 6, 1)
+        assert cube[2, :4, 0].tolist() == [10 + i for i in tracks[0][:4]]
+
+def _viterbi(startprob, transmat, emis, labels):
+    # reference decoding of a single sequence
+    with numpy.errstate(divide="ignore"):
+        log_start, log_trans, log_emis = numpy.log(startprob), numpy.log(transmat), numpy.log(emis)
+    lattice = log_start + log_emis[:, labels[0]]
+    backptr = []
+    for label in labels[1:]:
+        work = lattice[:, None] + log_trans
+        backptr.append(work.argmax(axis=0))
+        lattice = work.max(axis=0) + log_emis[:, label]
+    states = [int(lattice.argmax())]
+    for ptr in reversed(backptr):
+        states.append(int(ptr[states[-1]]))
+    return states[::-1]
+
+def test_viterbi_decoder():
+    est = cellh5.HMMAgnosticEstimator(3, cellh5.normalize(numpy.eye(3) + 0.1, axis=1), numpy.eye(3) + 0.01, numpy.ones((3, )))
+    decoder = cellh5.HMMViterbiDecoder.from_estimator(est)
+    states = decoder.predict_tracks([[0, 0, 1, 1, 2], [], [2, 2]])
+    assert [list(s) for s in states] == [[0, 0, 1, 1, 2], [], [2, 2]]
+    flat, offsets = decoder.decode([[0, 1, 2], [1, 0, 0]], [3, 1])
+    assert list(flat) == [0, 1, 2, 1]
+    assert list(offsets) == [0, 3, 4]
+
+    rng = numpy.random.RandomState(0)
+    startprob = numpy.array([0.5, 0.3, 0.2])
+    transmat = numpy.array([[0.7, 0.3, 0.0], [0.0, 0.8, 0.2], [0.1, 0.0, 0.9]])
+    emis = numpy.array([[0.6, 0.3, 0.1], [0.2, 0.5, 0.3], [0.1, 0.2, 0.7]])
+    decoder = cellh5.HMMViterbiDecoder(startprob, transmat, emis)
+    tracks = [rng.randint(0, 3, size=n) for n in rng.randint(1, 15, size=30)]
+    states = decoder.predict_tracks(tracks)
+    for track, state in zip(tracks, states):
+        assert list(state) == _viterbi(startprob, transmat, emis, track)